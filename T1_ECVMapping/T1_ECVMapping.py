@@ -1,16 +1,24 @@
 import os
+import sys
+import time
+ImportStart = time.perf_counter()
+import collections
+import tracemalloc
 import unittest
 import logging
+import warnings
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 import numpy as np
-from scipy.optimize import curve_fit
-import pydicom
 import slicer
-import DataProbeLib
-import SegmentStatistics
-from scipy import interpolate
+from T1_ECVMappingLib import BatchFit, ResultCache, DicomMetadata, Resample, ECV, Statistics, Quality, Instrumentation, Models
+
+# scipy, pydicom and DataProbeLib are imported where they are used, they slow down the start of Slicer. So are the
+# modules of T1_ECVMappingLib that only some engines and options use: ParallelFit, Dictionary, Multiresolution,
+# MotionCorrection and Benchmark.
+# Time (s) of the import of the module, of the construction of the widget and of the first set up of the scene
+StartupTimes = {}
 #
 # T1_ECVMapping
 #
@@ -49,6 +57,7 @@ class T1_ECVMappingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     """
     Called when the user opens the module the first time and the widget is initialized.
     """
+    Start = time.perf_counter()
     ScriptedLoadableModuleWidget.__init__(self, parent)
     VTKObservationMixin.__init__(self)  # needed for parameter node observation
     self.logic = None
@@ -56,21 +65,21 @@ class T1_ECVMappingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.T1_LLN_Node = None
     self.T1_LLE_Node = None
     self.ECVMapNode = None
+    self.ECVEngine = ECV.ECVEngine()
     self.LLE_Node = None
     self.LLN_Node = None
     self.ArefNode = None
     self.T1_LLE_Name = 'T1 Enhanced'
     self.T1_LLN_Name = 'T1 Native'
-    self.ResetSliceViews()
-    self.LinkSlices()
-    self.ColorBarEnabled()
-    self.setupVolumeNodeViewLayout()
+    self.SceneReady = False # The slice views and the layout are set up the first time a volume is shown, by PrepareScene
     self.Warning = True
+    StartupTimes['Widget'] = time.perf_counter()-Start
 
   def setup(self):
     """
     Called when the user opens the module the first time and the widget is initialized.
     """
+    Start = time.perf_counter()
     ScriptedLoadableModuleWidget.setup(self)
     try:
       self.reloadCollapsibleButton.collapsed   = True
@@ -87,10 +96,16 @@ class T1_ECVMappingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.setupAnatomicalRef()
     self.setupLL_Native()
     self.setupLL_Enhanced()
+    self.setupFitEngine()
+    self.setupWorkersSpinBox()
+    self.setupCache()
+    self.setupFitOptions()
+    self.setupFitRegionSelector()
 
     # Apply Buttons
     self.setRefreshViewsAndCheckButtonButton()
     self.setT1Button()
+    self.setupT1Progress()
 
     # Statistics section widgets
     Statistics = ctk.ctkCollapsibleButton()
@@ -126,9 +141,47 @@ class T1_ECVMappingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     self.onCheckbuttonChecked()
     self.setupConnections()
+    StartupTimes['Widget'] = StartupTimes.get('Widget', 0)+time.perf_counter()-Start
+    self.LogStartupTimes()
+
+  def LogStartupTimes(self):
+    """ Report the time of the import of the module, of the construction of its widget and of the set up of the scene """
+    logging.info('T1_ECVMapping startup: '+', '.join('{} {:.0f} ms'.format(Key.lower(), Time*1000) for Key, Time in StartupTimes.items()))
+
+  def PrepareScene(self):
+    """ Clear and link the slice views, enable the color bars and set the layout, only the first time a volume is shown """
+    if self.SceneReady:
+      return
+    self.SceneReady = True
+    Start = time.perf_counter()
+    self.ResetSliceViews()
+    self.LinkSlices()
+    self.ColorBarEnabled()
+    self.setupVolumeNodeViewLayout()
+    StartupTimes['Scene'] = time.perf_counter()-Start
+    self.LogStartupTimes()
 
 
   
+  def cleanup(self):
+    """ Called when the application closes and the module widget is destroyed """
+    if self.T1Jobs:
+      self.onCancelT1Button()
+    ParallelFit = sys.modules.get('T1_ECVMappingLib.ParallelFit') # There is no pool if it was never imported
+    if ParallelFit:
+      ParallelFit.ShutdownPool()
+    DoubleSlider.CancelUpdates()
+    self.removeObservers()
+    T1_ECVMappingLogic.ClearSegmentCache()
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeRemoved(self, Caller, Event, Node):
+    if Node.IsA('vtkMRMLSegmentationNode'):
+      T1_ECVMappingLogic.ClearSegmentCache(Node)
+
+  def onSceneEndClose(self, Caller, Event):
+    T1_ECVMappingLogic.ClearSegmentCache()
+
   def setupLL_Enhanced(self):
     """ Set up the Scalar Volume Selector for the Enhanced Look Locker"""
     self.LLE_Selector = slicer.qMRMLNodeComboBox()
@@ -164,6 +217,93 @@ class T1_ECVMappingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.Aref_SelectorLabel.setToolTip("Select the Anatomical sequence to visualize")
     self.InputOutput_Layout.addRow(self.Aref_SelectorLabel, self.Aref_Selector)
 
+  def setupFitEngine(self):
+    """ Set up the Combo boxes of the T1 estimation and of the signal model """
+    self.Engine_ComboBox = qt.QComboBox()
+    self.Engine_ComboBox.addItems(['Batched fit', 'Multiresolution fit', 'Dictionary', 'Pixel by pixel fit'])
+    self.Engine_ComboBox.setToolTip("Method used to fit the T1 of every pixel, Pixel by pixel fit is the original curve_fit method")
+    self.InputOutput_Layout.addRow(qt.QLabel('T1 estimation'), self.Engine_ComboBox)
+    self.Model_ComboBox = qt.QComboBox()
+    self.Model_ComboBox.addItems(list(Models.Registry))
+    self.Model_ComboBox.setToolTip("Signal model of the sequence, the models other than Look Locker are always fitted with the batched fit")
+    self.InputOutput_Layout.addRow(qt.QLabel('Signal model'), self.Model_ComboBox)
+
+  def setupWorkersSpinBox(self):
+    """ Set up the Spin box with the number of processes used to fit the T1 Mapping, and the background option """
+    self.Workers_SpinBox = qt.QSpinBox()
+    self.Workers_SpinBox.setRange(1, os.cpu_count() or 1)
+    self.Workers_SpinBox.value = 1
+    self.Workers_SpinBoxLabel = qt.QLabel('Worker processes')
+    self.Workers_SpinBox.setToolTip("Number of processes used to fit the T1 Mapping")
+    self.Background_CheckBox = qt.QCheckBox('Run in background')
+    self.Background_CheckBox.toolTip = "Fit the T1 Mapping with the batched fit in worker processes, keeping Slicer responsive"
+    self.Background_CheckBox.setChecked(self.BackgroundAvailable())
+    self.Background_CheckBox.enabled = self.BackgroundAvailable()
+    HLayout = qt.QHBoxLayout()
+    HLayout.addWidget(self.Workers_SpinBox)
+    HLayout.addWidget(self.Background_CheckBox)
+    self.InputOutput_Layout.addRow(self.Workers_SpinBoxLabel, HLayout)
+
+  def BackgroundAvailable(self):
+    """ ParallelFit.IsAvailable, without importing ParallelFit and multiprocessing when the widget is set up """
+    return sys.version_info >= (3, 8)
+
+  def setupCache(self):
+    """ Set up the cache option, its statistics and the button that clears it """
+    self.Cache_CheckBox = qt.QCheckBox('Use cache')
+    self.Cache_CheckBox.toolTip = "Restore the T1 Mapping of Look Locker volumes that were already fitted with the same settings"
+    self.Cache_CheckBox.setChecked(True)
+    self.CacheLabel = qt.QLabel()
+    self.ClearCacheButton = qt.QPushButton("Clear cache")
+    HLayout = qt.QHBoxLayout()
+    HLayout.addWidget(self.Cache_CheckBox)
+    HLayout.addWidget(self.CacheLabel)
+    HLayout.addWidget(self.ClearCacheButton)
+    self.InputOutput_Layout.addRow(HLayout)
+    self.UpdateCacheLabel()
+
+  def setupFitOptions(self):
+    """ Set up the Check boxes of the low memory mode, the quality maps and the motion correction """
+    self.LowMemory_CheckBox = qt.QCheckBox('Low memory')
+    self.LowMemory_CheckBox.toolTip = "Keep the T1 and ECV maps in float32 and write them directly in the volumes, for large Look Locker series"
+    self.QualityMaps_CheckBox = qt.QCheckBox('Quality maps')
+    self.QualityMaps_CheckBox.toolTip = "Also create the T1 SD, RMS, R2 and Iterations maps of the fit"
+    self.MotionCorrection_CheckBox = qt.QCheckBox('Motion correction')
+    self.MotionCorrection_CheckBox.toolTip = "Align the frames of every slice of the Look Locker before the fit"
+    HLayout = qt.QHBoxLayout()
+    HLayout.addWidget(self.LowMemory_CheckBox)
+    HLayout.addWidget(self.QualityMaps_CheckBox)
+    HLayout.addWidget(self.MotionCorrection_CheckBox)
+    self.InputOutput_Layout.addRow(HLayout)
+
+  def setupFitRegionSelector(self):
+    """ Set up the selector of the segmentation or ROI that limits the pixels fitted """
+    self.FitRegion_Selector = slicer.qMRMLNodeComboBox()
+    self.FitRegion_Selector.nodeTypes = ['vtkMRMLSegmentationNode', 'vtkMRMLMarkupsROINode', 'vtkMRMLAnnotationROINode']
+    self.FitRegion_Selector.noneEnabled = True
+    self.FitRegion_Selector.addEnabled = False
+    self.FitRegion_Selector.removeEnabled = False
+    self.FitRegion_Selector.setMRMLScene(slicer.mrmlScene)
+    self.FitRegion_Selector.setToolTip("Fit only the pixels inside this segmentation or ROI, None fits the whole image")
+    self.InputOutput_Layout.addRow('Fit region', self.FitRegion_Selector)
+
+  def UpdateCacheLabel(self):
+    """ Show the statistics of the T1 Mapping cache """
+    Stats = T1_ECVMappingLogic.GetResultCache().Statistics()
+    self.CacheLabel.text = '{} maps, {:.1f} of {:.0f} MB, {} hits, {} misses'.format(Stats['Entries'], Stats['Bytes']/1024**2, Stats['MaxBytes']/1024**2, Stats['Hits'], Stats['Misses'])
+
+  def onClearCacheButton(self):
+    T1_ECVMappingLogic.GetResultCache().Clear()
+    self.UpdateCacheLabel()
+
+  def GetEngine(self):
+    """ Logic engine of the T1 estimation selected """
+    return {'Batched fit': 'Batched', 'Multiresolution fit': 'Multiresolution', 'Dictionary': 'Dictionary', 'Pixel by pixel fit': 'CurveFit'}[self.Engine_ComboBox.currentText]
+
+  def onEngineChanged(self):
+    """ Only the Batched engine runs in background """
+    self.Background_CheckBox.enabled = self.BackgroundAvailable() and self.GetEngine() == 'Batched'
+
   def setT1Button(self):
     """ Set up the apply button which create the T1 Mapping"""
     self.T1Button = qt.QPushButton("Create T1 Mapping")
@@ -171,6 +311,22 @@ class T1_ECVMappingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.T1Button.enabled = False
     self.InputOutput_Layout.addRow(self.T1Button)
      
+  def setupT1Progress(self):
+    """ Set up the progress bar and the cancel button of the background T1 Mapping """
+    self.T1ProgressBar = qt.QProgressBar()
+    self.T1CancelButton = qt.QPushButton("Cancel")
+    self.T1CancelButton.toolTip = "Abort the T1 Mapping without modifying the T1 volumes"
+    HLayout = qt.QHBoxLayout()
+    HLayout.addWidget(self.T1ProgressBar)
+    HLayout.addWidget(self.T1CancelButton)
+    self.InputOutput_Layout.addRow(HLayout)
+    self.T1ProgressBar.visible = False
+    self.T1CancelButton.visible = False
+    self.T1Jobs = []
+    self.StreamingCancelled = False
+    self.T1Timer = qt.QTimer()
+    self.T1Timer.setInterval(250)
+
   def setRefreshViewsAndCheckButtonButton(self):
     """ Set up the apply button which refresh the slicer views. It also create a check button to fix the scalar volumes"""
     self.RViewButton = qt.QPushButton("Refresh views")
@@ -240,6 +396,12 @@ class T1_ECVMappingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
   def setupConnections(self):
     """ Set up the connections of all the widgets created before """
     self.T1Button.connect('clicked(bool)', self.onApplyButton)
+    self.T1CancelButton.connect('clicked(bool)', self.onCancelT1Button)
+    self.Engine_ComboBox.connect('currentIndexChanged(int)', self.onEngineChanged)
+    self.addObserver(slicer.mrmlScene, slicer.mrmlScene.NodeRemovedEvent, self.onNodeRemoved)
+    self.addObserver(slicer.mrmlScene, slicer.mrmlScene.EndCloseEvent, self.onSceneEndClose)
+    self.ClearCacheButton.connect('clicked(bool)', self.onClearCacheButton)
+    self.T1Timer.connect('timeout()', self.onT1JobTimer)
     self.RViewButton.connect('clicked(bool)', self.onApplyRViewButton)
     self.CheckButton.connect('stateChanged(int)', self.onCheckbuttonChecked)
     self.LLE_Selector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelectLLENode)
@@ -265,9 +427,9 @@ class T1_ECVMappingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     self.NativeT1_Selector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelectNT1Node)
     self.EnhancedT1_Selector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelectET1Node)
-    self.SB_NBlodd.connect("valueChanged(Double)", self.onSpinBoxNBChanged)
-    self.SB_EBlodd.connect("valueChanged(Double)", self.onSpinBoxEBChanged)
-    self.SB_Haematocrit.connect("valueChanged(Double)", self.onSpinBoxHChanged)
+    self.SB_NBlodd.connect("valueChanged(double)", self.onSpinBoxNBChanged)
+    self.SB_EBlodd.connect("valueChanged(double)", self.onSpinBoxEBChanged)
+    self.SB_Haematocrit.connect("valueChanged(double)", self.onSpinBoxHChanged)
     self.ECVButton.connect('clicked(bool)',self.onApplyECVButton)
       
   
@@ -283,12 +445,17 @@ class T1_ECVMappingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
   def SetThreshold (self,VolumeNode, min, max):
     """ Set the minimum and maximum threshold values of a Node"""
     DisplayNode = VolumeNode.GetScalarVolumeDisplayNode()
+    if DisplayNode is None:
+      return
+    wasModifying = DisplayNode.StartModify() # A single Modified event for both changes
     DisplayNode.SetApplyThreshold(True)
     DisplayNode.SetThreshold(min,max)
+    DisplayNode.EndModify(wasModifying)
 
 
   def ColorBarEnabled(self):
     """ it Makes appear the scalar bar for the background volumes"""
+    import DataProbeLib
     sliceAnnotations = DataProbeLib.SliceAnnotations()
     sliceAnnotations.scalarBarEnabled = 1
     sliceAnnotations.updateSliceViewFromGUI()    
@@ -313,8 +480,7 @@ class T1_ECVMappingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       self.onCheckbuttonChecked()
       if self.T1_LLN_Node.GetImageData() == None:
         return
-      self.T1_LLN_Array = slicer.util.arrayFromVolume(self.T1_LLN_Node)
-      max = np.nanmax(self.T1_LLN_Array)
+      max = T1_ECVMappingLogic.GetNodeRange(self.T1_LLN_Node)['Max']
       self.updateThresholdValues(self.ThSlider_LLN, self.T1_LLN_Node, max)
       self.SetLayoutViewer(self.T1_LLN_Node, 'Green')    
     except:
@@ -342,8 +508,7 @@ class T1_ECVMappingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       self.onCheckbuttonChecked()
       if self.T1_LLE_Node.GetImageData() == None:
         return
-      self.T1_LLE_Array = slicer.util.arrayFromVolume(self.T1_LLE_Node)
-      max = np.nanmax(self.T1_LLE_Array)
+      max = T1_ECVMappingLogic.GetNodeRange(self.T1_LLE_Node)['Max']
       self.updateThresholdValues(self.ThSlider_LLE, self.T1_LLE_Node, max)
       self.SetLayoutViewer(self.T1_LLE_Node, 'Yellow')
     except:
@@ -364,6 +529,7 @@ class T1_ECVMappingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
   def SetLayoutViewer (self, Node, sliceViewName):
     """ Set the image of the Node in the view sliceViewName"""
+    self.PrepareScene()
     SliceCompositeName = 'vtkMRMLSliceCompositeNode' + sliceViewName
     slicerViewer = slicer.mrmlScene.GetNodeByID(SliceCompositeName)
     slicerViewer.SetForegroundVolumeID(None)
@@ -432,7 +598,9 @@ class T1_ECVMappingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
 
   def onApplyButton(self):
-    import time
+    if self.Background_CheckBox.isChecked() and self.GetEngine() == 'Batched':
+      self.StartBackgroundT1()
+      return
 
     self.T1Button.setText('Processing ...') 
     self.T1Button.enabled = False    
@@ -448,22 +616,128 @@ class T1_ECVMappingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.Warning = False
     self.onApplyRViewButton()
     self.LinkSlices()
+    T1_ECVMappingLogic.Profile.Reset()
     time_start = time.time()
-    logic_Native = T1_ECVMappingLogic('Native')
-    logic_Native.run(self.LLN_Node , self.T1_LLN_Node)
+    if not self.RunStreaming(self.CreateLogic('Native'), self.LLN_Node, self.T1_LLN_Node, 'Green', MinThresh = 100):
+      return
     self.SetScalarDisplay(self.T1_LLN_Node, MinThresh = 100)
     self.onSelectLLNNode()
-    logic_Enhanced = T1_ECVMappingLogic('Enhanced')
-    logic_Enhanced.run(self.LLE_Node , self.T1_LLE_Node)
+    if not self.RunStreaming(self.CreateLogic('Enhanced'), self.LLE_Node, self.T1_LLE_Node, 'Yellow'):
+      return
     self.SetScalarDisplay(self.T1_LLE_Node)
     self.onSelectLLENode()
-    print('Running Time = ',time.time()-time_start)
+    T1_ECVMappingLogic.ReportProfile(Action = 'T1 Mapping', Engine = self.GetEngine(), Model = self.Model_ComboBox.currentText, Total = time.time()-time_start)
+    self.UpdateCacheLabel()
     self.setupVolumeNodeViewLayout()
     self.Warning = True
 
 
+  def CreateLogic(self, Mode):
+    """ Logic of the Mode T1 Mapping with the engine, workers and options selected in the widget """
+    Logic = T1_ECVMappingLogic(Mode, self.GetEngine(), self.Workers_SpinBox.value)
+    Logic.useCache = self.Cache_CheckBox.isChecked()
+    Logic.lowMemory = self.LowMemory_CheckBox.isChecked()
+    Logic.qualityMaps = self.QualityMaps_CheckBox.isChecked()
+    Logic.motionCorrection = self.MotionCorrection_CheckBox.isChecked()
+    Logic.model = self.Model_ComboBox.currentText
+    Logic.roiNode = self.FitRegion_Selector.currentNode()
+    return Logic
+
+  def RunStreaming(self, Logic, LLNode, T1Node, ViewName, MinThresh = 10):
+    """ Fit the T1Node slice by slice, refreshing the view ViewName after every slice. It returns False if it was cancelled """
+    self.T1Button.enabled = False # The events are processed between slices
+    self.T1CancelButton.visible = True
+    self.StreamingCancelled = False
+    Slices = Logic.RunSlices(LLNode, T1Node)
+    try:
+      for Count, k in enumerate(Slices):
+        if Count == 0:
+          self.SetLayoutViewer(T1Node, ViewName)
+          self.SetScalarDisplay(T1Node, MinThresh)
+        slicer.app.processEvents()
+        if self.StreamingCancelled:
+          Slices.close()
+          return False
+    finally:
+      self.T1CancelButton.visible = False
+      self.T1Button.enabled = True
+    return True
+
+  def StartBackgroundT1(self):
+    """ Start the Native and Enhanced fits in the worker processes. onT1JobTimer follows them and writes the T1 nodes """
+    from T1_ECVMappingLib import ParallelFit
+    self.Warning = False
+    self.onApplyRViewButton()
+    self.LinkSlices()
+    self.T1Jobs = []
+    T1_ECVMappingLogic.Profile.Reset()
+    try:
+      for Mode, LLNode, T1Node in (('Native', self.LLN_Node, self.T1_LLN_Node), ('Enhanced', self.LLE_Node, self.T1_LLE_Node)):
+        if not LLNode:
+          continue
+        Logic = self.CreateLogic(Mode)
+        self.T1Jobs.append((Logic, Logic.StartRun(LLNode, Start = False), LLNode, T1Node))
+      ParallelFit.StartJobs([Job for _, Job, _, _ in self.T1Jobs])
+    except Exception as e:
+      self.onCancelT1Button()
+      slicer.util.errorDisplay('The T1 Mapping could not be started: '+str(e))
+      return
+    self.T1StartTime = time.time()
+    self.T1Button.setText('Processing ...')
+    self.T1Button.enabled = False
+    self.T1ProgressBar.setRange(0, max(sum(Job.TotalPixels for _, Job, _, _ in self.T1Jobs), 1))
+    self.T1ProgressBar.value = 0
+    self.T1ProgressBar.visible = True
+    self.T1CancelButton.visible = True
+    self.T1Timer.start()
+
+  def onT1JobTimer(self):
+    """ Update the progress of the background T1 Mapping and write the nodes when every fit is done """
+    Fitted = sum(Job.FittedPixels() for _, Job, _, _ in self.T1Jobs)
+    Rate = Fitted/max(time.time()-self.T1StartTime, 1e-3)
+    self.T1ProgressBar.value = Fitted
+    self.T1ProgressBar.setFormat('%p%  ({:.0f} pixels/s)'.format(Rate))
+    if not all(Job.IsDone() for _, Job, _, _ in self.T1Jobs):
+      return
+    self.T1Timer.stop()
+    try:
+      for Logic, Job, LLNode, T1Node in self.T1Jobs:
+        Logic.FinishRun(Job, LLNode, T1Node)
+    except Exception as e:
+      self.onCancelT1Button()
+      slicer.util.errorDisplay('The T1 Mapping failed: '+str(e))
+      return
+    T1_ECVMappingLogic.ReportProfile(Action = 'T1 Mapping', Engine = 'Batched', Total = time.time()-self.T1StartTime)
+    self.UpdateCacheLabel()
+    self.T1Jobs = []
+    self.ResetT1Progress()
+    if self.LLN_Node:
+      self.SetScalarDisplay(self.T1_LLN_Node, MinThresh = 100)
+      self.onSelectLLNNode()
+    if self.LLE_Node:
+      self.SetScalarDisplay(self.T1_LLE_Node)
+      self.onSelectLLENode()
+    self.setupVolumeNodeViewLayout()
+    self.Warning = True
+
+  def onCancelT1Button(self):
+    """ Abort the background or the streaming T1 Mapping, leaving the T1 nodes untouched """
+    self.StreamingCancelled = True
+    self.T1Timer.stop()
+    for _, Job, _, _ in self.T1Jobs:
+      Job.Cancel()
+    self.T1Jobs = []
+    self.ResetT1Progress()
+    self.Warning = True
+
+  def ResetT1Progress(self):
+    self.T1ProgressBar.visible = False
+    self.T1CancelButton.visible = False
+    self.T1Button.setText('Create T1 Mapping')
+    self.T1Button.enabled = bool(self.LLE_Selector.currentNode() or self.LLN_Selector.currentNode())
+
   def onApplyRViewButton(self):
-  
+    self.PrepareScene()
     self.SetLayoutViewer(self.ArefNode,'Red')
     self.SetLayoutViewer(self.T1_LLN_Node,'Green')
     self.SetLayoutViewer(self.T1_LLE_Node,'Yellow') 
@@ -548,16 +822,35 @@ class T1_ECVMappingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
   def onSpinBoxNBChanged(self, Value):
     self.SB_NBlodd.value = Value
+    self.UpdateECVMap()
 
   def onSpinBoxEBChanged(self, Value):
     self.SB_EBlodd.value = Value
+    self.UpdateECVMap()
 
   def onSpinBoxHChanged(self, Value):
     self.SB_Haematocrit.value = Value
+    self.UpdateECVMap()
+
+  def UpdateECVMap(self):
+    """ Update in place the ECV map created by Apply with the current Haematocrit and blood T1, if its T1 maps didn't change """
+    if self.ECVMapNode is None or self.ECVEngine.Difference is None or slicer.mrmlScene.GetNodeByID(self.ECVMapNode.GetID()) is None:
+      return
+    T1Native_Node = self.NativeT1_Selector.currentNode()
+    T1Enhanced_Node = self.EnhancedT1_Selector.currentNode()
+    if not T1Native_Node or not T1Enhanced_Node or self.SB_NBlodd.value == self.SB_EBlodd.value:
+      return
+    if self.ECVEngine.Key != T1_ECVMappingLogic().ECVInputKey(T1Native_Node, T1Enhanced_Node, self.ECVMapNode):
+      return
+    ECV_Matrix = slicer.util.arrayFromVolume(self.ECVMapNode)
+    if ECV_Matrix.shape != self.ECVEngine.Difference.shape or ECV_Matrix.dtype != self.ECVEngine.Difference.dtype:
+      return
+    self.ECVEngine.Compute(self.SB_Haematocrit.value, self.SB_NBlodd.value, self.SB_EBlodd.value, Out=ECV_Matrix)
+    slicer.util.arrayFromVolumeModified(self.ECVMapNode)
 
   def onApplyECVButton(self):
     """ Create and configurate the ECV map """
-
+    T1_ECVMappingLogic.Profile.Reset()
     NodeName = 'ECV Map'
     try :
       self.ECVMapNode = slicer.util.getNode(NodeName)
@@ -565,101 +858,51 @@ class T1_ECVMappingWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', NodeName)
     self.ECVMapNode = slicer.util.getNode(NodeName)
 
-    T1Native_Matrix,T1Enhanced_Matrix = self.MatchMatrixs(self.NativeT1_Selector.currentNode(),self.EnhancedT1_Selector.currentNode())
+    T1Native_Node = self.NativeT1_Selector.currentNode()
+    T1Enhanced_Node = self.EnhancedT1_Selector.currentNode()
+    Key = T1_ECVMappingLogic().ECVInputKey(T1Native_Node, T1Enhanced_Node, self.ECVMapNode)
+    dtype = np.float32 if self.LowMemory_CheckBox.isChecked() else float
+    if self.ECVEngine.dtype != dtype:
+      self.ECVEngine = ECV.ECVEngine(dtype)
+    if Key != self.ECVEngine.Key: # The difference map is only computed again when the T1 maps change
+      T1Native_Matrix,T1Enhanced_Matrix = self.MatchMatrixs(T1Native_Node, T1Enhanced_Node)
+      self.ECVEngine.SetInputs(T1Native_Matrix, T1Enhanced_Matrix, Key)
 
     Haematocrit = self.SB_Haematocrit.value
     NT1B = self.SB_NBlodd.value
     ET1B = self.SB_EBlodd.value
-    Factor = (100-Haematocrit)*(NT1B*ET1B/(NT1B-ET1B))
-    epsilon = 0.1
-
-    T1Enhanced_Matrix = T1Enhanced_Matrix + epsilon
-    T1Native_Matrix = T1Native_Matrix + epsilon
-    self.ECV_Matrix = (1/T1Enhanced_Matrix-1/T1Native_Matrix)*Factor
-    self.ECV_Matrix = np.nan_to_num(self.ECV_Matrix)
-    self.ECV_Matrix[ np.logical_or(self.ECV_Matrix<0 , self.ECV_Matrix>100) ] = 0
-
-    slicer.util.updateVolumeFromArray(self.ECVMapNode, self.ECV_Matrix)
+    with T1_ECVMappingLogic.Profile.Stage('ECV'):
+      if self.LowMemory_CheckBox.isChecked(): # Computed directly in the image of the ECV Map
+        Buffer = T1_ECVMappingLogic().GetNodeBuffer(self.ECVMapNode, self.ECVEngine.Difference.shape, dtype)
+        self.ECV_Matrix = self.ECVEngine.Compute(Haematocrit, NT1B, ET1B, Out=Buffer)
+        slicer.util.arrayFromVolumeModified(self.ECVMapNode)
+      else:
+        self.ECV_Matrix = self.ECVEngine.Compute(Haematocrit, NT1B, ET1B)
+        slicer.util.updateVolumeFromArray(self.ECVMapNode, self.ECV_Matrix)
     self.SetLayoutViewer(self.ECVMapNode, 'Slice4')
     self.SetScalarDisplay(self.ECVMapNode, 1, 100) ## Que onda el Auto WL
     self.ThSlider_ECV.SetNode(self.ECVMapNode)
-    Max = np.nanmax(self.ECV_Matrix)
+    Max = T1_ECVMappingLogic.StoreNodeRange(self.ECVMapNode, self.ECV_Matrix)['Max']
     self.updateThresholdValues(self.ThSlider_ECV, self.ECVMapNode, Max)
+    T1_ECVMappingLogic.ReportProfile(Action = 'ECV Map')
 
 
 
   def MatchMatrixs (self,Node1,Node2):
     """ This tries to match the T1 Native and Enhanced image matrix if they haven't the same number of pixels"""
-
-    T1Native_Node = Node1
-    T1Native_Matrix = slicer.util.arrayFromVolume(T1Native_Node)
-    DimN = T1Native_Matrix.shape
-    T1Enhanced_Node = Node2
-    T1Enhanced_Matrix = slicer.util.arrayFromVolume(T1Enhanced_Node)
-    DimE = T1Enhanced_Matrix.shape
-
-    NMatrix = self.GetIJKToRASnpArray(T1Native_Node)
-    NVector = NMatrix[:-1,-1]
-    EMatrix = self.GetIJKToRASnpArray(T1Enhanced_Node)
-    EVector = EMatrix[:-1,-1]
-    NPixelSize = [np.linalg.norm(NMatrix[:-1,0]), np.linalg.norm(NMatrix[:-1,1])]
-    EPixelSize = [np.linalg.norm(EMatrix[:-1,0]), np.linalg.norm(EMatrix[:-1,1])]
-
-    Niversor = NMatrix[:-1,0]/NPixelSize[0]
-    Njversor = NMatrix[:-1,1]/NPixelSize[1]
-    Nkversor = np.round(np.cross(Niversor,Njversor),3)
-    Nkstep = round(np.linalg.norm(NMatrix[:-1,2]),3)
-
-    Eiversor = EMatrix[:-1,0]/EPixelSize[0]
-    Ejversor = EMatrix[:-1,1]/EPixelSize[1]
-    Ekversor = np.round(np.cross(Eiversor,Ejversor),3)
-    Ekstep = round(np.linalg.norm(EMatrix[:-1,2]),3)
-    print(Nkversor,Ekversor,Nkstep,Ekstep,NVector,EVector,(NVector-EVector).dot(Ekversor))
-    if not ( np.sum(Nkversor==Ekversor) == 3 and Nkstep==Ekstep and ((NVector-EVector).dot(Ekversor)) == 0 ): # it verifies if the slices are oriented in the same direction, with the same step between slices and if the first images are complanar.
+    Logic = T1_ECVMappingLogic()
+    Matrixs = Logic.MatchMatrixs(Node1, Node2, self.ECVMapNode)
+    if not Logic.GeometryMatches:
       slicer.util.warningDisplay('The geometry of the LL Native and LL Enhanced volume doesn\'t match. It could deteriorate the ECV map', windowTitle= 'Warning')
-
-    if (DimE == DimN):
-      T1_ECVMappingLogic.setupNodeFromNode(self,self.ECVMapNode , self.NativeT1_Selector.currentNode()) 
-      return [T1Native_Matrix,T1Enhanced_Matrix]
-    if (DimE[1:3] == DimN[1:3]):
-      k = min([DimE[1],DimN[1]])
-      T1_ECVMappingLogic.setupNodeFromNode(self,self.ECVMapNode , self.NativeT1_Selector.currentNode())
-      return [T1Native_Matrix[:k,:,:],T1Enhanced_Matrix[:k,:,:]]
-
-    jN = np.arange(0,DimN[2]*NPixelSize[1],NPixelSize[1])+NPixelSize[1]/2+(NVector-EVector).dot(Njversor)
-    iN = np.arange(0,DimN[1]*NPixelSize[0],NPixelSize[0])+NPixelSize[0]/2+(NVector-EVector).dot(Niversor)
-    iE = np.arange(0,DimE[1]*EPixelSize[0],EPixelSize[0])+EPixelSize[0]/2
-    jE = np.arange(0,DimE[2]*EPixelSize[1],EPixelSize[1])+EPixelSize[1]/2 
-    if DimE[1] > DimN[1]:  ## I concidered a square image
-      T1Nreshaped = np.zeros(DimE)
-      for k in range(DimN[0]):
-        f = interpolate.interp2d(iN, jN, np.nan_to_num(T1Native_Matrix[k,:,:]), fill_value = 0)
-        T1Nreshaped[k,:,:] = f(iE, jE)
-      T1Ereshaped = T1Enhanced_Matrix[:k+1,:,:]
-      T1_ECVMappingLogic.setupNodeFromNode(self,self.ECVMapNode , self.EnhancedT1_Selector.currentNode())
-      return [T1Nreshaped,T1Ereshaped]
-    else:
-      T1Ereshaped = np.zeros(DimN)
-      for k in range(DimE[0]):
-        f = interpolate.interp2d(iE, jE, np.nan_to_num(T1Enhanced_Matrix[k,:,:]), fill_value = 0)
-        T1Ereshaped[k,:,:] = f(iN, jN)     
-      T1Nreshaped = T1Native_Matrix[:k+1,:,:]
-      T1_ECVMappingLogic.setupNodeFromNode(self,self.ECVMapNode , self.NativeT1_Selector.currentNode()) 
-      return [T1Nreshaped,T1Ereshaped]
-      
-
-  def GetIJKToRASnpArray (self,Node):
-    VtkMatrix = vtk.vtkMatrix4x4()
-    Node.GetIJKToRASMatrix(VtkMatrix)
-    M = np.zeros((4,4))
-    for i in range (4):
-      for j in range (4):
-        M[i,j] = VtkMatrix.GetElement(i,j)
-    return M
+    return Matrixs
 
 
 class DoubleSlider():
-  """ This class creates and links a Double slider widget with two Spin Box """
+  """ Double slider linked with two Spin Boxes, its threshold changes are applied by a shared timer at most once per FrameInterval """
+
+  FrameInterval = 33 # ms
+  Pending = {} # Last thresholds requested by every slider, (VolumeNode, min, max)
+  Timer = None
 
   def __init__ (self, Display_Layout, function):
     self.function = function
@@ -704,21 +947,54 @@ class DoubleSlider():
     if self.VolumeNode is None:
       return    
     self.UpdateSpinBox (SliderMin,SliderMax)
-    self.function(self.VolumeNode,SliderMin, SliderMax)
+    self.RequestUpdate(SliderMin, SliderMax)
 
   def onSpinBoxLChanged(self, Value):
     if self.VolumeNode is None:
       return 
     self.Slider.minimumValue = Value
     self.SpinBoxR.minimum = Value
-    self.function(self.VolumeNode,Value,self.SpinBoxR.value)
+    self.RequestUpdate(Value, self.SpinBoxR.value)
     
   def onSpinBoxRChanged(self, Value):
     if self.VolumeNode is None:
       return 
     self.Slider.maximumValue = Value
     self.SpinBoxL.maximum = Value
-    self.function(self.VolumeNode,self.SpinBoxL.value,Value)
+    self.RequestUpdate(self.SpinBoxL.value, Value)
+
+  def RequestUpdate(self, min, max):
+    """ Apply the thresholds in the next update of the shared timer, replacing the ones requested before by this slider """
+    DoubleSlider.Pending[self] = (self.VolumeNode, min, max)
+    if DoubleSlider.Timer is None:
+      DoubleSlider.Timer = qt.QTimer()
+      DoubleSlider.Timer.singleShot = True
+      DoubleSlider.Timer.interval = DoubleSlider.FrameInterval
+      DoubleSlider.Timer.connect('timeout()', DoubleSlider.FlushUpdates)
+    if not DoubleSlider.Timer.active:
+      DoubleSlider.Timer.start()
+
+  @staticmethod
+  def FlushUpdates():
+    """ Apply the pending thresholds of all the sliders with the rendering paused, so the views are rendered once """
+    Pending = DoubleSlider.Pending
+    DoubleSlider.Pending = {}
+    PauseRender = hasattr(slicer.app, 'pauseRender')
+    if PauseRender:
+      slicer.app.pauseRender()
+    try:
+      for Slider, (VolumeNode, min, max) in Pending.items():
+        if VolumeNode is not None:
+          Slider.function(VolumeNode, min, max)
+    finally:
+      if PauseRender:
+        slicer.app.resumeRender()
+
+  @staticmethod
+  def CancelUpdates():
+    if DoubleSlider.Timer is not None:
+      DoubleSlider.Timer.stop()
+    DoubleSlider.Pending = {}
 
   def SetWindowLabel(self, min, max):
     DisplayNode = self.VolumeNode.GetScalarVolumeDisplayNode()
@@ -787,26 +1063,13 @@ class statistics():
     self.SButton.enabled = (self.scalarSelector2.currentNode() and self.segmentationSelector.currentNode()) or (self.scalarSelector.currentNode() and self.segmentationSelector.currentNode())
 
   def onApplySButton(self):
-    """ This function takes advantage of the functions of the Segment Statistics module to assess the statistics of the segmentation"""
-    self.stats = {}
-    self.NofV = 1
-    self.logic = SegmentStatistics.SegmentStatisticsLogic()
-    self.parameterNode = self.logic.getParameterNode()
-    self.parameterNode.SetParameter("Segmentation", self.segmentationSelector.currentNode().GetID())
-    self.parameterNode.SetParameter('ClosedSurfaceSegmentStatisticsPlugin.enabled','False')
-    self.parameterNode.SetParameter('LabelmapSegmentStatisticsPlugin.enabled','True')
-    self.parameterNode.SetParameter('LabelmapSegmentStatisticsPlugin.volume_cm3.enabled','False')
-    self.parameterNode.SetParameter('LabelmapSegmentStatisticsPlugin.volume_mm3.enabled','False')
-    self.parameterNode.SetParameter('LabelmapSegmentStatisticsPlugin.voxel_count.enabled','False')
-    self.parameterNode.SetParameter('LabelmapSegmentStatisticsPlugin.surface_area_mm2.enabled','True')
-
-    if self.scalarSelector.currentNode():
-      self.parameterNode.SetParameter("ScalarVolume", self.scalarSelector.currentNode().GetID())
-      self.GetStats(self.scalarSelector.currentNode())
-
-    if self.scalarSelector2.currentNode():
-      self.parameterNode.SetParameter("ScalarVolume", self.scalarSelector2.currentNode().GetID())
-      self.GetStats(self.scalarSelector2.currentNode())
+    """ Assess the statistics of the segmentation in the scalar volumes selected, rasterizing every segment once """
+    Volumes = [Node for Node in (self.scalarSelector.currentNode(), self.scalarSelector2.currentNode()) if Node]
+    self.NofV = len(Volumes)
+    T1_ECVMappingLogic.Profile.Reset()
+    self.stats, SegmentIDs = T1_ECVMappingLogic().GetSegmentStatistics(self.segmentationSelector.currentNode(), Volumes)
+    T1_ECVMappingLogic.ReportProfile(Action = 'Statistics')
+    self.statistics = {'SegmentIDs': SegmentIDs}
 
     try:
       self.ROImean = np.array(self.stats['Mean'])
@@ -815,38 +1078,10 @@ class statistics():
 
     self.PopulateTableStats()
 
-
-  def GetStats(self,Node):
-    self.logic.computeStatistics()
-    keys = self.logic.getNonEmptyKeys()
-    longname, names = self.logic.getHeaderNames(keys)
-    self.statistics = self.logic.getStatistics()
-    Stats = {}
-    for key in keys:
-      measurements = [self.statistics[segmentID, key] for segmentID in self.statistics["SegmentIDs"] if
-                      (segmentID, key) in self.statistics] 
-      Stats[names[key]] = measurements
-
-    if 'Mean [1]' in Stats.keys():
-      Stats['Minimum'] = Stats.pop('Minimum [1]')
-      Stats['Maximum'] = Stats.pop('Maximum [1]')
-      Stats['Mean'] = Stats.pop('Mean [1]')
-      Stats['Median'] = Stats.pop('Median [1]')
-      Stats['Standard Deviation'] = Stats.pop('Standard Deviation [1]')
-
-    Stats['Scalar Volume'] = [Node.GetName()]*len(Stats['Segment'])
-
-    if not bool(self.stats):
-      self.stats = Stats
-    else:
-      for k in self.stats.keys():
-        self.stats[k].extend(Stats[k])
-        self.NofV = 2
-
   def PopulateTableStats(self):
     """ Creates the Qt table with the statistics"""
 
-    NewOrderKeys = ['Segment','Scalar Volume','Mean','Standard Deviation', 'Minimum','Maximum', 'Median','Number of voxels [voxels]','Surface area [mm2]','Volume [mm3]','Volume [mm3]' ]
+    NewOrderKeys = ['Segment','Scalar Volume','Mean','Standard Deviation', 'Minimum','Maximum', 'Median','Number of voxels [voxels]','Surface area [mm2]','Volume [mm3]' ]
     self.items = []
     self.model = qt.QStandardItemModel()
     self.table.setModel(self.model)
@@ -895,67 +1130,290 @@ class statistics():
 
 class T1_ECVMappingLogic(ScriptedLoadableModuleLogic):
 
-  def __init__ (self, mode):
+  T1Seeds = BatchFit.T1Seeds
+  T1Min = 40
+  T1Max = 3000
+  CacheVersion = 2 # Increase it when a change of the fit modifies the results, to invalidate the cached maps
+  Cache = None
+  SegmentCache = collections.OrderedDict() # Rasterized segments of the last segmentation nodes, until they are modified
+  SegmentCacheSize = 8
+  RangeCache = {} # Range and histogram of the image of every volume node, until the image is modified
+  RegionStates = collections.OrderedDict() # Maps fitted inside a fit region, with the pixels already fitted
+  RegionStatesSize = 4
+  HistogramBins = 64
+  Profile = Instrumentation.Recorder() # Times of the stages and counters of the fits of all the logic instances
+  ProfileLog = os.environ.get('T1_ECVMAPPING_PROFILE_LOG') # JSON log where ReportProfile appends every report
+
+  def __init__ (self, mode = None, engine = 'Batched', workers = 1, refine = True):
+    """ mode is 'Native' or 'Enhanced', engine 'Batched', 'Multiresolution', 'Dictionary' or 'CurveFit', and workers the processes of the batched fit """
     self.mode = mode
-
+    self.engine = engine
+    self.workers = workers
+    self.refine = refine
+    self.useCache = True
+    self.interpolation = 'linear' # 'linear' or 'nearest', used to resample the T1 Mappings when their grids differ
+    self.lowMemory = False # Keep the maps in float32, write them in the images of the nodes and report the peak Python allocations
+    self.qualityMaps = False # Create the T1 SD, RMS, R2 and iterations maps of the fit next to the T1 Mapping
+    self.motionCorrection = False # Align the frames of every slice before the fit
+    self.model = Models.Default # Name of the signal model of Models.Registry fitted by the Batched and Multiresolution engines
+    self.MotionShifts = None
+    self.roiNode = None # Segmentation or ROI node: only the pixels inside it are fitted
+    self.RegionState = None
+    self.PeakMemory = None # Peak Python allocations (bytes) of the last fit in the low memory mode, in this process only
+
+  @Profile.Timed('Metadata')
   def getMultiVolumeLabels(self,volumeNode):
-    """ Get the Trigger time of the volumeNode"""
+    """ Get the Trigger time of the volumeNode, from its DICOM instances when the frame labels are missing or rounded """
 
     frameLabels = volumeNode.GetAttribute('MultiVolume.FrameLabels')
     nFrames = volumeNode.GetNumberOfFrames()
-    mvLabels = [0,]*nFrames
+    mvLabels = None
     if frameLabels:
       mvLabels = frameLabels.split(',')
       if len(mvLabels) == nFrames:
         for l in range(nFrames):
           mvLabels[l] = float(mvLabels[l])
-    else:
-      for l in range(nFrames):
-        mvLabels[l] = float(l)
+    instanceUIDs = volumeNode.GetAttribute('DICOM.instanceUIDs')
+    if instanceUIDs and slicer.dicomDatabase and (mvLabels is None or len(mvLabels) == nFrames):
+      instanceUIDs = instanceUIDs.split()
+      paths = [slicer.dicomDatabase.fileForInstance(uid) for uid in instanceUIDs]
+      if all(paths):
+        mvLabels = DicomMetadata.RefineFrameLabels(mvLabels, paths, nFrames, InstanceUIDs = instanceUIDs)
+    if mvLabels is None:
+      mvLabels = [float(l) for l in range(nFrames)]
     return mvLabels
 
 
   def Signal(self,x,A,B,Ts,c):
       return np.abs(A-B*np.exp(-x/Ts))+c
 
+  def SignalJacobian(self,x,A,B,Ts,c):
+      return BatchFit.SignalJacobian(np.asarray(x, dtype=float), np.array([[A,B,Ts,c]], dtype=float))[0]
+
   def TsToT1 (self,A,B,Ts):
       return Ts*(B/A-1)
 
-  def SigmaT1(self,A,B,Ts,DeltaT,cov):  ## It is the error of T1 taking into account that Signal is np.abs(A-B*np.exp(-(TrgTime+DeltaT)/Ts)) 
-      dT1_dTs = B*np.exp(DeltaT/Ts)/A*(1-DeltaT/Ts)
-      dT1_dB = Ts*np.exp(DeltaT/Ts)/A
-      dT1_dA = -Ts*np.exp(DeltaT/Ts)*B/A**2
-      return np.sqrt(np.abs(dT1_dA**2*cov[0,0]+dT1_dB**2*cov[1,1]+dT1_dTs**2*cov[2,2]+2*dT1_dA*dT1_dB*cov[0,1]+2*dT1_dA*dT1_dTs*cov[0,2]+2*dT1_dTs*dT1_dB*cov[1,2]+cov[2,2]))
-
+  @Profile.Timed('Metadata')
   def GetDicomFromNode(self,node):
-    """ Get Dicom Tags from a MRML node """
+    """ Get the timing Dicom Tags (InversionTime, TriggerTime) of a MRML node, reading and caching only the header of the file """
     storageNode=node.GetStorageNode()
+    instanceUID=None
     if storageNode is not None: # loaded via drag-drop
         filepath=storageNode.GetFullNameFromFileName()
     else: # loaded via DICOM browser
-        instanceUIDs=node.GetAttribute('DICOM.instanceUIDs').split()
-        filepath=slicer.dicomDatabase.fileForInstance(instanceUIDs[0])
-    Dcm_tag=pydicom.dcmread(filepath)
+        instanceUID=node.GetAttribute('DICOM.instanceUIDs').split()[0]
+        filepath=slicer.dicomDatabase.fileForInstance(instanceUID)
+    Dcm_tag=DicomMetadata.ReadTags(filepath, InstanceUID = instanceUID)
     return Dcm_tag
 
-  def FilterNoneValues(self, Matrix, dim, Value = False):
-    """ Replace the None values of the T1 Mapping with the median value of the neighbors of the None pixels """
+  @Profile.Timed('FilterNoneValues')
+  def FilterNoneValues(self, Matrix, dim, Value = None, Out = None):
+    """ Replace the None values of the T1 Mapping with the dim x dim median of their neighbors, or with Value, in Out if it is given """
+    if Out is None:
+      Out = np.array(Matrix, dtype=float)
+    elif Out is not Matrix:
+      np.copyto(Out, Matrix, casting='unsafe')
+    K,I,J = np.nonzero(np.isnan(Matrix))
+    if Value is not None:
+      Out[K,I,J] = Value
+      return Out
     kmax,imax,jmax = Matrix.shape
     Neighbor = dim//2
-    for k in range (kmax):
-      I,J = np.where(np.isnan(Matrix[k, :, :])) # change the shape of image in order to not have problems with the borders
-      Conditional=np.logical_and(np.logical_and(imax-Neighbor>I, Neighbor<=I), np.logical_and(jmax-Neighbor>J, Neighbor <=J))
-      I= I[Conditional]
-      J= J[Conditional]
-      Matrix_Filtered = np.copy(Matrix)
-      for i in range (len(I)):
-          M = Matrix[k,I[i]-Neighbor:I[i]+Neighbor+1,J[i]-Neighbor:J[i]+Neighbor+1]
-          M=M[np.invert(np.isnan(M))]
-          if len(M)>0 and Value==False:
-              Matrix_Filtered[k,I[i],J[i]]=np.median(M)
-          else :
-              Matrix_Filtered[k,I[i],J[i]] = Value     
-    return Matrix_Filtered
+    Offsets = np.arange(-Neighbor, Neighbor+1)
+    Block = 65536 # None pixels filtered together, it bounds the memory used by the windows
+    Medians = np.zeros(len(K))
+    for Start in range(0, len(K), Block):
+      k = K[Start:Start+Block,None,None]
+      i = I[Start:Start+Block,None,None]+Offsets[None,:,None]
+      j = J[Start:Start+Block,None,None]+Offsets[None,None,:]
+      Inside = (i>=0) & (i<imax) & (j>=0) & (j<jmax)
+      # The windows are read from Matrix, so the values filled in this call don't affect the other None pixels
+      Windows = np.where(Inside, Matrix[k, np.clip(i,0,imax-1), np.clip(j,0,jmax-1)], np.nan).reshape(len(k),-1)
+      with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # All-NaN windows
+        Medians[Start:Start+Block] = np.nan_to_num(np.nanmedian(Windows, axis=1))
+    Out[K,I,J] = Medians # Written at the end, so Out can be Matrix
+    return Out
+
+  @Profile.Timed('MatchMatrixs')
+  def MatchMatrixs (self,Node1,Node2,ECVMapNode):
+    """ Resample the T1 Native or Enhanced matrix with fewer pixels on the grid of the other one, and set the geometry of the ECVMapNode """
+
+    T1Native_Node = Node1
+    T1Native_Matrix = slicer.util.arrayFromVolume(T1Native_Node)
+    DimN = T1Native_Matrix.shape
+    T1Enhanced_Node = Node2
+    T1Enhanced_Matrix = slicer.util.arrayFromVolume(T1Enhanced_Node)
+    DimE = T1Enhanced_Matrix.shape
+
+    NMatrix = self.GetIJKToRASnpArray(T1Native_Node)
+    NVector = NMatrix[:-1,-1]
+    EMatrix = self.GetIJKToRASnpArray(T1Enhanced_Node)
+    EVector = EMatrix[:-1,-1]
+    NPixelSize = [np.linalg.norm(NMatrix[:-1,0]), np.linalg.norm(NMatrix[:-1,1])]
+    EPixelSize = [np.linalg.norm(EMatrix[:-1,0]), np.linalg.norm(EMatrix[:-1,1])]
+
+    Niversor = NMatrix[:-1,0]/NPixelSize[0]
+    Njversor = NMatrix[:-1,1]/NPixelSize[1]
+    Nkversor = np.round(np.cross(Niversor,Njversor),3)
+    Nkstep = round(np.linalg.norm(NMatrix[:-1,2]),3)
+
+    Eiversor = EMatrix[:-1,0]/EPixelSize[0]
+    Ejversor = EMatrix[:-1,1]/EPixelSize[1]
+    Ekversor = np.round(np.cross(Eiversor,Ejversor),3)
+    Ekstep = round(np.linalg.norm(EMatrix[:-1,2]),3)
+    # it verifies if the slices are oriented in the same direction, with the same step between slices and if the first images are complanar.
+    self.GeometryMatches = np.sum(Nkversor==Ekversor) == 3 and Nkstep==Ekstep and ((NVector-EVector).dot(Ekversor)) == 0
+    if not self.GeometryMatches:
+      logging.warning('The geometry of the LL Native and LL Enhanced volume doesn\'t match: {} {} {} {} {} {}'.format(Nkversor,Ekversor,Nkstep,Ekstep,NVector,EVector))
+
+    if DimE == DimN and np.allclose(NMatrix, EMatrix):
+      self.setupNodeFromNode(ECVMapNode, T1Native_Node) 
+      return [T1Native_Matrix,T1Enhanced_Matrix]
+
+    # The volume with fewer pixels per slice is resampled on the grid of the other one, and the slices of the grid
+    # after the last one with resampled voxels are removed
+    if DimE[1]*DimE[2] > DimN[1]*DimN[2]:
+      T1Nreshaped, Inside = Resample.ResampleVolume(np.nan_to_num(T1Native_Matrix), NMatrix, EMatrix, DimE, self.interpolation)
+      T1Ereshaped = T1Enhanced_Matrix
+      self.setupNodeFromNode(ECVMapNode, T1Enhanced_Node)
+    else:
+      T1Ereshaped, Inside = Resample.ResampleVolume(np.nan_to_num(T1Enhanced_Matrix), EMatrix, NMatrix, DimN, self.interpolation)
+      T1Nreshaped = T1Native_Matrix
+      self.setupNodeFromNode(ECVMapNode, T1Native_Node)
+    k = np.flatnonzero(Inside.any(axis=(1,2)))
+    k = k[-1]+1 if len(k) else 0
+    return [T1Nreshaped[:k,:,:],T1Ereshaped[:k,:,:]]
+
+  def GetIJKToRASnpArray (self,Node):
+    VtkMatrix = vtk.vtkMatrix4x4()
+    Node.GetIJKToRASMatrix(VtkMatrix)
+    M = np.zeros((4,4))
+    for i in range (4):
+      for j in range (4):
+        M[i,j] = VtkMatrix.GetElement(i,j)
+    return M
+
+  @Profile.Timed('Segment indices')
+  def GetSegmentIndices(self, SegmentationNode, ReferenceNode):
+    """ Segment IDs, flat voxel indices and surface area (mm2) of every segment on the grid of the ReferenceNode, cached """
+    Segmentation = SegmentationNode.GetSegmentation()
+    SegmentationID = (SegmentationNode.GetID(), Segmentation.GetAddressAsString('vtkSegmentation')) # The IDs are reused when the scene is cleared
+    if SegmentationID in self.SegmentCache:
+      self.SegmentCache.move_to_end(SegmentationID)
+    else:
+      Entry = self.SegmentCache[SegmentationID] = {'Segmentation': Segmentation, 'Tags': [], 'Grids': {}}
+      Events = ['SegmentAdded', 'SegmentRemoved', 'SegmentModified', 'RepresentationModified', 'SourceRepresentationModified', 'MasterRepresentationModified']
+      for Event in Events:
+        if hasattr(slicer.vtkSegmentation, Event):
+          Entry['Tags'].append(Segmentation.AddObserver(getattr(slicer.vtkSegmentation, Event), lambda Caller, Event, Grids = Entry['Grids']: Grids.clear()))
+      while len(self.SegmentCache) > self.SegmentCacheSize:
+        self.RemoveSegmentCache(next(iter(self.SegmentCache)))
+    Cache = self.SegmentCache[SegmentationID]['Grids']
+    Key = (ReferenceNode.GetImageData().GetDimensions(), self.GetIJKToRASnpArray(ReferenceNode).tobytes())
+    if Key in Cache:
+      return Cache[Key]
+
+    SegmentIDs = [Segmentation.GetNthSegmentID(n) for n in range(Segmentation.GetNumberOfSegments())]
+    Indices = []
+    Areas = []
+    Labelmap = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+    try:
+      for SegmentID in SegmentIDs:
+        Ids = vtk.vtkStringArray()
+        Ids.InsertNextValue(SegmentID)
+        slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(SegmentationNode, Ids, Labelmap, ReferenceNode)
+        Mask = slicer.util.arrayFromVolume(Labelmap) > 0
+        Indices.append(np.flatnonzero(Mask))
+        Areas.append(self.SurfaceArea(Mask, ReferenceNode.GetSpacing()))
+    finally:
+      slicer.mrmlScene.RemoveNode(Labelmap)
+    Cache[Key] = (SegmentIDs, Indices, Areas)
+    return Cache[Key]
+
+  @classmethod
+  def RemoveSegmentCache(cls, SegmentationID):
+    """ Forget the rasterized segments of the SegmentationID key of SegmentCache and stop observing its segmentation """
+    Entry = cls.SegmentCache.pop(SegmentationID)
+    for Tag in Entry['Tags']:
+      Entry['Segmentation'].RemoveObserver(Tag)
+
+  @classmethod
+  def ClearSegmentCache(cls, SegmentationNode = None):
+    """ Remove the rasterized segments of the SegmentationNode from SegmentCache, or all of them if it is None """
+    for SegmentationID in list(cls.SegmentCache):
+      if SegmentationNode is None or SegmentationID[0] == SegmentationNode.GetID():
+        cls.RemoveSegmentCache(SegmentationID)
+
+  def SurfaceArea(self, Mask, Spacing):
+    """ Area (mm2) of the surface of the voxels of Mask, with the discrete flying edges of the Labelmap Segment Statistics """
+    if not Mask.any():
+      return 0.0
+    import vtk.util.numpy_support
+    Padded = np.pad(Mask.astype(np.uint8), 1)
+    Image = vtk.vtkImageData()
+    Image.SetDimensions(Padded.shape[2], Padded.shape[1], Padded.shape[0])
+    Image.SetSpacing(Spacing)
+    Image.GetPointData().SetScalars(vtk.util.numpy_support.numpy_to_vtk(Padded.ravel(), deep=True))
+    Surface = vtk.vtkDiscreteFlyingEdges3D()
+    Surface.SetInputData(Image)
+    Surface.SetValue(0, 1)
+    MassProperties = vtk.vtkMassProperties()
+    MassProperties.SetInputConnection(Surface.GetOutputPort())
+    MassProperties.Update()
+    return MassProperties.GetSurfaceArea()
+
+  @Profile.Timed('Statistics')
+  def GetSegmentStatistics(self, SegmentationNode, VolumeNodes):
+    """ Columns of the statistics table of every segment in every volume, and the segment IDs """
+    Stats = {Key: [] for Key in ['Segment', 'Scalar Volume']+Statistics.StatisticsKeys+['Number of voxels [voxels]', 'Surface area [mm2]', 'Volume [mm3]']}
+    SegmentIDs = []
+    Segmentation = SegmentationNode.GetSegmentation()
+    # The volumes with the same grid share the rasterized segments and are computed together
+    Groups = {}
+    for VolumeNode in VolumeNodes:
+      Entry = self.GetSegmentIndices(SegmentationNode, VolumeNode)
+      Groups.setdefault(id(Entry), (Entry, []))[1].append(VolumeNode)
+    Results = {}
+    for Entry, Nodes in Groups.values():
+      Arrays = [slicer.util.arrayFromVolume(Node) for Node in Nodes]
+      for Node, Result in zip(Nodes, Statistics.ComputeStatistics(Entry[1], Arrays)):
+        Results[Node.GetID()] = Entry, Result
+    for VolumeNode in VolumeNodes:
+      (SegmentIDs, Indices, Areas), Result = Results[VolumeNode.GetID()]
+      VoxelVolume = np.prod(VolumeNode.GetSpacing())
+      for n, SegmentID in enumerate(SegmentIDs):
+        Stats['Segment'].append(Segmentation.GetSegment(SegmentID).GetName())
+        Stats['Scalar Volume'].append(VolumeNode.GetName())
+        for Key in Statistics.StatisticsKeys:
+          Stats[Key].append(float(Result[Key][n]))
+        Stats['Number of voxels [voxels]'].append(len(Indices[n]))
+        Stats['Surface area [mm2]'].append(Areas[n])
+        Stats['Volume [mm3]'].append(len(Indices[n])*VoxelVolume)
+    return Stats, SegmentIDs
+
+  @Profile.Timed('ECV')
+  def ECVFromT1(self, T1Native_Matrix, T1Enhanced_Matrix, Haematocrit, NT1B, ET1B):
+    """ ECV map (%) from the matched T1 Native and Enhanced matrixs, the Haematocrit (%) and the T1 of the blood in both mappings """
+    Engine = ECV.ECVEngine()
+    Engine.SetInputs(T1Native_Matrix, T1Enhanced_Matrix)
+    return Engine.Compute(Haematocrit, NT1B, ET1B)
+
+  def ECVInputKey(self, T1Native_Node, T1Enhanced_Node, ECVMapNode):
+    """ Identify the T1 maps used to create the ECV map: it changes when their voxels or geometry are modified """
+    Key = [ECVMapNode.GetID(), self.interpolation]
+    for Node in (T1Native_Node, T1Enhanced_Node):
+      Key += [Node.GetID(), Node.GetImageData().GetMTime() if Node.GetImageData() else 0, self.GetIJKToRASnpArray(Node).tobytes()]
+    return tuple(Key)
+
+  def CreateECVMap(self, T1Native_Node, T1Enhanced_Node, ECVMapNode, Haematocrit, NT1B, ET1B):
+    """ Compute the ECV map of the T1 Native and Enhanced nodes and copy it in the ECVMapNode """
+    T1Native_Matrix,T1Enhanced_Matrix = self.MatchMatrixs(T1Native_Node, T1Enhanced_Node, ECVMapNode)
+    ECV_Matrix = self.ECVFromT1(T1Native_Matrix, T1Enhanced_Matrix, Haematocrit, NT1B, ET1B)
+    slicer.util.updateVolumeFromArray(ECVMapNode, ECV_Matrix)
+    self.StoreNodeRange(ECVMapNode, ECV_Matrix)
+    return ECV_Matrix
+
 
   def setupNodeFromNode(self, ScalarvolumeNode, MultivolumeNode):
     """ Copy the IJKToRASMatrix of the LL node to the new Scalar volume node"""
@@ -964,58 +1422,469 @@ class T1_ECVMappingLogic(ScriptedLoadableModuleLogic):
     MultivolumeNode.GetIJKToRASMatrix(ijkToRas)
     ScalarvolumeNode.SetIJKToRASMatrix(ijkToRas)
 
-  def FitSignal(self,TT,S_ij,DeltaT,k):
-    """ Try different seeds to fit the Signal function """
-    Min = 40
-    Max = 3000
-    if self.mode == 'Enhanced':
-      T1o = [300,200,250,400,500]
-    if self.mode == 'Native':
-     T1o = [1000,1500,650,1250,500]
+  def FitSignal(self,TT,S_ij,DeltaT,k,ReturnParams = False):
+    """ Try different seeds to fit the Signal function, k = -1 starts with the closed form estimate """
+    Min = self.T1Min
+    Max = self.T1Max
+    T1o = self.T1Seeds[self.mode]
 
     if k>=len(T1o):  
-      return None
+      return (None, None, 0) if ReturnParams else None
       
-    Ao = np.max(S_ij)
-    Bo=2*Ao
-    Seed= [Ao,Bo,T1o[k]/(Bo/Ao-1),0]   
+    if k<0:
+      Seed = list(BatchFit.InitialEstimate(TT,S_ij[None,:])[0])
+    else:
+      Ao = np.max(S_ij)
+      Bo=2*Ao
+      Seed= [Ao,Bo,T1o[k]/(Bo/Ao-1),0]   
+    from scipy.optimize import curve_fit
+    Iterations = [0]
+    def Jacobian(*Args):
+      Iterations[0] += 1
+      return self.SignalJacobian(*Args)
     try:
-        [A,B,Ts,c],cov = curve_fit(self.Signal,TT,S_ij,Seed)
+        [A,B,Ts,c],cov = curve_fit(self.Signal,TT,S_ij,Seed,jac=Jacobian)
         T1 = self.TsToT1(A,B*np.exp(DeltaT/Ts),Ts)
-      # dT1 = self.SigmaT1(A,B,Ts,DeltaT,cov)
         if  Min<T1<Max:
-            return T1
+            return (T1, [A,B,Ts,c], Iterations[0]) if ReturnParams else T1
         else:
-           return self.FitSignal(TT,S_ij,DeltaT,k+1) 
+           return self.FitSignal(TT,S_ij,DeltaT,k+1,ReturnParams) 
+    except:
+          return self.FitSignal(TT,S_ij,DeltaT,k+1,ReturnParams) 
+
+  def FitSignalBatch(self,TT,S,DeltaT):
+    """ Fit the Signal function of all the rows of S at once, returning the T1, the parameters and the iterations of every row """
+    if self.FitEngine() == 'Dictionary':
+      from T1_ECVMappingLib import Dictionary
+      return Dictionary.MatchT1(TT, S, DeltaT, self.T1Min, self.T1Max, self.refine)+(np.zeros(len(S), dtype=int),)
+    return BatchFit.FitT1(TT, S, DeltaT, self.T1Seeds[self.mode], self.T1Min, self.T1Max, ReturnIterations = True, Counters = self.Profile.Counters, Model = self.model)
+
+
+  @classmethod
+  def ReportProfile(cls, **Context):
+    """ Log, append to ProfileLog and reset the stage times and counters recorded since the last Reset """
+    logging.info('Profile'+''.join(' {}={}'.format(*Item) for Item in Context.items())+': '+cls.Profile.Summary())
+    if cls.ProfileLog:
+      Report = cls.Profile.Log(cls.ProfileLog, **Context)
+    else:
+      Report = dict(Context, **cls.Profile.Report())
+    cls.Profile.Reset()
+    return Report
+
+  def GetFitInputs(self, MultivolumeNode):
+    """ Get the trigger times, the DeltaT and the Look Locker array of the MultivolumeNode """
+    TT=np.array(self.getMultiVolumeLabels(MultivolumeNode))
+    try: # It isn't available when the Look Locker wasn't loaded from DICOM files
+        Dcm = self.GetDicomFromNode(MultivolumeNode)   
+        DeltaT = Dcm.InversionTime-Dcm.TriggerTime
     except:
-          return self.FitSignal(TT,S_ij,DeltaT,k+1) 
+        DeltaT = 0
+    MvImg = slicer.util.arrayFromVolume(MultivolumeNode) 
+    return TT, DeltaT, MvImg
 
+  @Profile.Timed('Mask')
+  def GetFitMask(self, MvImg):
+    """ Pixels to fit: the ones whose signal in the last frame is above the tenth of the maximum of the slice """
+    return np.stack([MvImg[k,:,:,-1] > np.max(MvImg[k,:,:,:])/10 for k in range(MvImg.shape[0])])
 
   def run(self, MultivolumeNode, ScalarvolumeNode):
     if not MultivolumeNode:
       return
 
-    TT=np.array(self.getMultiVolumeLabels(MultivolumeNode))
-    Dcm = self.GetDicomFromNode(MultivolumeNode)   
-    try:
-        DeltaT = Dcm.InversionTime-Dcm.TriggerTime
-    except:
-        DeltaT = 0
+    if self.lowMemory:
+      self.StartMemoryTrace()
+    TT, DeltaT, MvImg = self.GetFitInputs(MultivolumeNode)
+    Cached = self.GetCachedMaps(MvImg, TT, DeltaT)
+    if Cached:
+      self.T1_Mapping, self.Params_Mapping, self.Iterations_Mapping = self.CastMaps(Cached)
+    else:
+      MvImg = self.CorrectMotion(MvImg)
+      Mask = self.GetFitRegion(MultivolumeNode, MvImg)
+      self.FitMaps(TT, DeltaT, MvImg, Mask)
+      self.FinishFit(Mask)
+    self.UpdateT1Node(ScalarvolumeNode, MultivolumeNode)
+    if self.qualityMaps:
+      self.CreateQualityMaps(MultivolumeNode, ScalarvolumeNode)
+    if self.lowMemory:
+      self.PeakMemory = self.StopMemoryTrace()
+      logging.info('Peak Python allocations of the {} T1 Mapping in the main process: {:.1f} MB'.format(self.mode, self.PeakMemory/1024**2))
+
+  def RunSlices(self, MultivolumeNode, ScalarvolumeNode):
+    """ Streaming version of run, a generator that yields every slice once it is written in the ScalarvolumeNode """
+    if not MultivolumeNode:
+      return
+    if self.lowMemory:
+      self.StartMemoryTrace()
+    TT, DeltaT, MvImg = self.GetFitInputs(MultivolumeNode)
+    Cached = self.GetCachedMaps(MvImg, TT, DeltaT)
+    if Cached:
+      self.T1_Mapping, self.Params_Mapping, self.Iterations_Mapping = self.CastMaps(Cached)
+      self.UpdateT1Node(ScalarvolumeNode, MultivolumeNode)
+      for k in range(MvImg.shape[0]):
+        yield k
+    else:
+      MvImg = self.CorrectMotion(MvImg)
+      Mask = self.GetFitRegion(MultivolumeNode, MvImg)
+      Saved = self.SaveNodeImage(ScalarvolumeNode)
+      self.setupNodeFromNode(ScalarvolumeNode, MultivolumeNode)
+      Image = self.GetNodeBuffer(ScalarvolumeNode, MvImg.shape[:-1], self.MapType())
+      Image[...] = 0
+      try:
+        for k in self.FitSlices(TT, DeltaT, MvImg, Mask):
+          with self.Profile.Stage('Node update'):
+            self.FilterNoneValues(self.T1_Mapping[k:k+1], 3, Out = Image[k:k+1])
+            slicer.util.arrayFromVolumeModified(ScalarvolumeNode)
+          yield k
+      except GeneratorExit: # Closed by the caller, the fit is cancelled
+        self.RestoreNodeImage(ScalarvolumeNode, Saved)
+        if self.lowMemory:
+          self.StopMemoryTrace()
+        raise
+      self.FinishFit(Mask)
+      self.T1_Mapping_Filtered = Image
+      self.StoreNodeRange(ScalarvolumeNode, Image)
+    if self.qualityMaps:
+      self.CreateQualityMaps(MultivolumeNode, ScalarvolumeNode)
+    if self.lowMemory:
+      self.PeakMemory = self.StopMemoryTrace()
+      logging.info('Peak Python allocations of the {} T1 Mapping in the main process: {:.1f} MB'.format(self.mode, self.PeakMemory/1024**2))
+
+  @Profile.Timed('Motion correction')
+  def CorrectMotion(self, MvImg):
+    """ The Look Locker array with the frames of every slice aligned if motionCorrection is set, MvImg otherwise """
+    self.MotionShifts = None
+    if not self.motionCorrection:
+      return MvImg
+    from T1_ECVMappingLib import MotionCorrection
+    Corrected, self.MotionShifts, Peaks = MotionCorrection.CorrectVolume(MvImg, dtype = self.MapType())
+    for k in range(MvImg.shape[0]):
+      logging.info('{} slice {} motion (rows, columns): '.format(self.mode, k)+' '.join('({:.1f}, {:.1f})'.format(*Shift) for Shift in self.MotionShifts[k]))
+    self.Profile.Count('Frames shifted', np.count_nonzero(np.any(self.MotionShifts != 0, axis=-1)))
+    return Corrected
+
+  def MapType(self):
+    """ Type of the T1 and parameters maps """
+    return np.float32 if self.lowMemory else float
+
+  def CastMaps(self, Maps):
+    """ T1 and parameters maps of MapType and iterations map """
+    T1, Params, Iterations = Maps
+    return T1.astype(self.MapType(), copy=False), Params.astype(self.MapType(), copy=False), Iterations
+
+  def StartMemoryTrace(self):
+    """ Start measuring the peak of the memory allocated by Python and NumPy in this process (not in the worker processes) """
+    self.StopTracemalloc = not tracemalloc.is_tracing()
+    if self.StopTracemalloc:
+      tracemalloc.start()
+    self.MemoryStart = tracemalloc.get_traced_memory()[0]
+    if hasattr(tracemalloc, 'reset_peak'):
+      tracemalloc.reset_peak()
+
+  def StopMemoryTrace(self):
+    """ Peak Python allocations (bytes) of the main process since StartMemoryTrace """
+    Peak = tracemalloc.get_traced_memory()[1]-self.MemoryStart
+    if self.StopTracemalloc:
+      tracemalloc.stop()
+    return Peak
+
+  def FitMaps(self, TT, DeltaT, MvImg, Mask = None):
+    """ Fit the T1, parameter and iteration maps of the pixels of Mask, by default the ones of GetFitMask """
+    if Mask is None:
+      Mask = self.GetFitMask(MvImg)
+    if self.UseParallel():
+      from T1_ECVMappingLib import ParallelFit
+      with self.Profile.Stage('Fit'):
+        self.T1_Mapping, self.Params_Mapping, self.Iterations_Mapping = ParallelFit.FitT1Parallel(MvImg, Mask, TT, DeltaT, self.T1Seeds[self.mode], self.T1Min, self.T1Max, self.workers, self.MapType(), self.Profile.Counters, self.model)
+      self.Profile.Count('Pixels fitted', np.count_nonzero(Mask))
+      return
+    for _ in self.FitSlices(TT, DeltaT, MvImg, Mask):
+      pass
 
-    MvImg = slicer.util.arrayFromVolume(MultivolumeNode) 
-    self.T1_Mapping = np.zeros(MvImg.shape[0:-1])
+  def FitEngine(self):
+    """ Engine used for the fit, the models other than Look Locker are always fitted by the Batched engine """
+    if self.model != Models.Default and self.engine in ('Dictionary', 'CurveFit'):
+      return 'Batched'
+    return self.engine
+
+  def UseParallel(self):
+    """ True if the fit is split in worker processes """
+    from T1_ECVMappingLib import ParallelFit
+    Parallel = self.FitEngine() == 'Batched' and self.workers > 1
+    if Parallel and not ParallelFit.IsAvailable():
+      logging.warning('Shared memory is not available in this Python version, the T1 Mapping will be fitted in a single process')
+      Parallel = False
+    return Parallel
+
+  def FitSlices(self, TT, DeltaT, MvImg, Mask):
+    """ Fit the maps of FitMaps slice by slice, a generator that yields every slice once it is fitted """
+    Shape = MvImg.shape[0:-1]
+    if self.RegionState is None:
+      self.T1_Mapping = np.zeros(Shape, dtype=self.MapType())
+      self.Params_Mapping = np.full(Shape+(4,), np.nan, dtype=self.MapType())
+      self.Iterations_Mapping = np.zeros(Shape, dtype=np.int32)
+    else:
+      self.T1_Mapping, self.Params_Mapping, self.Iterations_Mapping = [self.RegionState[Key].copy() for Key in ('T1', 'Params', 'Iterations')]
 
+    Parallel = self.UseParallel()
     for k in range(MvImg.shape[0]):
-      mx = np.max(MvImg[k,:,:,:])/10
-      I,J = np.where(MvImg[k,:,:,-1]>mx)
+      with self.Profile.Stage('Fit'):
+        self.FitSlice(TT, DeltaT, MvImg, Mask, k, Parallel)
+      self.Profile.Count('Pixels fitted', np.count_nonzero(Mask[k]))
+      yield k
+
+  def FitSlice(self, TT, DeltaT, MvImg, Mask, k, Parallel = False):
+    """ Fit the pixels of Mask of the slice k in the maps, with the engine of the logic """
+    I,J = np.where(Mask[k])
+    Counters = self.Profile.Counters
+    if Parallel:
+      from T1_ECVMappingLib import ParallelFit
+      T1, Params, Iterations = ParallelFit.FitT1Parallel(MvImg[k:k+1], Mask[k:k+1], TT, DeltaT, self.T1Seeds[self.mode], self.T1Min, self.T1Max, self.workers, self.MapType(), Counters, self.model)
+      self.T1_Mapping[k,I,J], self.Params_Mapping[k,I,J], self.Iterations_Mapping[k,I,J] = T1[0,I,J], Params[0,I,J], Iterations[0,I,J]
+    elif self.FitEngine() == 'Multiresolution':
+      from T1_ECVMappingLib import Multiresolution
+      self.T1_Mapping[k,I,J], self.Params_Mapping[k,I,J], self.Iterations_Mapping[k,I,J], Report = Multiresolution.FitSlice(TT, MvImg[k], Mask[k], DeltaT, self.T1Seeds[self.mode], self.T1Min, self.T1Max, Counters = Counters, Model = self.model)
+      logging.info('Slice {}: {Coarse} blocks, {Seeded} pixels fitted from the blocks, {Neighbours} from their neighbours in {Rounds} rounds, {Fallback} from the seeds, {Iterations} iterations'.format(k, **Report))
+    elif self.FitEngine() in ('Batched', 'Dictionary'):
+      self.T1_Mapping[k,I,J], self.Params_Mapping[k,I,J], self.Iterations_Mapping[k,I,J] = self.FitSignalBatch(TT,MvImg[k,I,J,:],DeltaT)
+    else:
       for i in range (len(I)):
           S_ij=MvImg[k,I[i],J[i],:]
-          self.T1_Mapping[k,I[i],J[i]] = self.FitSignal(TT,S_ij,DeltaT,0)     
+          T1, Params, Iterations = self.FitSignal(TT,S_ij,DeltaT,-1,ReturnParams = True)
+          if T1 is None:
+            self.Profile.Count('Unfitted')
+          else:
+            self.Params_Mapping[k,I[i],J[i]], self.Iterations_Mapping[k,I[i],J[i]] = Params, Iterations
+          self.T1_Mapping[k,I[i],J[i]] = T1
+
+  def StartRun(self, MultivolumeNode, Start = True):
+    """ Start the batched fit in the worker processes without blocking, returning the job to pass to FinishRun """
+    if self.FitEngine() != 'Batched':
+      raise ValueError('The {} engine can not run in the worker processes, use run instead'.format(self.engine))
+    TT, DeltaT, MvImg = self.GetFitInputs(MultivolumeNode)
+    Cached = self.GetCachedMaps(MvImg, TT, DeltaT)
+    if Cached:
+      return ResultCache.CachedJob(*self.CastMaps(Cached))
+    from T1_ECVMappingLib import ParallelFit
+    MvImg = self.CorrectMotion(MvImg)
+    self.JobMask = self.GetFitRegion(MultivolumeNode, MvImg)
+    self.JobStart = time.perf_counter()
+    return ParallelFit.FitJob(MvImg, self.JobMask, TT, DeltaT, self.T1Seeds[self.mode], self.T1Min, self.T1Max, self.workers, Start, self.MapType(), self.model)
+
+  def FinishRun(self, Job, MultivolumeNode, ScalarvolumeNode):
+    """ Write the result of a job started with StartRun in the ScalarvolumeNode """
+    self.T1_Mapping, self.Params_Mapping, self.Iterations_Mapping = Job.Result()
+    if not isinstance(Job, ResultCache.CachedJob):
+      self.Profile.Add('Fit', time.perf_counter()-self.JobStart)
+      self.Profile.Merge(Job.Counters())
+      self.Profile.Count('Pixels fitted', Job.TotalPixels)
+      self.FinishFit(self.JobMask)
+    self.UpdateT1Node(ScalarvolumeNode, MultivolumeNode)
+    if self.qualityMaps:
+      self.CreateQualityMaps(MultivolumeNode, ScalarvolumeNode)
+
+  def GetFitRegion(self, MultivolumeNode, MvImg):
+    """ Pixels of GetFitMask to fit, only the ones of the roiNode not fitted yet if there is one (its edits aren't observed) """
+    Mask = self.GetFitMask(MvImg)
+    self.RegionState = None
+    if self.roiNode is None:
+      return Mask
+    Mask &= self.GetRegionMask(self.roiNode, MultivolumeNode)
+    if self.InputKey in self.RegionStates:
+      self.RegionStates.move_to_end(self.InputKey)
+    else:
+      self.RegionStates[self.InputKey] = {'Fitted': np.zeros(Mask.shape, dtype=bool),
+                                          'T1': np.zeros(Mask.shape, dtype=self.MapType()),
+                                          'Params': np.full(Mask.shape+(4,), np.nan, dtype=self.MapType()),
+                                          'Iterations': np.zeros(Mask.shape, dtype=np.int32)}
+      while len(self.RegionStates) > self.RegionStatesSize:
+        self.RegionStates.popitem(last=False)
+    self.RegionState = self.RegionStates[self.InputKey]
+    Mask &= ~self.RegionState['Fitted']
+    logging.info('Fit region: {} new pixels, {} fitted before'.format(np.count_nonzero(Mask), np.count_nonzero(self.RegionState['Fitted'])))
+    return Mask
+
+  def FinishFit(self, Mask):
+    """ Store the maps just fitted in the cache, or with a roiNode add the pixels of Mask to the maps of the fit region """
+    if self.RegionState is None:
+      self.StoreCachedMaps()
+      return
+    State = self.RegionState
+    State['T1'][Mask] = self.T1_Mapping[Mask]
+    State['Params'][Mask] = self.Params_Mapping[Mask]
+    State['Iterations'][Mask] = self.Iterations_Mapping[Mask]
+    State['Fitted'] |= Mask
+    self.T1_Mapping, self.Params_Mapping, self.Iterations_Mapping = State['T1'], State['Params'], State['Iterations']
+
+  @Profile.Timed('Mask')
+  def GetRegionMask(self, RegionNode, VolumeNode):
+    """ Mask of the voxels of the VolumeNode inside the segments of a segmentation node or inside a ROI node """
+    Shape = slicer.util.arrayFromVolume(VolumeNode).shape[:3]
+    if RegionNode.IsA('vtkMRMLSegmentationNode'):
+      Mask = np.zeros(np.prod(Shape), dtype=bool)
+      for Index in self.GetSegmentIndices(RegionNode, VolumeNode)[1]:
+        Mask[Index] = True
+      return Mask.reshape(Shape)
+
+    K, J, I = np.meshgrid(*[np.arange(n) for n in Shape], indexing='ij')
+    RAS = self.GetIJKToRASnpArray(VolumeNode).dot(np.stack([I.ravel(), J.ravel(), K.ravel(), np.ones(I.size)]))
+    if RegionNode.IsA('vtkMRMLMarkupsROINode'):
+      ObjectToWorld = vtk.vtkMatrix4x4()
+      RegionNode.GetObjectToWorldMatrix(ObjectToWorld)
+      WorldToObject = np.linalg.inv(np.array([[ObjectToWorld.GetElement(i,j) for j in range(4)] for i in range(4)]))
+      Local = WorldToObject.dot(RAS)[:3]
+      Radius = np.array(RegionNode.GetSize())/2
+    else: # Annotation ROI, aligned with the RAS axes
+      Center = [0,0,0]
+      RegionNode.GetXYZ(Center)
+      Radius = [0,0,0]
+      RegionNode.GetRadiusXYZ(Radius)
+      Local = RAS[:3]-np.array(Center)[:,None]
+    return np.all(np.abs(Local) <= np.array(Radius)[:,None], axis=0).reshape(Shape)
+
+  @classmethod
+  def GetResultCache(cls):
+    """ Cache of the fitted maps, shared by all the logic instances """
+    if cls.Cache is None:
+      cls.Cache = ResultCache.ResultCache(os.path.join(slicer.app.cachePath, 'T1_ECVMapping'))
+    return cls.Cache
+
+  @Profile.Timed('Cache')
+  def GetCachedMaps(self, MvImg, TT, DeltaT):
+    """ Return the T1, parameters and iterations maps fitted before for these inputs, or None. It also sets the key used by StoreCachedMaps """
+    self.CacheKey = None
+    self.InputKey = None
+    if not self.useCache and self.roiNode is None:
+      return None
+    Settings = {'Version': self.CacheVersion, 'Engine': self.FitEngine(), 'Refine': self.refine,
+                'Seeds': tuple(self.T1Seeds[self.mode]), 'T1Min': self.T1Min, 'T1Max': self.T1Max}
+    if self.lowMemory:
+      Settings['Type'] = 'float32'
+    if self.motionCorrection:
+      Settings['MotionCorrection'] = True
+    if self.model != Models.Default:
+      Settings['Model'] = self.model
+    self.InputKey = ResultCache.ComputeKey(MvImg, TT, DeltaT, self.mode, Settings) # Also identifies the maps of the fit region
+    if not self.useCache:
+      return None
+    self.CacheKey = self.InputKey
+    Entry = self.GetResultCache().Get(self.CacheKey)
+    if Entry is None:
+      return None
+    return Entry['T1'], Entry['Params'], Entry['Iterations']
 
-    self.setupNodeFromNode(ScalarvolumeNode, MultivolumeNode)
-    self.T1_Mapping_Filtered = self.FilterNoneValues(self.T1_Mapping,3)
-    slicer.util.updateVolumeFromArray(ScalarvolumeNode,self.T1_Mapping_Filtered)
+  @Profile.Timed('Cache')
+  def StoreCachedMaps(self):
+    if self.CacheKey is not None:
+      self.GetResultCache().Put(self.CacheKey, T1 = self.T1_Mapping, Params = self.Params_Mapping, Iterations = self.Iterations_Mapping)
 
+  @Profile.Timed('Node update')
+  def UpdateT1Node(self, ScalarvolumeNode, MultivolumeNode):
+    """ Filter the T1 Mapping and copy it in the ScalarvolumeNode """
+    self.setupNodeFromNode(ScalarvolumeNode, MultivolumeNode)
+    if self.lowMemory: # Filtered directly in the image of the node
+      self.T1_Mapping_Filtered = self.FilterNoneValues(self.T1_Mapping, 3, Out = self.GetNodeBuffer(ScalarvolumeNode, self.T1_Mapping.shape, np.float32))
+      slicer.util.arrayFromVolumeModified(ScalarvolumeNode)
+    else:
+      self.T1_Mapping_Filtered = self.FilterNoneValues(self.T1_Mapping,3)
+      slicer.util.updateVolumeFromArray(ScalarvolumeNode,self.T1_Mapping_Filtered)
+    self.StoreNodeRange(ScalarvolumeNode, self.T1_Mapping_Filtered)
+
+  @classmethod
+  def StoreNodeRange(cls, VolumeNode, Array = None):
+    """ Compute and keep the range and histogram of the image of the VolumeNode, from Array if it is given """
+    if Array is None:
+      Array = slicer.util.arrayFromVolume(VolumeNode)
+    Values = Array[np.isfinite(Array)]
+    Range = {'Min': 0, 'Max': 0, 'Histogram': np.zeros(cls.HistogramBins, dtype=int), 'Edges': np.zeros(cls.HistogramBins+1)}
+    if Values.size:
+      Range['Min'], Range['Max'] = float(np.min(Values)), float(np.max(Values))
+      Range['Histogram'], Range['Edges'] = np.histogram(Values, cls.HistogramBins, (Range['Min'], Range['Max']))
+    cls.RangeCache[VolumeNode.GetID()] = (cls.ImageStamp(VolumeNode), Range)
+    return Range
+
+  @classmethod
+  def GetNodeRange(cls, VolumeNode):
+    """ Range and histogram of the image of the VolumeNode, only computed again if the image was modified """
+    Entry = cls.RangeCache.get(VolumeNode.GetID())
+    if Entry is not None and Entry[0] == cls.ImageStamp(VolumeNode):
+      return Entry[1]
+    return cls.StoreNodeRange(VolumeNode)
+
+  @staticmethod
+  def ImageStamp(VolumeNode):
+    """ It changes when the image of the VolumeNode is replaced or modified """
+    ImageData = VolumeNode.GetImageData()
+    if ImageData is None:
+      return None
+    return ImageData.GetAddressAsString('vtkImageData'), ImageData.GetMTime()
+
+  def SaveNodeImage(self, VolumeNode):
+    """ Copy of the image and IJKToRASMatrix of the VolumeNode, which RestoreNodeImage puts back """
+    Matrix = vtk.vtkMatrix4x4()
+    VolumeNode.GetIJKToRASMatrix(Matrix)
+    Image = None
+    if VolumeNode.GetImageData():
+      Image = vtk.vtkImageData()
+      Image.DeepCopy(VolumeNode.GetImageData())
+    return Image, Matrix
+
+  def RestoreNodeImage(self, VolumeNode, Saved):
+    Image, Matrix = Saved
+    VolumeNode.SetIJKToRASMatrix(Matrix)
+    VolumeNode.SetAndObserveImageData(Image)
+
+  def GetNodeBuffer(self, VolumeNode, Shape, dtype):
+    """ Array of the image of the VolumeNode, only allocated again if it hasn't the Shape and dtype """
+    if VolumeNode.GetImageData():
+      Array = slicer.util.arrayFromVolume(VolumeNode)
+      if Array.shape == tuple(Shape) and Array.dtype == dtype:
+        return Array
+    ImageData = vtk.vtkImageData()
+    ImageData.SetDimensions(Shape[2], Shape[1], Shape[0])
+    ImageData.AllocateScalars(vtk.VTK_FLOAT if np.dtype(dtype) == np.float32 else vtk.VTK_DOUBLE, 1)
+    VolumeNode.SetAndObserveImageData(ImageData)
+    return slicer.util.arrayFromVolume(VolumeNode)
+
+
+  def BenchmarkJacobian(self, MultivolumeNode = None, N = 20000):
+    """ Compare the fit with the numerical and the analytic Jacobian on the MultivolumeNode, or on N synthetic signals """
+    from T1_ECVMappingLib import Benchmark
+    if MultivolumeNode:
+      TT, DeltaT, MvImg = self.GetFitInputs(MultivolumeNode)
+      S = MvImg[self.GetFitMask(MvImg)]
+    else:
+      TT, DeltaT = Benchmark.TriggerTimes[self.mode], 0
+      S, _ = Benchmark.SyntheticSignals(TT, N, Benchmark.T1Ranges[self.mode])
+    Report = Benchmark.CompareJacobians(TT, S, DeltaT, self.T1Seeds[self.mode], self.T1Min, self.T1Max)
+    for Name in ('Numerical', 'Analytic'):
+      logging.info('{} Jacobian: {:.2f} s, {:.2f} iterations per pixel, {:.1%} converged'.format(Name, Report[Name]['Time'], Report[Name]['Iterations'], Report[Name]['Converged']))
+    logging.info('Speedup = {:.2f}'.format(Report['Speedup']))
+    return Report
+
+  def BenchmarkPipeline(self, Path = None, BaselinePath = None, **Options):
+    """ Run Benchmark.RunSuite with the options of this logic, saved in Path and compared with BaselinePath if given """
+    from T1_ECVMappingLib import Benchmark
+    def Fit(Mode, TT, DeltaT, MvImg):
+      Logic = T1_ECVMappingLogic(Mode, self.engine, self.workers, self.refine)
+      Logic.lowMemory = self.lowMemory
+      Logic.FitMaps(TT, DeltaT, MvImg)
+      return Logic.T1_Mapping
+    Report = Benchmark.RunSuite(Fit = Fit, Filter = lambda T1: self.FilterNoneValues(T1, 3), **Options)
+    Report['Settings'] = {'Engine': self.engine, 'Workers': self.workers, 'Refine': self.refine, 'LowMemory': self.lowMemory}
+    for Case in Report['Cases']:
+      logging.info('Size {Size}, noise {Noise}, scheme {Scheme}:'.format(**Case['Case']))
+      for Stage in Benchmark.PipelineStages:
+        if Stage in Case:
+          Accuracy = Case[Stage].get('Accuracy')
+          logging.info('  {}: {:.3f} s, {:.0f} pixels/s{}'.format(Stage, Case[Stage]['Time'], Case[Stage]['PixelsPerSecond'],
+                       ', {:.1%} within 5%, {:.1%} failed'.format(Accuracy['Within5%'], Accuracy['Failed']) if Accuracy else ''))
+    if Path:
+      Benchmark.SaveBaseline(Report, Path)
+    if BaselinePath:
+      Report['Regressions'] = Benchmark.CompareBaseline(Report, Benchmark.LoadBaseline(BaselinePath))
+      for Regression in Report['Regressions']:
+        logging.warning('Regression: '+Regression)
+    return Report
 
   def GetT1MappingError (self, MultivolumeNode, ScalarvolumeNode):
     """ This creates a node with an image which has high values in the pixels where in fitting did bad """
@@ -1027,9 +1896,46 @@ class T1_ECVMappingLogic(ScriptedLoadableModuleLogic):
 
     self.NewNode = slicer.util.getNode(NewNodeName)
     self.setupNodeFromNode(self.NewNode , MultivolumeNode)
+    if self.lowMemory:
+      self.FilterNoneValues(self.T1_Mapping, 3, 10000, Out = self.GetNodeBuffer(self.NewNode, self.T1_Mapping.shape, np.float32))
+      slicer.util.arrayFromVolumeModified(self.NewNode)
+      return
     T1_MappingError = self.FilterNoneValues(self.T1_Mapping,3,10000)
     slicer.util.updateVolumeFromArray(self.NewNode,T1_MappingError)
 
+  @Profile.Timed('Quality maps')
+  def CreateQualityMaps(self, MultivolumeNode, ScalarvolumeNode):
+    """ Create or update the T1 SD, RMS, R2 and Iterations volumes of the fit of the ScalarvolumeNode, NaN where undetermined """
+    TT, DeltaT, MvImg = self.GetFitInputs(MultivolumeNode)
+    if self.motionCorrection: # The shifts are only missing when the maps come from the cache
+      from T1_ECVMappingLib import MotionCorrection
+      MvImg = MotionCorrection.ShiftVolume(MvImg, self.MotionShifts) if self.MotionShifts is not None else self.CorrectMotion(MvImg)
+    Fitted = np.all(np.isfinite(self.Params_Mapping), axis=-1)
+    Maps = {Key: np.full(Fitted.shape, np.nan, dtype=self.MapType()) for Key in Quality.QualityKeys}
+    for k in range(MvImg.shape[0]):
+      I,J = np.nonzero(Fitted[k])
+      for Key, Values in Quality.FitQuality(TT, MvImg[k,I,J,:], self.Params_Mapping[k,I,J], DeltaT, self.model).items():
+        Maps[Key][k,I,J] = np.where(np.isfinite(Values), Values, np.nan)
+    Maps['Iterations'] = self.Iterations_Mapping
+    Nodes = {}
+    for Key, Map in Maps.items():
+      Name = ScalarvolumeNode.GetName()+' '+Key
+      Nodes[Key] = slicer.mrmlScene.GetFirstNodeByName(Name) or slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', Name)
+      self.setupNodeFromNode(Nodes[Key], MultivolumeNode)
+      slicer.util.updateVolumeFromArray(Nodes[Key], Map)
+      Range = self.StoreNodeRange(Nodes[Key], Map)
+      Display = Nodes[Key].GetScalarVolumeDisplayNode()
+      if Key in Quality.QualityKeys and Display:
+        Display.SetAutoWindowLevel(False)
+        Display.SetWindowLevelMinMax(Range['Min'], Range['Max'])
+        Display.SetApplyThreshold(True)
+        Display.SetThreshold(Range['Min'], Range['Max'])
+    SD, R2 = Maps['T1 SD'][Fitted], Maps['R2'][Fitted]
+    logging.info('{}: median T1 SD {:.1f} ms, {} undetermined fits, median R2 {:.3f}, {} pixels with R2 < 0.9'.format(ScalarvolumeNode.GetName(),
+                 np.nanmedian(SD) if np.isfinite(SD).any() else 0, np.count_nonzero(np.isnan(SD)),
+                 np.nanmedian(R2) if np.isfinite(R2).any() else 0, np.count_nonzero(R2 < 0.9)))
+    return Nodes
+
 
 
 
@@ -1044,13 +1950,115 @@ class T1_ECVMappingTest(ScriptedLoadableModuleTest):
     slicer.mrmlScene.Clear(0)
 
   def runTest(self):
-    """Currently no testing functionality.
+    """ Run all the tests
     """
     self.setUp()
-    self.test_SegmentEditor1()
+    self.test_BatchedFit()
+    self.test_FitEngines()
+    self.test_BatchProcessingEngines()
+    self.test_SegmentCache()
+    self.test_FilterNoneValues()
+
+  def test_BatchedFit(self):
+    """ The Batched engine gives the T1 Mapping of the per pixel curve_fit, on noisy Look Locker signals """
+    TT = np.array([100,180,260,900,980,1060,1700,1780,2600,3400,4200.])
+    Random = np.random.RandomState(0)
+    A = Random.uniform(200, 400, 2*6*6)
+    Ts = Random.uniform(200, 1200, len(A))
+    P = np.stack([A, A*Random.uniform(1.6, 2, len(A)), Ts, np.zeros(len(A))], axis=1)
+    MvImg = (BatchFit.Signal(TT, P)+Random.normal(0, 4, (len(A), len(TT)))).reshape(2,6,6,-1)
+    Mask = np.ones(MvImg.shape[:-1], dtype=bool)
+    Maps = {}
+    for Engine in ('Batched', 'CurveFit'):
+      Logic = T1_ECVMappingLogic('Native', Engine)
+      Logic.useCache = False
+      Logic.FitMaps(TT, 0, MvImg, Mask)
+      Maps[Engine] = Logic.T1_Mapping
+    Fitted = np.isfinite(Maps['CurveFit'])
+    self.assertGreater(np.count_nonzero(Fitted), 0.9*Fitted.size)
+    np.testing.assert_array_equal(np.isfinite(Maps['Batched']), Fitted)
+    np.testing.assert_allclose(Maps['Batched'][Fitted], Maps['CurveFit'][Fitted], rtol=1e-3)
+    self.delayDisplay('Test passed!')
 
-  def test_SegmentEditor1(self):
-    """Add test here later.
-    """
-    self.delayDisplay("Starting the test")
+  def test_FitEngines(self):
+    """ FitMaps fits the pixels with the function of the engine of the logic """
+    import contextlib
+    from unittest import mock
+    from T1_ECVMappingLib import Dictionary, Multiresolution
+    TT = np.array([100,180,260,900,980,1060,1700,1780,2600,3400,4200.])
+    MvImg = np.abs(BatchFit.Signal(TT, np.array([[300.,570.,1000/0.9,0]]))).reshape(1,1,1,-1).repeat(4, axis=1)
+    Mask = np.ones(MvImg.shape[:-1], dtype=bool)
+    Functions = {'Batched': (BatchFit, 'FitT1'), 'Multiresolution': (Multiresolution, 'FitSlice'),
+                 'Dictionary': (Dictionary, 'MatchT1'), 'CurveFit': (None, 'FitSignal')}
+    for Engine in Functions:
+      Logic = T1_ECVMappingLogic('Native', Engine)
+      Logic.useCache = False
+      Mocks = {}
+      with contextlib.ExitStack() as Stack:
+        for Key, (Module, Name) in Functions.items():
+          Target = Module or Logic
+          Mocks[Key] = Stack.enter_context(mock.patch.object(Target, Name, wraps = getattr(Target, Name)))
+        Logic.FitMaps(TT, 0, MvImg, Mask)
+      self.assertTrue(Mocks[Engine].called, Engine)
+      for Other in ('Multiresolution', 'Dictionary', 'CurveFit'): # The Batched fit is also used inside Multiresolution
+        if Other != Engine:
+          self.assertFalse(Mocks[Other].called, Engine)
+      self.assertTrue(np.allclose(Logic.T1_Mapping, 1000, rtol=0.05), Engine)
+      self.assertTrue(np.all(np.isfinite(Logic.Params_Mapping)), Engine) # The quality maps are computed from them
+    self.delayDisplay('Test passed!')
+
+  def test_BatchProcessingEngines(self):
+    """ BatchProcessing only fits the Batched engine in the worker processes, the other engines are run with their own fit """
+    from unittest import mock
+    from T1_ECVMappingLib import BatchProcessing, ParallelFit
+    for Engine in ('Batched', 'Multiresolution', 'Dictionary', 'CurveFit'):
+      Logic = T1_ECVMappingLogic('Native', Engine)
+      Job = ResultCache.CachedJob(np.zeros((1,1,1)), np.zeros((1,1,1,4)), np.zeros((1,1,1)))
+      with mock.patch.object(ParallelFit, 'IsAvailable', return_value = True), \
+           mock.patch.object(Logic, 'run') as Run, mock.patch.object(Logic, 'StartRun', return_value = Job) as StartRun, \
+           mock.patch.object(Logic, 'FinishRun') as FinishRun:
+        BatchProcessing.FitT1Mappings([Logic], ['Look Locker'], ['T1'])
+      self.assertEqual(StartRun.called and FinishRun.called, Engine == 'Batched', Engine)
+      self.assertEqual(Run.called, Engine != 'Batched', Engine)
+      if Engine != 'Batched':
+        with self.assertRaises(ValueError): # The cache must not keep a batched fit under another engine
+          Logic.StartRun(None)
     self.delayDisplay('Test passed!')
+
+  def test_SegmentCache(self):
+    """ The rasterized segments are kept for the last SegmentCacheSize segmentations, and their observers are removed with them """
+    from unittest import mock
+    Logic = T1_ECVMappingLogic()
+    Logic.ClearSegmentCache()
+    Reference = mock.MagicMock()
+    Reference.GetImageData().GetDimensions.return_value = (4, 4, 1)
+    Nodes = []
+    for n in range(Logic.SegmentCacheSize+1):
+      Node = mock.MagicMock()
+      Node.GetID.return_value = 'Segmentation{}'.format(n)
+      Node.GetSegmentation().GetNumberOfSegments.return_value = 1
+      Nodes.append(Node)
+    with mock.patch.object(slicer.modules.segmentations, 'logic'), mock.patch.object(Logic, 'SurfaceArea', return_value = 0), \
+         mock.patch.object(slicer.util, 'arrayFromVolume', return_value = np.ones((1,4,4))):
+      for Node in Nodes:
+        Logic.GetSegmentIndices(Node, Reference)
+    self.assertEqual(len(Logic.SegmentCache), Logic.SegmentCacheSize)
+    Evicted = Nodes[0].GetSegmentation()
+    self.assertTrue(Evicted.AddObserver.called)
+    self.assertEqual(Evicted.RemoveObserver.call_count, Evicted.AddObserver.call_count)
+    Logic.ClearSegmentCache(Nodes[1])
+    self.assertEqual(len(Logic.SegmentCache), Logic.SegmentCacheSize-1)
+    Logic.ClearSegmentCache()
+    self.assertEqual(len(Logic.SegmentCache), 0)
+    self.delayDisplay('Test passed!')
+
+  def test_FilterNoneValues(self):
+    """ The None pixels get the median of their neighbors, or Value when it is given, even if it is 0 """
+    Logic = T1_ECVMappingLogic()
+    T1 = np.array([[[np.nan, 1000., 1200.], [900., 1100., np.nan]]])
+    np.testing.assert_allclose(Logic.FilterNoneValues(T1, 3), [[[1000., 1000., 1200.], [900., 1100., 1100.]]])
+    np.testing.assert_array_equal(Logic.FilterNoneValues(T1, 3, 0), [[[0., 1000., 1200.], [900., 1100., 0.]]])
+    np.testing.assert_array_equal(Logic.FilterNoneValues(T1, 3, 10000)[np.isnan(T1)], 10000)
+    self.delayDisplay('Test passed!')
+
+StartupTimes['Import'] = time.perf_counter()-ImportStart
@@ -0,0 +1,247 @@
+import numpy as np
+
+#
+# Batched Levenberg-Marquardt fitting of the Look Locker signal
+#
+# Every function of this file works on a whole set of pixels at once: the signals are stored in a (N,F) matrix,
+# one row per pixel and one column per trigger time, and the parameters in a (N,4) matrix with the columns A,B,Ts,c.
+# It only depends on numpy, so it can be imported outside Slicer. FitT1 fits the Look Locker signal by default, or any
+# of the models of Models.Registry with the same Levenberg-Marquardt.
+#
+
+MaxIterations = 200
+Tolerance = 1.49012e-08 # Same ftol and xtol used by scipy curve_fit
+MaxLambda = 1e16
+ChunkSize = 4096 # Pixels fitted together. The parallel fit splits the work with the same chunks, so both give the same result
+TsGrid = np.geomspace(10, 4000, 96) # Apparent relaxation times tried by InitialEstimate
+T1Seeds = {'Enhanced': [300,200,250,400,500], 'Native': [1000,1500,650,1250,500]} # Tried in order when a fit fails
+# Counted by FitT1: Levenberg-Marquardt fits, fits from a seed after the first one, fits that didn't converge, fits that
+# converged to a T1 out of (T1Min,T1Max) and pixels without T1 after all the seeds
+FitCounters = ['Fits', 'Seed retries', 'Optimizer failures', 'Out of range', 'Unfitted']
+
+
+def Signal(TT, P):
+  """ Look Locker signal np.abs(A-B*np.exp(-TT/Ts))+c for every row of the parameter matrix P """
+  A,B,Ts,c = P[:,0:1],P[:,1:2],P[:,2:3],P[:,3:4]
+  return np.abs(A-B*np.exp(-TT/Ts))+c
+
+
+def TsToT1(A, B, Ts):
+  """ Look Locker correction of the apparent relaxation time """
+  return Ts*(B/A-1)
+
+
+def NumericalJacobian(TT, P, F, Function = Signal):
+  """ Forward difference Jacobian (N,F,4) of Function, by default Signal, F is the function already evaluated in P """
+  eps = np.sqrt(np.finfo(float).eps)
+  Jac = np.empty(F.shape+(P.shape[1],))
+  for p in range(P.shape[1]):
+    h = eps*np.abs(P[:,p])
+    h[h==0] = eps
+    Ph = P.copy()
+    Ph[:,p] += h
+    Jac[:,:,p] = (Function(TT,Ph)-F)/h[:,None]
+  return Jac
+
+
+def SignalJacobian(TT, P, F = None):
+  """ Analytic Jacobian (N,F,4) of Signal. The derivatives of A-B*exp(-TT/Ts) are multiplied by its sign, due to the absolute value """
+  A,B,Ts = P[:,0:1],P[:,1:2],P[:,2:3]
+  E = np.exp(-TT/Ts)
+  Sign = np.where(A-B*E < 0, -1.0, 1.0)
+  Jac = np.empty(E.shape+(4,))
+  Jac[:,:,0] = Sign
+  Jac[:,:,1] = -Sign*E
+  Jac[:,:,2] = -Sign*B*E*TT/Ts**2
+  Jac[:,:,3] = 1
+  return Jac
+
+
+def SolveBatch(H, g):
+  """ Solve the (N,4,4) linear systems H*x = g, falling back to the pseudo-inverse when some of them are singular """
+  try:
+    return np.linalg.solve(H, g[...,None])[...,0]
+  except np.linalg.LinAlgError:
+    return np.einsum('nij,nj->ni', np.linalg.pinv(H), g)
+
+
+def LevenbergMarquardt(TT, S, P0, Jacobian = SignalJacobian, MaxIter = MaxIterations, Tol = Tolerance, Function = Signal):
+  """ Fit Function, by default Signal, whose Jacobian is Jacobian, to every row of S starting from the rows of P0.
+  It returns the fitted parameters, a boolean array with the pixels that converged and the number of iterations of each pixel """
+  TT = np.asarray(TT, dtype=float)
+  S = np.asarray(S, dtype=float)
+  P = np.array(P0, dtype=float)
+  N = P.shape[0]
+  with np.errstate(all='ignore'):
+    F = Function(TT,P)
+    Cost = np.sum((S-F)**2, axis=1)
+  Lambda = np.full(N, 1e-3)
+  Active = np.isfinite(Cost)
+  Converged = np.zeros(N, dtype=bool)
+  Iterations = np.zeros(N, dtype=int)
+  Converged[Active & (Cost==0)] = True
+  Active &= ~Converged
+
+  for it in range(MaxIter):
+    idx = np.flatnonzero(Active)
+    if len(idx)==0:
+      break
+    Iterations[idx] += 1
+    p = P[idx]
+    with np.errstate(all='ignore'):
+      Jac = Jacobian(TT, p, F[idx])
+      JTJ = np.einsum('nfi,nfj->nij', Jac, Jac)
+      g = np.einsum('nfi,nf->ni', Jac, S[idx]-F[idx])
+      D = np.maximum(np.diagonal(JTJ, axis1=1, axis2=2), 1e-12)
+      H = JTJ + (Lambda[idx,None]*D)[:,:,None]*np.eye(P.shape[1])
+      Bad = ~np.all(np.isfinite(H), axis=(1,2)) | ~np.all(np.isfinite(g), axis=1)
+      H[Bad] = np.eye(P.shape[1])
+      g[Bad] = 0
+      dp = SolveBatch(H, g)
+      pn = p+dp
+      Fn = Function(TT,pn)
+      Costn = np.sum((S[idx]-Fn)**2, axis=1)
+
+    Accept = ~Bad & np.isfinite(Costn) & (Costn < Cost[idx])
+    a = idx[Accept]
+    with np.errstate(all='ignore'):
+      SmallStep = np.all(np.abs(dp[Accept]) <= Tol*(np.abs(pn[Accept])+Tol), axis=1)
+      SmallReduction = (Cost[a]-Costn[Accept]) <= Tol*Cost[a]
+    P[a] = pn[Accept]
+    F[a] = Fn[Accept]
+    Cost[a] = Costn[Accept]
+    Lambda[a] = np.maximum(Lambda[a]/10, 1e-12)
+    Lambda[idx[~Accept]] *= 10
+
+    Done = a[SmallStep | SmallReduction | (Cost[a]==0)]
+    Stalled = idx[~Accept & ~Bad & (Lambda[idx]>MaxLambda)] # No step reduces the cost: it is already at the minimum
+    Converged[Done] = True
+    Converged[Stalled] = True
+    Active[Done] = False
+    Active[Stalled] = False
+    Active[idx[Bad]] = False
+
+  return P, Converged, Iterations
+
+
+def RestorePolarity(S):
+  """ The two possible polarities (N,2,F) of the rows of S, sorted by time: the null point is just after or just
+  before the minimum sample """
+  Min = np.argmin(S, axis=1)
+  Y = np.repeat(S[:,None,:], 2, axis=1) # (N, 2 polarities, F)
+  Frames = np.arange(S.shape[1])
+  Y[:,0,:][Frames < Min[:,None]] *= -1 # Null point just after the minimum: the minimum is the last negative sample
+  Y[:,1,:][Frames <= Min[:,None]] *= -1 # Null point just before the minimum: the minimum is negative too
+  return Y
+
+
+def LinearEstimate(t, Y, Ts, PerRow = False):
+  """ Least squares A and B of y = A-B*exp(-t/Ts) for the rows of Y (...,F), which is linear in them for a fixed Ts.
+  Every Ts of the grid Ts (G) is tried for every row, giving A, B and the residual (...,G), or with PerRow every row
+  (N,...,F) has its own Ts (N), giving them (N,...) """
+  F = len(t)
+  with np.errstate(all='ignore'):
+    E = np.exp(-t[None,:]/Ts[:,None]) # (G, F) or (N, F)
+    if PerRow:
+      E = E.reshape((len(Ts),)+(1,)*(Y.ndim-2)+(F,))
+      SumY, SumYE = np.sum(Y, axis=-1), np.sum(Y*E, axis=-1)
+      SumY2 = np.sum(Y**2, axis=-1)
+    else:
+      SumY, SumYE = np.sum(Y, axis=-1)[...,None], np.matmul(Y, E.T)
+      SumY2 = np.sum(Y**2, axis=-1)[...,None]
+    SumE, SumE2 = np.sum(E, axis=-1), np.sum(E**2, axis=-1)
+    # Normal equations of y = A - B*e: [[F, -SumE], [-SumE, SumE2]] [A, B] = [SumY, -SumYE]
+    Det = F*SumE2-SumE**2
+    A = (SumE2*SumY-SumE*SumYE)/Det
+    B = (SumE*SumY-F*SumYE)/Det
+    Residual = SumY2-(A*SumY-B*SumYE)
+  Residual[~np.isfinite(Residual)] = np.inf
+  return A, B, Residual
+
+
+def InitialEstimate(TT, S, Grid = TsGrid):
+  """ Closed form estimate of the parameters of every row of S, used as seed of the fit.
+  The polarity of the signal is restored assuming that the null point is just before or just after the minimum
+  sample. For a fixed Ts, A-B*exp(-TT/Ts) is linear in A and B, so they are solved by least squares for every Ts
+  of the Grid at once, and the Ts and the polarity with the lowest residual are chosen. c is set to 0 """
+  TT = np.asarray(TT, dtype=float)
+  S = np.asarray(S, dtype=float)
+  N = S.shape[0]
+  Order = np.argsort(TT)
+  t, S = TT[Order], S[:,Order]
+
+  A, B, Residual = LinearEstimate(t, RestorePolarity(S), Grid) # (N, 2 polarities, G)
+  Best = np.argmin(Residual.reshape(N,-1), axis=1)
+  p, g = np.unravel_index(Best, (2, len(Grid)))
+  n = np.arange(N)
+  return np.stack([A[n,p,g], B[n,p,g], Grid[g], np.zeros(N)], axis=1)
+
+
+def AmplitudeEstimate(TT, S, Ts):
+  """ Closed form A and B of every row of S for its own apparent relaxation time Ts (N), known e.g. from the fit of a
+  downsampled image, with the polarity of InitialEstimate. It returns the parameters (N,4), with c set to 0 """
+  TT = np.asarray(TT, dtype=float)
+  S = np.asarray(S, dtype=float)
+  N = S.shape[0]
+  Order = np.argsort(TT)
+  t, S = TT[Order], S[:,Order]
+  A, B, Residual = LinearEstimate(t, RestorePolarity(S), Ts, PerRow = True) # (N, 2 polarities)
+  p = np.argmin(Residual, axis=1)
+  n = np.arange(N)
+  return np.stack([A[n,p], B[n,p], Ts, np.zeros(N)], axis=1)
+
+
+def FitT1(TT, S, DeltaT, T1Seeds, T1Min = 40, T1Max = 3000, Jacobian = None, Initialize = True, ReturnIterations = False, Counters = None, Model = None):
+  """ Fit the T1 of every row of S trying the seeds of T1Seeds in order, as FitSignal does for one pixel.
+  With Initialize, the first seed of every pixel is its InitialEstimate and T1Seeds are only used when it fails.
+  Only the pixels whose fit failed or whose T1 is out of the interval (T1Min,T1Max) are fitted again with the next seed.
+  It returns the T1 (N) and the fitted parameters (N,4), both NaN where every seed failed, and with ReturnIterations
+  also the iterations of every pixel, summed over all the seeds tried.
+  Counters is an optional dict where the fits of FitCounters are counted. Model is a model of Models.Registry or its
+  name, by default the Look Locker signal, and Jacobian replaces the one of the model if it is given """
+  N = len(S)
+  T1 = np.full(N, np.nan)
+  Params = np.full((N,4), np.nan)
+  Iterations = np.zeros(N, dtype=int)
+  for Start in range(0, N, ChunkSize):
+    Stop = min(Start+ChunkSize, N)
+    T1[Start:Stop], Params[Start:Stop], Iterations[Start:Stop] = FitT1Chunk(TT, S[Start:Stop], DeltaT, T1Seeds, T1Min, T1Max, Jacobian, Initialize, Counters, Model)
+  if ReturnIterations:
+    return T1, Params, Iterations
+  return T1, Params
+
+
+def FitT1Chunk(TT, S, DeltaT, T1Seeds, T1Min, T1Max, Jacobian, Initialize, Counters = None, Model = None):
+  """ FitT1 of one chunk of pixels """
+  from . import Models # Models builds on the functions of this file
+  Model = Models.GetModel(Model)
+  S = np.asarray(S, dtype=float)
+  N = S.shape[0]
+  T1 = np.full(N, np.nan)
+  Params = np.full((N,4), np.nan)
+  Iterations = np.zeros(N, dtype=int)
+  Pending = np.arange(N)
+  Count = dict.fromkeys(FitCounters, 0)
+  for Seed, T1o in enumerate(([None] if Initialize else [])+list(T1Seeds)):
+    if len(Pending)==0:
+      break
+    with np.errstate(all='ignore'):
+      P0 = Model.InitialEstimate(TT, S[Pending]) if T1o is None else Model.Seed(S[Pending], T1o)
+    P, Converged, It = LevenbergMarquardt(TT, S[Pending], P0, Jacobian or Model.Jacobian, Function = Model.Signal)
+    Iterations[Pending] += It
+    with np.errstate(all='ignore'):
+      T1p = Model.T1(P, DeltaT)
+      Ok = Converged & np.isfinite(T1p) & (T1Min<T1p) & (T1p<T1Max)
+    T1[Pending[Ok]] = T1p[Ok]
+    Params[Pending[Ok], :P.shape[1]] = P[Ok]
+    Params[Pending[Ok], P.shape[1]:] = 0
+    Count['Fits'] += len(Pending)
+    Count['Seed retries'] += len(Pending) if Seed else 0
+    Count['Optimizer failures'] += int(np.count_nonzero(~Converged))
+    Count['Out of range'] += int(np.count_nonzero(Converged & ~Ok))
+    Pending = Pending[~Ok]
+  Count['Unfitted'] = len(Pending)
+  if Counters is not None:
+    for Name in FitCounters:
+      Counters[Name] = Counters.get(Name, 0)+Count[Name]
+  return T1, Params, Iterations
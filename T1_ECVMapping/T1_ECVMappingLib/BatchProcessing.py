@@ -0,0 +1,195 @@
+"""
+Headless T1 and ECV mapping of a cohort of studies.
+
+Run it with:
+
+  Slicer --no-main-window --python-script <path>/T1_ECVMappingLib/BatchProcessing.py Manifest.json OutputDirectory [--workers N] [--engine Batched] [--model "Look Locker"]
+
+The manifest is a JSON list of studies (or a dict with the list in "Studies"). Paths are relative to the manifest:
+
+  [{"Name": "Patient01",
+    "Native": "Patient01/LL_Native",          # DICOM folder or MultiVolume file of the Native Look Locker
+    "Enhanced": "Patient01/LL_Enhanced",      # DICOM folder or MultiVolume file of the Enhanced Look Locker
+    "Haematocrit": 42,                        # %
+    "NativeBloodT1": 1650, "EnhancedBloodT1": 450,  # ms, or
+    "BloodSegmentation": "Patient01/Blood.seg.nrrd", # the mean T1 inside its first segment is used
+    "Segmentation": "Patient01/Myocardium.seg.nrrd"  # optional, statistics of every segment
+  }]
+
+For every study a folder with the T1 Native, T1 Enhanced and ECV Map volumes and a Statistics.csv is written in the
+output directory, together with Timing.csv, Summary.json and Profile.jsonl (stage times and fit counters of the logic)
+for the whole cohort. No Qt widget is created.
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import logging
+import argparse
+import numpy as np
+import slicer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from T1_ECVMappingLib import ParallelFit, Models
+
+Stages = ['Load', 'Fit', 'ECV', 'Statistics', 'Save']
+
+
+def ReadManifest(Path):
+  """ Studies of the manifest with their paths made absolute """
+  with open(Path) as File:
+    Manifest = json.load(File)
+  Studies = Manifest['Studies'] if isinstance(Manifest, dict) else Manifest
+  Root = os.path.dirname(os.path.abspath(Path))
+  for Number, Study in enumerate(Studies):
+    Study.setdefault('Name', 'Study{:03d}'.format(Number+1))
+    for Key in ('Native', 'Enhanced', 'BloodSegmentation', 'Segmentation'):
+      if Study.get(Key):
+        Study[Key] = os.path.join(Root, Study[Key])
+  return Studies
+
+
+def LoadLookLocker(Path):
+  """ Load a Look Locker MultiVolume from a DICOM folder, imported in the current DICOM database, or from a file """
+  if not os.path.isdir(Path):
+    return slicer.util.loadNodeFromFile(Path, 'MultiVolumeFile')
+  from DICOMLib import DICOMUtils
+  DICOMUtils.importDicom(Path, slicer.dicomDatabase)
+  Folder = os.path.abspath(Path)+os.sep
+  FileLists = []
+  for Patient in slicer.dicomDatabase.patients():
+    for Study in slicer.dicomDatabase.studiesForPatient(Patient):
+      for Series in slicer.dicomDatabase.seriesForStudy(Study):
+        Files = list(slicer.dicomDatabase.filesForSeries(Series))
+        if Files and os.path.abspath(Files[0]).startswith(Folder): # The database can have the series of the other Look Locker
+          FileLists.append(Files)
+  Plugin = slicer.modules.dicomPlugins['MultiVolumeImporterPlugin']()
+  Loadables = sorted(Plugin.examine(FileLists), key=lambda Loadable: -Loadable.confidence)
+  if not Loadables:
+    raise ValueError('No Look Locker MultiVolume found in '+Path)
+  return Plugin.load(Loadables[0])
+
+
+def FitT1Mappings(Logics, LookLockers, T1Nodes):
+  """ Fit the T1 Mappings of a study. The ones of the Batched engine are fitted at the same time in the worker processes
+  when they are available, the other engines only run in this process """
+  Jobs = []
+  for Logic, LL, T1Node in zip(Logics, LookLockers, T1Nodes):
+    if ParallelFit.IsAvailable() and Logic.FitEngine() == 'Batched':
+      Jobs.append((Logic, Logic.StartRun(LL, Start = False), LL, T1Node))
+    else:
+      Logic.run(LL, T1Node)
+  ParallelFit.StartJobs([Job for _, Job, _, _ in Jobs])
+  for Logic, Job, LL, T1Node in Jobs:
+    Job.Wait()
+    Logic.FinishRun(Job, LL, T1Node)
+
+
+def ProcessStudy(Study, OutputDirectory, Workers, Engine, Model = Models.Default):
+  """ Create the T1 and ECV maps of a study and write them with its statistics. It returns the time of every stage """
+  from T1_ECVMapping import T1_ECVMappingLogic
+  Timing = {}
+  StudyDirectory = os.path.join(OutputDirectory, Study['Name'])
+  os.makedirs(StudyDirectory, exist_ok=True)
+
+  Start = time.time()
+  Modes = [Mode for Mode in ('Native', 'Enhanced') if Study.get(Mode)]
+  LookLockers = [LoadLookLocker(Study[Mode]) for Mode in Modes]
+  Timing['Load'] = time.time()-Start
+
+  Start = time.time()
+  Logics = [T1_ECVMappingLogic(Mode, Engine, Workers) for Mode in Modes]
+  for Logic in Logics:
+    Logic.model = Model
+  T1Nodes = [slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'T1 '+Mode) for Mode in Modes]
+  FitT1Mappings(Logics, LookLockers, T1Nodes)
+  Maps = dict(zip(Modes, T1Nodes))
+  Timing['Fit'] = time.time()-Start
+
+  Start = time.time()
+  Volumes = [Maps[Mode] for Mode in Modes]
+  if len(Maps) == 2 and 'Haematocrit' in Study:
+    if Study.get('BloodSegmentation'):
+      Blood = slicer.util.loadSegmentation(Study['BloodSegmentation'])
+      BloodT1 = []
+      for Mode in Modes:
+        _, Indices, _ = T1_ECVMappingLogic().GetSegmentIndices(Blood, Maps[Mode])
+        BloodT1.append(np.mean(slicer.util.arrayFromVolume(Maps[Mode]).ravel()[Indices[0]]))
+      Study['NativeBloodT1'], Study['EnhancedBloodT1'] = max(BloodT1), min(BloodT1)
+    ECVMapNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'ECV Map')
+    T1_ECVMappingLogic().CreateECVMap(Maps['Native'], Maps['Enhanced'], ECVMapNode, Study['Haematocrit'], Study['NativeBloodT1'], Study['EnhancedBloodT1'])
+    Volumes.append(ECVMapNode)
+  Timing['ECV'] = time.time()-Start
+
+  Start = time.time()
+  if Study.get('Segmentation'):
+    Segmentation = slicer.util.loadSegmentation(Study['Segmentation'])
+    Stats, _ = T1_ECVMappingLogic().GetSegmentStatistics(Segmentation, Volumes)
+    Keys = list(Stats) # The same columns as the table of the module, with the voxels, surface area and volume
+    with open(os.path.join(StudyDirectory, 'Statistics.csv'), 'w', newline='') as File:
+      Writer = csv.writer(File)
+      Writer.writerow(Keys)
+      Writer.writerows(zip(*[Stats[Key] for Key in Keys]))
+  Timing['Statistics'] = time.time()-Start
+
+  Start = time.time()
+  for Volume in Volumes:
+    slicer.util.saveNode(Volume, os.path.join(StudyDirectory, Volume.GetName()+'.nrrd'))
+  Timing['Save'] = time.time()-Start
+  return Timing
+
+
+def ProcessCohort(ManifestPath, OutputDirectory, Workers = 1, Engine = 'Batched', Model = Models.Default):
+  """ Process every study of the manifest. A failing study is reported and skipped. The stage times and counters of
+  the logic of every study are added to the summary and appended to Profile.jsonl """
+  from DICOMLib import DICOMUtils
+  from T1_ECVMapping import T1_ECVMappingLogic
+  os.makedirs(OutputDirectory, exist_ok=True)
+  T1_ECVMappingLogic.ProfileLog = os.path.join(OutputDirectory, 'Profile.jsonl')
+  Summary = []
+  for Study in ReadManifest(ManifestPath):
+    Start = time.time()
+    Result = {'Name': Study['Name']}
+    T1_ECVMappingLogic.Profile.Reset()
+    try:
+      with DICOMUtils.TemporaryDICOMDatabase(): # The DICOM tags of the study are read while it is open
+        Result['Timing'] = ProcessStudy(Study, OutputDirectory, Workers, Engine, Model)
+    except Exception as e:
+      logging.exception('Study {} failed'.format(Study['Name']))
+      Result['Error'] = str(e)
+    Result['Total'] = time.time()-Start
+    Result['Profile'] = T1_ECVMappingLogic.ReportProfile(Study = Study['Name'], Engine = Engine, Model = Model)
+    logging.info('Study {}: {:.1f} s'.format(Study['Name'], Result['Total']))
+    Summary.append(Result)
+    slicer.mrmlScene.Clear(0)
+    T1_ECVMappingLogic.ClearSegmentCache()
+
+  with open(os.path.join(OutputDirectory, 'Timing.csv'), 'w', newline='') as File:
+    Writer = csv.writer(File)
+    Writer.writerow(['Study']+Stages+['Total', 'Error'])
+    for Result in Summary:
+      Timing = Result.get('Timing', {})
+      Writer.writerow([Result['Name']]+[Timing.get(Stage, '') for Stage in Stages]+[Result['Total'], Result.get('Error', '')])
+  with open(os.path.join(OutputDirectory, 'Summary.json'), 'w') as File:
+    json.dump(Summary, File, indent=2)
+  ParallelFit.ShutdownPool()
+  return Summary
+
+
+def main(argv):
+  Parser = argparse.ArgumentParser(description='T1 and ECV mapping of a cohort of Look Locker studies')
+  Parser.add_argument('Manifest', help='JSON file with the studies')
+  Parser.add_argument('OutputDirectory')
+  Parser.add_argument('--workers', type=int, default=1, help='Worker processes used to fit the T1 Mappings, 1 (as in the module) fits them in the main process')
+  Parser.add_argument('--engine', default='Batched', choices=['Batched', 'Multiresolution', 'Dictionary', 'CurveFit'])
+  Parser.add_argument('--model', default=Models.Default, choices=list(Models.Registry), help='Signal model of the sequence')
+  Args = Parser.parse_args(argv)
+  Summary = ProcessCohort(Args.Manifest, Args.OutputDirectory, Args.workers, Args.engine, Args.model)
+  return int(any('Error' in Result for Result in Summary))
+
+
+if __name__ == '__main__':
+  logging.getLogger().setLevel(logging.INFO)
+  slicer.util.exit(main(sys.argv[1:]))
@@ -0,0 +1,220 @@
+import json
+import time
+import platform
+import numpy as np
+from . import BatchFit, Resample, ECV, Statistics
+
+#
+# Benchmarks of the fitting engine and of the T1 and ECV pipeline
+#
+# The pipeline suite runs on synthetic Look Locker phantoms of a short axis slice, with known T1 maps: the blood pool,
+# the myocardium around it and other tissue, surrounded by air. Every stage is timed and its throughput and accuracy
+# against the ground truth are reported, and the report can be saved as a JSON baseline and compared with a later run.
+#
+
+# Trigger times and T1 of the myocardium and blood pool usually found in each mode
+TriggerTimes = {'Native': np.array([110,190,270,1000,1080,1160,1900,1980,2060,2800,2880,2960.]),
+                'Enhanced': np.array([60,110,160,400,450,500,750,800,850,1100,1150,1200.])}
+T1Ranges = {'Native': (800,1800), 'Enhanced': (200,600)}
+
+# Phantom tissues: label and T1 (ms) in each mode. Label 0 is air, without signal
+Tissues = {'Myocardium': (1, {'Native': 1000, 'Enhanced': 450}),
+           'Blood': (2, {'Native': 1650, 'Enhanced': 300}),
+           'Tissue': (3, {'Native': 800, 'Enhanced': 400})}
+Haematocrit = 42
+PipelineStages = ['Fit Native', 'Fit Enhanced', 'Filter', 'Match', 'ECV', 'Statistics']
+
+
+def TriggerScheme(Inversions, FramesPerInversion, First, InversionSpacing, FrameSpacing):
+  """ Trigger times of a Look Locker acquisition with several inversions, every one followed by FramesPerInversion
+  frames. E.g. TriggerScheme(4, 3, 110, 890, 80) are the Native TriggerTimes """
+  return np.array([First+i*InversionSpacing+f*FrameSpacing for i in range(Inversions) for f in range(FramesPerInversion)], dtype=float)
+
+
+TriggerSchemes = {'Native': {'4x3': TriggerTimes['Native'], '3x5': TriggerScheme(3, 5, 110, 1150, 80)},
+                  'Enhanced': {'4x3': TriggerTimes['Enhanced'], '3x5': TriggerScheme(3, 5, 60, 450, 50)}}
+
+
+def SyntheticSignals(TT, N, T1Range = (300,1800), Efficiency = (1.6,2.0), Amplitude = (200,600), Noise = 8, DeltaT = 0, Seed = 0):
+  """ Magnitude Look Locker signals of N pixels with random T1, inversion efficiency (B/A) and amplitude A, plus gaussian noise.
+  It returns the signals (N,F) and their true T1 """
+  Rng = np.random.RandomState(Seed)
+  TT = np.asarray(TT, dtype=float)
+  T1 = Rng.uniform(T1Range[0], T1Range[1], N)
+  A = Rng.uniform(Amplitude[0], Amplitude[1], N)
+  Ratio = Rng.uniform(Efficiency[0], Efficiency[1], N)
+  Ts = T1/(Ratio-1)
+  B = A*Ratio*np.exp(-DeltaT/Ts)
+  P = np.stack([A, B, Ts, np.zeros(N)], axis=1)
+  S = np.abs(BatchFit.Signal(TT, P)+Rng.normal(0, Noise, (N,len(TT))))
+  return S, T1
+
+
+def CompareJacobians(TT, S, DeltaT = 0, T1Seeds = BatchFit.T1Seeds['Native'], T1Min = 40, T1Max = 3000):
+  """ Fit S with the numerical and with the analytic Jacobian. For each one it returns the wall time of FitT1,
+  and the mean number of iterations and the fraction of converged pixels of one Levenberg-Marquardt from InitialEstimate """
+  S = np.asarray(S, dtype=float)
+  P0 = BatchFit.InitialEstimate(TT, S)
+  Report = {}
+  for Name, Jacobian in (('Numerical', BatchFit.NumericalJacobian), ('Analytic', BatchFit.SignalJacobian)):
+    Start = time.time()
+    BatchFit.FitT1(TT, S, DeltaT, T1Seeds, T1Min, T1Max, Jacobian)
+    Time = time.time()-Start
+    _, Converged, Iterations = BatchFit.LevenbergMarquardt(TT, S, P0, Jacobian)
+    Report[Name] = {'Time': Time, 'Iterations': float(np.mean(Iterations)), 'Converged': float(np.mean(Converged))}
+  Report['Speedup'] = Report['Numerical']['Time']/max(Report['Analytic']['Time'], 1e-9)
+  return Report
+
+
+def PhantomLabels(Slices, Size):
+  """ Labels (Slices, Size, Size) of a short axis phantom: the blood pool disk in the center, the myocardium ring
+  around it and other tissue, inside a field of view of the same size for any matrix Size """
+  y, x = (np.mgrid[0:Size,0:Size]+0.5)/Size-0.5
+  r = np.hypot(x, y)
+  Labels = np.zeros((Size,Size), dtype=int)
+  Labels[r < 0.45] = Tissues['Tissue'][0]
+  Labels[r < 0.25] = Tissues['Myocardium'][0]
+  Labels[r < 0.15] = Tissues['Blood'][0]
+  return np.repeat(Labels[None], Slices, axis=0)
+
+
+def Phantom(Mode, Slices = 1, Size = 128, TT = None, Noise = 8, DeltaT = 0, Seed = 0):
+  """ Synthetic Look Locker array (Slices, Size, Size, Frames) of the phantom of PhantomLabels in this Mode, with
+  the signal model of BatchFit.Signal and gaussian noise of standard deviation Noise.
+  It returns the array, the true T1 map (0 in the air) and the labels """
+  TT = TriggerTimes[Mode] if TT is None else np.asarray(TT, dtype=float)
+  Labels = PhantomLabels(Slices, Size)
+  T1 = np.zeros(Labels.shape)
+  for Label, T1s in Tissues.values():
+    T1[Labels == Label] = T1s[Mode]
+  Rng = np.random.RandomState(Seed)
+  Inside = Labels > 0
+  A = np.where(Inside, Rng.uniform(300, 500, Labels.shape), 0)
+  Ratio = 1.9
+  Ts = np.where(Inside, T1, 1000)/(Ratio-1)
+  B = A*Ratio*np.exp(-DeltaT/Ts)
+  P = np.stack([A.ravel(), B.ravel(), Ts.ravel(), np.zeros(A.size)], axis=1)
+  S = BatchFit.Signal(TT, P).reshape(Labels.shape+(len(TT),))
+  return np.abs(S+Rng.normal(0, Noise, S.shape)), T1, Labels
+
+
+def PhantomIJKToRAS(Size, FieldOfView = 300, SliceThickness = 8):
+  """ IJK to RAS matrix of a phantom of matrix Size, all the sizes share the field of view """
+  Matrix = np.diag([FieldOfView/Size, FieldOfView/Size, SliceThickness, 1.0])
+  Matrix[:2,3] = -FieldOfView/2+FieldOfView/Size/2
+  return Matrix
+
+
+def T1Accuracy(T1, Truth, Mask):
+  """ Error of the T1 map (or any map) against the ground truth inside Mask. The pixels without value (NaN or 0) are
+  counted as failed and left out of the errors """
+  T1, Truth = T1[Mask], Truth[Mask]
+  Valid = np.isfinite(T1) & (T1 != 0)
+  Error = T1[Valid]-Truth[Valid]
+  if not Valid.any():
+    return {'Bias': None, 'MAE': None, 'RMSE': None, 'Within5%': 0.0, 'Failed': 1.0}
+  return {'Bias': float(np.mean(Error)), 'MAE': float(np.mean(np.abs(Error))), 'RMSE': float(np.sqrt(np.mean(Error**2))),
+          'Within5%': float(np.mean(np.abs(Error) <= 0.05*np.abs(Truth[Valid]))), 'Failed': float(1-np.mean(Valid))}
+
+
+def DefaultFit(Mode, TT, DeltaT, MvImg):
+  """ T1 map of the masked pixels of MvImg with BatchFit, the mask is the one of the logic """
+  T1 = np.zeros(MvImg.shape[:-1])
+  for k in range(MvImg.shape[0]):
+    Mask = MvImg[k,:,:,-1] > np.max(MvImg[k])/10
+    T1[k][Mask] = BatchFit.FitT1(TT, MvImg[k][Mask], DeltaT, BatchFit.T1Seeds[Mode])[0]
+  return T1
+
+
+def TimeStage(Report, Name, Pixels, Function, *Args):
+  """ Call Function(*Args), and add its wall time and its throughput (Pixels/s) to Report[Name] """
+  Start = time.perf_counter()
+  Result = Function(*Args)
+  Time = time.perf_counter()-Start
+  Report[Name] = {'Time': Time, 'Pixels': int(Pixels), 'PixelsPerSecond': Pixels/max(Time, 1e-9)}
+  return Result
+
+
+def RunPipeline(Size = 128, Noise = 8, Scheme = '4x3', Slices = 1, EnhancedScale = 0.75, Fit = DefaultFit, Filter = None, Seed = 0):
+  """ Run the whole pipeline on a pair of Native and Enhanced phantoms: fit both, filter the failed pixels, resample
+  the Enhanced map (EnhancedScale times the matrix Size) on the Native grid, compute the ECV map and the statistics of
+  the tissues. Fit(Mode, TT, DeltaT, MvImg) returns a T1 map and Filter(T1) the filtered one, so the engines of the
+  logic can be measured. It returns the times, throughputs and accuracies of every stage """
+  Report = {'Case': {'Size': Size, 'Noise': Noise, 'Scheme': Scheme, 'Slices': Slices, 'EnhancedScale': EnhancedScale}}
+  Sizes = {'Native': Size, 'Enhanced': max(int(round(Size*EnhancedScale)), 8)}
+  T1, Truth, Labels = {}, {}, {}
+  for Mode in ('Native', 'Enhanced'):
+    TT = TriggerSchemes[Mode][Scheme]
+    MvImg, Truth[Mode], Labels[Mode] = Phantom(Mode, Slices, Sizes[Mode], TT, Noise, Seed = Seed)
+    T1[Mode] = TimeStage(Report, 'Fit '+Mode, np.count_nonzero(Labels[Mode]), Fit, Mode, TT, 0, MvImg)
+    Report['Fit '+Mode]['Accuracy'] = T1Accuracy(T1[Mode], Truth[Mode], Labels[Mode] > 0)
+  if Filter is not None:
+    Filtered = {}
+    TimeStage(Report, 'Filter', T1['Native'].size+T1['Enhanced'].size, lambda: Filtered.update({Mode: Filter(T1[Mode]) for Mode in T1}))
+    T1 = Filtered
+
+  Enhanced, _ = TimeStage(Report, 'Match', T1['Native'].size, Resample.ResampleVolume, np.nan_to_num(T1['Enhanced']),
+                          PhantomIJKToRAS(Sizes['Enhanced']), PhantomIJKToRAS(Size), T1['Native'].shape)
+  Myocardium, Blood = Labels['Native'] == Tissues['Myocardium'][0], Labels['Native'] == Tissues['Blood'][0]
+  NT1B, ET1B = Tissues['Blood'][1]['Native'], Tissues['Blood'][1]['Enhanced']
+  EnhancedTruth = np.zeros(Truth['Native'].shape) # Both phantoms share the field of view, so the labels of the Native grid give it
+  for Label, T1s in Tissues.values():
+    EnhancedTruth[Labels['Native'] == Label] = T1s['Enhanced']
+  ECVTruth = ECV.ECVEngine()
+  ECVTruth.SetInputs(Truth['Native'], EnhancedTruth)
+  ECVTruth = ECVTruth.Compute(Haematocrit, NT1B, ET1B)
+  Engine = ECV.ECVEngine()
+  ECVMap = TimeStage(Report, 'ECV', T1['Native'].size, lambda: (Engine.SetInputs(T1['Native'], Enhanced), Engine.Compute(Haematocrit, NT1B, ET1B))[1])
+  Report['ECV']['Accuracy'] = T1Accuracy(ECVMap, ECVTruth, Myocardium)
+
+  Indices = [np.flatnonzero(Labels['Native'] == Label) for Label, _ in Tissues.values()]
+  Stats = TimeStage(Report, 'Statistics', sum(len(Index) for Index in Indices), Statistics.ComputeStatistics, Indices, [T1['Native'], Enhanced, ECVMap])
+  Report['Statistics']['Mean'] = {Name: [float(Map['Mean'][t]) for Map in Stats] for t, Name in enumerate(Tissues)}
+  return Report
+
+
+def RunSuite(Sizes = (96, 160), Noises = (4, 12), Schemes = ('4x3', '3x5'), Slices = 1, **Options):
+  """ RunPipeline for every combination of matrix size, noise and trigger time scheme. Options are passed to RunPipeline.
+  It returns the report of the suite, which SaveBaseline writes as JSON """
+  Cases = [RunPipeline(Size, Noise, Scheme, Slices, **Options) for Size in Sizes for Noise in Noises for Scheme in Schemes]
+  return {'Platform': {'Python': platform.python_version(), 'NumPy': np.__version__, 'Machine': platform.machine(),
+                       'Processor': platform.processor()},
+          'Date': time.strftime('%Y-%m-%d %H:%M:%S'), 'Cases': Cases}
+
+
+def CaseKey(Case):
+  return tuple(sorted(Case['Case'].items()))
+
+
+def SaveBaseline(Report, Path):
+  with open(Path, 'w') as File:
+    json.dump(Report, File, indent=2)
+
+
+def LoadBaseline(Path):
+  with open(Path) as File:
+    return json.load(File)
+
+
+def CompareBaseline(Report, Baseline, TimeTolerance = 0.25, AccuracyTolerance = 0.02, MinTime = 0.01):
+  """ Regressions of Report against the Baseline of the same cases: the stages more than TimeTolerance and MinTime s slower, and
+  the fits and ECV maps with a fraction of pixels within 5% or of failed pixels worse by more than AccuracyTolerance.
+  It returns a list of messages, empty if there isn't any regression """
+  Reference = {CaseKey(Case): Case for Case in Baseline['Cases']}
+  Regressions = []
+  for Case in Report['Cases']:
+    Base = Reference.get(CaseKey(Case))
+    if Base is None:
+      continue
+    Name = ', '.join('{}={}'.format(*Item) for Item in CaseKey(Case))
+    for Stage in PipelineStages:
+      if Stage not in Case or Stage not in Base:
+        continue
+      if Case[Stage]['Time'] > max(Base[Stage]['Time']*(1+TimeTolerance), Base[Stage]['Time']+MinTime):
+        Regressions.append('{} [{}]: {:.3f} s, baseline {:.3f} s'.format(Stage, Name, Case[Stage]['Time'], Base[Stage]['Time']))
+      if 'Accuracy' in Case[Stage] and 'Accuracy' in Base[Stage]:
+        New, Old = Case[Stage]['Accuracy'], Base[Stage]['Accuracy']
+        if New['Within5%'] < Old['Within5%']-AccuracyTolerance or New['Failed'] > Old['Failed']+AccuracyTolerance:
+          Regressions.append('{} [{}]: {:.1%} within 5% and {:.1%} failed, baseline {:.1%} and {:.1%}'.format(Stage, Name,
+                             New['Within5%'], New['Failed'], Old['Within5%'], Old['Failed']))
+  return Regressions
@@ -0,0 +1,60 @@
+import os
+import numpy as np
+
+#
+# Header-only, cached DICOM tag access
+#
+# The files are read with stop_before_pixels and only the tags requested, and the result is cached by SOPInstanceUID,
+# or by path and modification time for the files that aren't in the DICOM database, so asking again for the tags of a
+# series costs nothing.
+#
+
+TimingTags = ['SOPInstanceUID', 'InversionTime', 'TriggerTime']
+
+Cache = {}
+
+
+def ReadTags(Path, Tags = TimingTags, InstanceUID = None):
+  """ pydicom Dataset with only the Tags of the file, without reading the pixel data. InstanceUID is the SOPInstanceUID
+  of the file, if it is known (e.g. from the DICOM database), so the file isn't even looked up to find it in the cache """
+  Key = (InstanceUID, tuple(Tags)) if InstanceUID else (Path, os.path.getmtime(Path), tuple(Tags))
+  if Key not in Cache:
+    import pydicom # Only needed when a volume comes from DICOM, and slow to import
+    Cache[Key] = pydicom.dcmread(Path, stop_before_pixels=True, specific_tags=list(Tags))
+  return Cache[Key]
+
+
+def ClearCache():
+  Cache.clear()
+
+
+def FrameTriggerTimes(Paths, NumberOfFrames, InstanceUIDs = None):
+  """ Trigger time of every frame from the TriggerTime tag of all the instances of a MultiVolume, with their
+  SOPInstanceUIDs if they are known. The instances are sorted by trigger time and split in NumberOfFrames groups (one
+  per frame) at the largest gaps between them, and the mean of every group is returned. It returns None if the tags are
+  missing, or if the frames don't have the same number of instances """
+  if NumberOfFrames < 1 or len(Paths) % NumberOfFrames != 0:
+    return None
+  InstanceUIDs = InstanceUIDs or [None]*len(Paths)
+  try:
+    Times = np.sort([float(ReadTags(Path, InstanceUID = UID).TriggerTime) for Path, UID in zip(Paths, InstanceUIDs)])
+  except (AttributeError, TypeError, ValueError, OSError):
+    return None
+  Gaps = np.sort(np.argsort(np.diff(Times), kind='stable')[len(Times)-NumberOfFrames:])
+  Frames = np.split(Times, Gaps+1)
+  if any(len(Frame) != len(Paths)//NumberOfFrames for Frame in Frames):
+    return None
+  return np.array([Frame.mean() for Frame in Frames])
+
+
+def RefineFrameLabels(Labels, Paths, NumberOfFrames, Tolerance = 1.0, InstanceUIDs = None):
+  """ Replace missing (None) or rounded frame labels by the trigger times of the instances. The labels are kept when
+  they are not integers, or when the instances give times that differ from them more than a rounding (Tolerance ms) """
+  if Labels is not None and not np.all(np.mod(Labels, 1) == 0):
+    return Labels
+  Times = FrameTriggerTimes(Paths, NumberOfFrames, InstanceUIDs)
+  if Times is None:
+    return Labels
+  if Labels is None or np.all(np.abs(Times-np.asarray(Labels, dtype=float)) <= Tolerance):
+    return list(Times)
+  return Labels
@@ -0,0 +1,89 @@
+import collections
+import numpy as np
+from . import BatchFit
+
+#
+# Dictionary (look-up table) T1 estimation
+#
+# Every atom of the dictionary is the Look Locker signal of one (T1, inversion efficiency) pair, sampled at the trigger
+# times of the series. Atoms and pixel signals are normalized to zero mean and unit norm, so the match doesn't depend
+# on the scale A nor on the offset c, and the best atom of every pixel is the maximum of a matrix product.
+#
+
+T1GridSize = 300
+EfficiencyGrid = np.linspace(1.4, 2.0, 9) # B/A values, with the B of the T1 formula
+MatchBlock = 1024 # Pixels matched together, it bounds the size of the correlation matrix
+CacheSize = 8
+
+Cache = collections.OrderedDict()
+
+
+def Normalize(X):
+  """ Remove the mean of every row and scale it to unit norm. It returns the normalized rows, their means and norms """
+  Mean = np.mean(X, axis=1, keepdims=True)
+  X = X-Mean
+  Norm = np.linalg.norm(X, axis=1, keepdims=True)
+  with np.errstate(all='ignore'):
+    return X/Norm, Mean[:,0], Norm[:,0]
+
+
+def BuildDictionary(TT, DeltaT, T1Min, T1Max, GridSize = T1GridSize, Efficiency = EfficiencyGrid):
+  """ Compute the normalized atoms. It returns a dict with the atoms (float32, M x F), and the T1 and the
+  Signal parameters (A=1, B, Ts, c=0) of every atom """
+  TT = np.asarray(TT, dtype=float)
+  T1, Ratio = np.meshgrid(np.geomspace(T1Min, T1Max, GridSize), Efficiency, indexing='ij')
+  T1, Ratio = T1.ravel(), Ratio.ravel()
+  Ts = T1/(Ratio-1)
+  B = Ratio*np.exp(-DeltaT/Ts) # T1 is computed with B*exp(DeltaT/Ts)
+  P = np.stack([np.ones_like(T1), B, Ts, np.zeros_like(T1)], axis=1)
+  Atoms, Mean, Norm = Normalize(BatchFit.Signal(TT, P))
+  Valid = np.isfinite(Atoms).all(axis=1)
+  return {'Atoms': Atoms[Valid].astype(np.float32), 'T1': T1[Valid], 'Params': P[Valid], 'Mean': Mean[Valid], 'Norm': Norm[Valid]}
+
+
+def GetDictionary(TT, DeltaT, T1Min, T1Max, GridSize = T1GridSize):
+  """ Return the dictionary of these trigger times and DeltaT, computing it only if it isn't in the cache """
+  Key = (tuple(np.round(np.asarray(TT, dtype=float), 6)), round(float(DeltaT), 6), T1Min, T1Max, GridSize)
+  if Key in Cache:
+    Cache.move_to_end(Key)
+    return Cache[Key]
+  Cache[Key] = BuildDictionary(TT, DeltaT, T1Min, T1Max, GridSize)
+  while len(Cache) > CacheSize:
+    Cache.popitem(last=False)
+  return Cache[Key]
+
+
+def MatchT1(TT, S, DeltaT, T1Min = 40, T1Max = 3000, Refine = True, RefineIterations = 10):
+  """ T1 of every row of S from its best matching atom. With Refine the parameters of the atom are used as seed of a
+  short Levenberg-Marquardt fit, and the fitted T1 replaces the dictionary one when it converges inside (T1Min,T1Max).
+  It returns the T1 (N) and the parameters (N,4), NaN for the pixels without signal variation """
+  S = np.asarray(S, dtype=float)
+  N = S.shape[0]
+  D = GetDictionary(TT, DeltaT, T1Min, T1Max)
+  Sn, SMean, SNorm = Normalize(S)
+  Sn = Sn.astype(np.float32)
+  Best = np.zeros(N, dtype=int)
+  Corr = np.zeros(N, dtype=np.float32)
+  for Start in range(0, N, MatchBlock):
+    C = np.matmul(Sn[Start:Start+MatchBlock], D['Atoms'].T)
+    Best[Start:Start+MatchBlock] = np.argmax(C, axis=1)
+    Corr[Start:Start+MatchBlock] = np.max(C, axis=1)
+
+  Valid = np.isfinite(Corr) & (SNorm > 0)
+  T1 = np.where(Valid, D['T1'][Best], np.nan)
+  # Scale and offset of the atom that fit the pixel: S = a*Atom+c, with Atom = (Signal-Mean)/Norm and Signal(A=1,c=0)
+  a = Corr*SNorm/D['Norm'][Best]
+  Params = D['Params'][Best]*np.stack([a, a, np.ones(N), np.ones(N)], axis=1)
+  Params[:,3] = SMean-a*D['Mean'][Best]
+  Params[~Valid] = np.nan
+  if not Refine:
+    return T1, Params
+
+  Idx = np.flatnonzero(Valid)
+  P, Converged, _ = BatchFit.LevenbergMarquardt(TT, S[Idx], Params[Idx], MaxIter = RefineIterations)
+  with np.errstate(all='ignore'):
+    T1r = BatchFit.TsToT1(P[:,0], P[:,1]*np.exp(DeltaT/P[:,2]), P[:,2])
+    Ok = Converged & np.isfinite(T1r) & (T1Min<T1r) & (T1r<T1Max)
+  T1[Idx[Ok]] = T1r[Ok]
+  Params[Idx[Ok]] = P[Ok]
+  return T1, Params
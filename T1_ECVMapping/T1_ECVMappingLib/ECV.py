@@ -0,0 +1,54 @@
+import numpy as np
+
+#
+# ECV map from the T1 Native and Enhanced maps
+#
+# ECV = (1/T1E-1/T1N)*Factor, where only Factor depends on the Haematocrit and the T1 of the blood. The engine keeps the
+# difference map of the last pair of T1 maps, so a change of those values is a single scale of it in a preallocated
+# buffer, followed by setting to 0 the values outside [0,100] %.
+#
+
+Epsilon = 0.1 # Added to the T1 maps to avoid the division by zero of the pixels without T1
+
+
+def ECVFactor(Haematocrit, NT1B, ET1B):
+  """ Factor of the ECV formula, from the Haematocrit (%) and the T1 of the blood in the Native and Enhanced maps """
+  return (100-Haematocrit)*(NT1B*ET1B/(NT1B-ET1B))
+
+
+class ECVEngine():
+  """ ECV maps of one pair of matched T1 maps for any Haematocrit and blood T1. The maps are of type dtype """
+
+  def __init__(self, dtype = float):
+    self.dtype = np.dtype(dtype)
+    self.Key = None
+    self.Difference = None
+
+  def SetInputs(self, T1Native_Matrix, T1Enhanced_Matrix, Key = None):
+    """ Compute the difference map of the T1 maps. Key identifies the pair, the difference map isn't computed again if
+    it's the Key of the last pair. It returns True if the difference map was computed """
+    if Key is not None and Key == self.Key and self.Difference is not None:
+      return False
+    with np.errstate(all='ignore'):
+      Difference = np.add(T1Enhanced_Matrix, Epsilon, dtype=self.dtype)
+      np.reciprocal(Difference, out=Difference)
+      Native = np.add(T1Native_Matrix, Epsilon, dtype=self.dtype)
+      np.subtract(Difference, np.reciprocal(Native, out=Native), out=Difference)
+    self.Difference = np.nan_to_num(Difference, copy=False)
+    self.Outside = np.empty(self.Difference.shape, dtype=bool)
+    self.Buffer = np.empty(self.Difference.shape, dtype=bool)
+    self.Key = Key
+    return True
+
+  def Compute(self, Haematocrit, NT1B, ET1B, Out = None):
+    """ ECV map (%) of the Haematocrit and blood T1. It's written in Out when it's given (an array of the shape of the
+    difference map, e.g. the array of the ECV Map node), without allocating new arrays """
+    if Out is None:
+      Out = np.empty_like(self.Difference)
+    with np.errstate(all='ignore'):
+      np.multiply(self.Difference, ECVFactor(Haematocrit, NT1B, ET1B), out=Out)
+      np.less(Out, 0, out=self.Outside)
+      np.greater(Out, 100, out=self.Buffer)
+    np.logical_or(self.Outside, self.Buffer, out=self.Outside)
+    np.copyto(Out, 0, where=self.Outside)
+    return Out
@@ -0,0 +1,83 @@
+import json
+import time
+import functools
+import contextlib
+
+#
+# Wall time of the stages of the pipeline and counters of the fit
+#
+# A Recorder accumulates the calls and the time of every named stage, and counters such as the pixels fitted or the
+# seeds retried, until it is reset. Stages may be nested, the time of a stage includes the one of its inner stages.
+# The report is a dict that can be queried, logged or appended as a line of a JSON log.
+#
+
+
+class Recorder():
+  """ Stage times and counters. Stage is a context manager and Timed a decorator that time a stage """
+
+  def __init__(self):
+    self.Reset()
+
+  def Reset(self):
+    self.Stages = {}
+    self.Counters = {}
+    self.Start = time.time()
+
+  def Add(self, Name, Time):
+    """ Add one call of Time s to the stage Name """
+    Stage = self.Stages.setdefault(Name, {'Calls': 0, 'Time': 0.0, 'Max': 0.0})
+    Stage['Calls'] += 1
+    Stage['Time'] += Time
+    Stage['Max'] = max(Stage['Max'], Time)
+
+  @contextlib.contextmanager
+  def Stage(self, Name):
+    Start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.Add(Name, time.perf_counter()-Start)
+
+  def Timed(self, Name):
+    """ Decorator that records every call of the function as the stage Name """
+    def Decorator(Function):
+      @functools.wraps(Function)
+      def Wrapper(*Args, **Kwargs):
+        with self.Stage(Name):
+          return Function(*Args, **Kwargs)
+      return Wrapper
+    return Decorator
+
+  def Count(self, Name, N = 1):
+    self.Counters[Name] = self.Counters.get(Name, 0)+int(N)
+
+  def Merge(self, Counters):
+    """ Add the counters of a dict, e.g. the ones returned by a worker process """
+    for Name, N in Counters.items():
+      self.Count(Name, N)
+
+  def Query(self, Name):
+    """ The stage (dict with Calls, Time, Max and Mean) or the counter Name, None if it wasn't recorded """
+    if Name in self.Stages:
+      Stage = dict(self.Stages[Name])
+      Stage['Mean'] = Stage['Time']/Stage['Calls']
+      return Stage
+    return self.Counters.get(Name)
+
+  def Report(self):
+    """ Stages and counters recorded since the last Reset """
+    return {'Start': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.Start)), 'Elapsed': time.time()-self.Start,
+            'Stages': {Name: self.Query(Name) for Name in self.Stages}, 'Counters': dict(self.Counters)}
+
+  def Summary(self):
+    """ One line text of the report """
+    Stages = ', '.join('{} {:.3f} s'.format(Name, Stage['Time']) for Name, Stage in self.Stages.items())
+    Counters = ', '.join('{} {}'.format(Name, N) for Name, N in self.Counters.items())
+    return '; '.join(Part for Part in (Stages, Counters) if Part)
+
+  def Log(self, Path, **Context):
+    """ Append the report, with the Context items, as a line of the JSON log Path. It returns the report """
+    Report = dict(Context, **self.Report())
+    with open(Path, 'a') as File:
+      File.write(json.dumps(Report)+'\n')
+    return Report
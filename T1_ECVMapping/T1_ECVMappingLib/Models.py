@@ -0,0 +1,225 @@
+import collections
+import numpy as np
+from . import BatchFit
+
+#
+# Signal models of the T1 mapping sequences
+#
+# A model gives the signal of a pixel from its parameters, the analytic Jacobian, the closed form estimate and the
+# seeds of the parameters, and the T1 of the fitted parameters. All of them work on whole sets of pixels, as BatchFit
+# does, so every model registered is fitted by the same batched Levenberg-Marquardt of BatchFit.FitT1, in one or in
+# several processes. The parameters of a model are the first columns of the (N,4) parameter maps, the others are 0.
+#
+
+MaxParameters = 4 # Columns of the parameter maps
+Registry = collections.OrderedDict()
+
+
+def Register(Model):
+  """ Add the Model, an instance of a SignalModel subclass, to the registry under its Name, replacing the one with the
+  same name. The models used by ParallelFit must be defined in a module that the worker processes can import """
+  if not 0 < len(Model.Parameters) <= MaxParameters:
+    raise ValueError('The model {} must have between 1 and {} parameters'.format(Model.Name, MaxParameters))
+  Registry[Model.Name] = Model
+  return Model
+
+
+def GetModel(Model = None):
+  """ The registered model with the name Model, Model itself if it is already a model, or the default Look Locker model if it is None """
+  if Model is None:
+    return Registry[Default]
+  if isinstance(Model, SignalModel):
+    return Model
+  if Model not in Registry:
+    raise ValueError('Unknown signal model {}, the registered ones are {}'.format(Model, ', '.join(Registry)))
+  return Registry[Model]
+
+
+def Pad(P):
+  """ Parameters (N,n) of a model as rows of a parameter map (N,4) """
+  return np.concatenate([P, np.zeros((len(P), MaxParameters-P.shape[1]))], axis=1)
+
+
+class SignalModel():
+  """ Signal model of a sequence. Subclasses set Name and Parameters, the names of the columns of P, and implement
+  Signal, Jacobian, InitialEstimate, Seed, T1 and T1Gradient for the parameter matrices P (N, len(Parameters)) """
+  Name = ''
+  Parameters = []
+
+  def Signal(self, TT, P):
+    """ Signal (N,F) at the times TT of every row of P """
+    raise NotImplementedError
+
+  def Jacobian(self, TT, P, F = None):
+    """ Jacobian (N,F,len(Parameters)) of Signal. F is the signal already evaluated in P, if it is known """
+    raise NotImplementedError
+
+  def InitialEstimate(self, TT, S):
+    """ Closed form estimate of the parameters of every row of S, the first seed of the fit """
+    raise NotImplementedError
+
+  def Seed(self, S, T1o):
+    """ Seed of the parameters of every row of S for the T1 T1o, tried when the fit from the InitialEstimate fails """
+    raise NotImplementedError
+
+  def SeedFrom(self, TT, S, P):
+    """ Seed of every row of S from the parameters P of a similar signal, e.g. of its block in a downsampled image.
+    The models whose amplitudes are linear solve them for S, keeping the relaxation time of P """
+    return np.array(P, dtype=float)
+
+  def T1(self, P, DeltaT):
+    """ T1 of every row of P. DeltaT is the time from the preparation pulse to the first trigger time """
+    raise NotImplementedError
+
+  def T1Gradient(self, P, DeltaT):
+    """ Derivatives (N,len(Parameters)) of T1 with respect to the parameters, used by Quality.FitQuality """
+    raise NotImplementedError
+
+
+class LookLocker(SignalModel):
+  """ Inversion recovery read out with a Look Locker train, np.abs(A-B*np.exp(-TT/Ts))+c. The apparent relaxation
+  time Ts is corrected to T1 with BatchFit.TsToT1, as done since the first versions of the module """
+  Name = 'Look Locker'
+  Parameters = ['A', 'B', 'Ts', 'c']
+
+  def Signal(self, TT, P):
+    return BatchFit.Signal(TT, P)
+
+  def Jacobian(self, TT, P, F = None):
+    return BatchFit.SignalJacobian(TT, P, F)
+
+  def InitialEstimate(self, TT, S):
+    return BatchFit.InitialEstimate(TT, S)
+
+  def Seed(self, S, T1o):
+    Ao = np.max(S, axis=1)
+    Bo = 2*Ao
+    return np.stack([Ao, Bo, T1o/(Bo/Ao-1), np.zeros(len(S))], axis=1)
+
+  def SeedFrom(self, TT, S, P):
+    return BatchFit.AmplitudeEstimate(TT, S, P[:,2])
+
+  def T1(self, P, DeltaT):
+    A,B,Ts = P[:,0],P[:,1],P[:,2]
+    return BatchFit.TsToT1(A, B*np.exp(DeltaT/Ts), Ts)
+
+  def T1Gradient(self, P, DeltaT):
+    A,B,Ts = P[:,0],P[:,1],P[:,2]
+    E = np.exp(DeltaT/Ts)
+    return np.stack([-Ts*B*E/A**2, Ts*E/A, B*E/A*(1-DeltaT/Ts)-1, np.zeros(len(P))], axis=1)
+
+
+class MOLLI(SignalModel):
+  """ Three parameter MOLLI model np.abs(A-B*np.exp(-TT/Ts)), without offset, with TT the inversion times. T1 is
+  corrected with Ts*(B/A-1) (Messroghli et al., 2004), the trigger times already are the times from the inversion """
+  Name = 'MOLLI'
+  Parameters = ['A', 'B', 'Ts']
+
+  def Signal(self, TT, P):
+    A,B,Ts = P[:,0:1],P[:,1:2],P[:,2:3]
+    return np.abs(A-B*np.exp(-TT/Ts))
+
+  def Jacobian(self, TT, P, F = None):
+    return BatchFit.SignalJacobian(TT, P)[:,:,:3]
+
+  def InitialEstimate(self, TT, S):
+    return BatchFit.InitialEstimate(TT, S)[:,:3]
+
+  def Seed(self, S, T1o):
+    Ao = np.max(S, axis=1)
+    return np.stack([Ao, 2*Ao, np.full(len(S), float(T1o))], axis=1)
+
+  def SeedFrom(self, TT, S, P):
+    return BatchFit.AmplitudeEstimate(TT, S, P[:,2])[:,:3]
+
+  def T1(self, P, DeltaT):
+    return BatchFit.TsToT1(P[:,0], P[:,1], P[:,2])
+
+  def T1Gradient(self, P, DeltaT):
+    A,B,Ts = P[:,0],P[:,1],P[:,2]
+    return np.stack([-Ts*B/A**2, Ts/A, B/A-1], axis=1)
+
+
+class SaturationRecovery(SignalModel):
+  """ Three parameter saturation recovery, e.g. SASHA, A-B*np.exp(-TT/T1), with TT the times from the saturation pulse.
+  B/A is the efficiency of the saturation, 1 for a perfect one. There is no Look Locker correction, T1 is fitted directly """
+  Name = 'Saturation recovery'
+  Parameters = ['A', 'B', 'T1']
+
+  def Signal(self, TT, P):
+    A,B,T1 = P[:,0:1],P[:,1:2],P[:,2:3]
+    return A-B*np.exp(-TT/T1)
+
+  def Jacobian(self, TT, P, F = None):
+    B,T1 = P[:,1:2],P[:,2:3]
+    E = np.exp(-TT/T1)
+    return np.stack([np.ones_like(E), -E, -B*E*TT/T1**2], axis=2)
+
+  def InitialEstimate(self, TT, S):
+    TT = np.asarray(TT, dtype=float)
+    A, B, Residual = BatchFit.LinearEstimate(TT, np.asarray(S, dtype=float), BatchFit.TsGrid)
+    g = np.argmin(Residual, axis=1)
+    n = np.arange(len(S))
+    return np.stack([A[n,g], B[n,g], BatchFit.TsGrid[g]], axis=1)
+
+  def Seed(self, S, T1o):
+    Ao = np.max(S, axis=1)
+    return np.stack([Ao, Ao, np.full(len(S), float(T1o))], axis=1)
+
+  def SeedFrom(self, TT, S, P):
+    A, B, _ = BatchFit.LinearEstimate(np.asarray(TT, dtype=float), np.asarray(S, dtype=float), P[:,2], PerRow = True)
+    return np.stack([A, B, P[:,2]], axis=1)
+
+  def T1(self, P, DeltaT):
+    return P[:,2]
+
+  def T1Gradient(self, P, DeltaT):
+    return np.stack([np.zeros(len(P)), np.zeros(len(P)), np.ones(len(P))], axis=1)
+
+
+class TwoParameter(SignalModel):
+  """ Two parameter saturation recovery A*(1-np.exp(-TT/T1)), assuming a perfect saturation. It is more precise
+  than the three parameter one, but biased when the saturation is incomplete """
+  Name = 'Two parameter'
+  Parameters = ['A', 'T1']
+
+  def Signal(self, TT, P):
+    A,T1 = P[:,0:1],P[:,1:2]
+    return A*(1-np.exp(-TT/T1))
+
+  def Jacobian(self, TT, P, F = None):
+    A,T1 = P[:,0:1],P[:,1:2]
+    E = np.exp(-TT/T1)
+    return np.stack([1-E, -A*E*TT/T1**2], axis=2)
+
+  def InitialEstimate(self, TT, S):
+    # For a fixed T1 the signal is linear in A: A = S.g/g.g, with g = 1-exp(-TT/T1), for every T1 of the grid at once
+    TT = np.asarray(TT, dtype=float)
+    S = np.asarray(S, dtype=float)
+    G = 1-np.exp(-TT[None,:]/BatchFit.TsGrid[:,None]) # (G, F)
+    SumG2 = np.sum(G**2, axis=1)
+    SumSG = np.matmul(S, G.T) # (N, G)
+    Best = np.argmax(SumSG**2/SumG2, axis=1) # Lowest residual S.S-(S.g)^2/g.g
+    n = np.arange(len(S))
+    return np.stack([SumSG[n,Best]/SumG2[Best], BatchFit.TsGrid[Best]], axis=1)
+
+  def Seed(self, S, T1o):
+    return np.stack([np.max(S, axis=1), np.full(len(S), float(T1o))], axis=1)
+
+  def SeedFrom(self, TT, S, P):
+    G = 1-np.exp(-np.asarray(TT, dtype=float)[None,:]/P[:,1:2])
+    with np.errstate(all='ignore'):
+      return np.stack([np.sum(S*G, axis=1)/np.sum(G**2, axis=1), P[:,1]], axis=1)
+
+  def T1(self, P, DeltaT):
+    return P[:,1]
+
+  def T1Gradient(self, P, DeltaT):
+    return np.stack([np.zeros(len(P)), np.ones(len(P))], axis=1)
+
+
+Default = LookLocker.Name
+Register(LookLocker())
+Register(MOLLI())
+Register(SaturationRecovery())
+Register(TwoParameter())
@@ -0,0 +1,93 @@
+import numpy as np
+
+#
+# In-plane translation correction of the Look Locker frames
+#
+# Every frame of a slice is registered to a reference frame by phase correlation, all the frames of the slice at once
+# with one batched FFT. The contrast of the Look Locker frames changes with the inversion time, the blood and the
+# myocardium even swap their intensities near the null point, so the correlation uses the gradient magnitude of the
+# frames, whose edges are kept. The peak is refined to subpixel precision on each axis, and the frames are shifted in
+# the Fourier domain.
+#
+
+MaxShift = 0.2 # Largest shift accepted, fraction of the image size. Larger ones are taken as failures and not applied
+MinPeak = 0.02 # Smallest normalized correlation peak accepted
+
+
+def ReferenceFrame(Slice):
+  """ Frame with the highest mean signal of the slice (rows, columns, frames), the best recovered one """
+  return int(np.argmax(Slice.reshape(-1, Slice.shape[-1]).mean(axis=0)))
+
+
+def EdgeImages(Frames):
+  """ Gradient magnitude of every frame (frames, rows, columns), times a Hann window so the borders don't correlate """
+  Gy, Gx = np.gradient(np.asarray(Frames, dtype=float), axis=(1,2))
+  Rows, Columns = Frames.shape[1:]
+  return np.hypot(Gy, Gx)*np.outer(np.hanning(Rows), np.hanning(Columns))
+
+
+def SubpixelPeak(Values):
+  """ Subpixel offset of the peaks from the values (N,3) of the phase correlation before, at and after them. The peak of
+  a phase correlation is a sinc, so the ratio of the higher neighbour to the peak gives it (Foroosh et al., 2002) """
+  Left, Center, Right = Values.T
+  Side = np.where(Right > Left, 1, -1)
+  Neighbour = np.maximum(Left, Right)
+  with np.errstate(all='ignore'):
+    Offset = Side*Neighbour/(Neighbour+Center)
+  return np.clip(np.nan_to_num(Offset), -0.5, 0.5)
+
+
+def EstimateShifts(Slice, Reference = None):
+  """ Translation (rows, columns) of every frame of the slice (rows, columns, frames) with respect to the Reference
+  frame, by default ReferenceFrame. It returns the shifts (frames, 2), that ShiftFrames applies to align the frames with
+  the reference, and the height of the correlation peaks (frames). The shifts of the rejected peaks are 0 """
+  if Reference is None:
+    Reference = ReferenceFrame(Slice)
+  Frames = np.moveaxis(Slice, -1, 0)
+  N, Rows, Columns = Frames.shape
+  F = np.fft.rfft2(EdgeImages(Frames))
+  Cross = F[Reference]*np.conj(F)
+  Cross /= np.abs(Cross)+1e-12
+  Correlation = np.fft.irfft2(Cross, s=(Rows, Columns))
+
+  Peak = np.argmax(Correlation.reshape(N, -1), axis=1)
+  i, j = np.unravel_index(Peak, (Rows, Columns))
+  n = np.arange(N)
+  Height = Correlation[n, i, j]
+  di = SubpixelPeak(np.stack([Correlation[n, (i+d) % Rows, j] for d in (-1,0,1)], axis=1))
+  dj = SubpixelPeak(np.stack([Correlation[n, i, (j+d) % Columns] for d in (-1,0,1)], axis=1))
+  # The correlation is circular: the peaks after the middle are negative shifts
+  Shifts = np.stack([(i+Rows//2) % Rows-Rows//2+di, (j+Columns//2) % Columns-Columns//2+dj], axis=1)
+  Rejected = (Height < MinPeak) | np.any(np.abs(Shifts) > MaxShift*np.array([Rows, Columns]), axis=1)
+  Shifts[Rejected] = 0
+  Shifts[Reference] = 0
+  return Shifts, Height
+
+
+def ShiftFrames(Slice, Shifts):
+  """ Translate every frame of the slice (rows, columns, frames) by its shift (frames, 2) in the Fourier domain """
+  Rows, Columns = Slice.shape[:2]
+  if not np.any(Shifts):
+    return np.array(Slice, dtype=float)
+  u = np.fft.fftfreq(Rows)[None,:,None]
+  v = np.fft.rfftfreq(Columns)[None,None,:]
+  Phase = np.exp(-2j*np.pi*(u*Shifts[:,0,None,None]+v*Shifts[:,1,None,None]))
+  Frames = np.fft.irfft2(np.fft.rfft2(np.moveaxis(np.asarray(Slice, dtype=float), -1, 0))*Phase, s=(Rows, Columns))
+  return np.moveaxis(np.maximum(Frames, 0), 0, -1) # Magnitude images, the ringing below 0 is removed
+
+
+def CorrectVolume(MvImg, Reference = None, dtype = float):
+  """ Align the frames of every slice of the Look Locker array (slices, rows, columns, frames). It returns the
+  corrected array, of type dtype, the shifts (slices, frames, 2) and the correlation peaks (slices, frames) """
+  Corrected = np.empty(MvImg.shape, dtype=dtype)
+  Shifts = np.zeros((MvImg.shape[0], MvImg.shape[-1], 2))
+  Peaks = np.zeros((MvImg.shape[0], MvImg.shape[-1]))
+  for k in range(MvImg.shape[0]):
+    Shifts[k], Peaks[k] = EstimateShifts(MvImg[k], Reference)
+    Corrected[k] = ShiftFrames(MvImg[k], Shifts[k])
+  return Corrected, Shifts, Peaks
+
+
+def ShiftVolume(MvImg, Shifts):
+  """ Apply the shifts (slices, frames, 2) of CorrectVolume to the Look Locker array again """
+  return np.stack([ShiftFrames(MvImg[k], Shifts[k]) for k in range(MvImg.shape[0])])
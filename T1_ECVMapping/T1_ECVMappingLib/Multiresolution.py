@@ -0,0 +1,147 @@
+import numpy as np
+from . import BatchFit
+from . import Models
+
+#
+# Coarse to fine fitting of a slice
+#
+# The slice is first fitted at a lower resolution, averaging Factor x Factor blocks of pixels. Every pixel is seeded
+# with the relaxation time of its block and its own amplitudes, solved in closed form (SignalModel.SeedFrom), so the
+# grid search of the InitialEstimate is only done for the blocks and the fine fit starts next to the minimum. The
+# pixels whose fit fails are fitted again from the mean parameters of their converged neighbours, outward from the
+# converged pixels one ring at a time, and only the ones never reached go through the seeds of BatchFit.FitT1. Every
+# signal model of Models.Registry can be fitted this way.
+#
+
+Factor = 4
+NeighbourIterations = 50 # A fit from the neighbours converges quickly or not at all, the fallback seeds take the rest
+SeededIterations = 50 # Same for the fit from the block, it starts next to the minimum
+
+
+def Downsample(Slice, Mask, Factor = Factor):
+  """ Mean signal of the masked pixels of every Factor x Factor block of the slice (rows, columns, frames).
+  It returns the block signals (R,C,F) and the mask of the blocks with masked pixels """
+  Rows, Columns, Frames = Slice.shape
+  R, C = -(-Rows//Factor), -(-Columns//Factor)
+  Pad = ((0, R*Factor-Rows), (0, C*Factor-Columns))
+  Weights = np.pad(Mask, Pad).astype(float)
+  Sum = np.pad(Slice*Mask[:,:,None], Pad+((0,0),)).reshape(R, Factor, C, Factor, Frames).sum(axis=(1,3))
+  Count = Weights.reshape(R, Factor, C, Factor).sum(axis=(1,3))
+  Valid = Count > 0
+  Sum[Valid] /= Count[Valid][:,None]
+  return Sum, Valid
+
+
+def FitSeeds(TT, S, P0, DeltaT, T1Min, T1Max, MaxIter = BatchFit.MaxIterations, Model = None):
+  """ One Levenberg-Marquardt of the Model from the seeds P0 (N,4). It returns the T1, the parameters, the mask of the
+  pixels fitted inside (T1Min,T1Max) and the iterations """
+  Model = Models.GetModel(Model)
+  n = len(Model.Parameters)
+  T1 = np.full(len(S), np.nan)
+  Params = np.full((len(S),4), np.nan)
+  Iterations = np.zeros(len(S), dtype=int)
+  for Start in range(0, len(S), BatchFit.ChunkSize):
+    Chunk = slice(Start, Start+BatchFit.ChunkSize)
+    P, Converged, Iterations[Chunk] = BatchFit.LevenbergMarquardt(TT, S[Chunk], P0[Chunk,:n], Model.Jacobian, MaxIter, Function = Model.Signal)
+    with np.errstate(all='ignore'):
+      T1p = Model.T1(P, DeltaT)
+      Ok = Converged & np.isfinite(T1p) & (T1Min<T1p) & (T1p<T1Max)
+    T1[Chunk] = np.where(Ok, T1p, np.nan)
+    Params[Chunk] = np.where(Ok[:,None], Models.Pad(P), np.nan)
+  return T1, Params, np.isfinite(T1), Iterations
+
+
+def NeighbourSeeds(ParamsMap, Pixels):
+  """ Mean parameters of the fitted pixels of the 8-neighbourhood of every pixel of Pixels (I,J), NaN if none is fitted """
+  I, J = Pixels
+  Rows, Columns = ParamsMap.shape[:2]
+  Sum = np.zeros((len(I),4))
+  Count = np.zeros(len(I))
+  for di in (-1,0,1):
+    for dj in (-1,0,1):
+      if di == 0 and dj == 0:
+        continue
+      i, j = I+di, J+dj
+      Inside = (i>=0) & (i<Rows) & (j>=0) & (j<Columns)
+      P = np.full((len(I),4), np.nan)
+      P[Inside] = ParamsMap[i[Inside], j[Inside]]
+      Fitted = np.isfinite(P).all(axis=1)
+      Sum[Fitted] += P[Fitted]
+      Count += Fitted
+  with np.errstate(all='ignore'):
+    return Sum/Count[:,None]
+
+
+def Dilate(Map):
+  """ Pixels of the boolean Map (rows, columns) and their 8-neighbours """
+  Padded = np.pad(Map, 1)
+  Rows, Columns = Map.shape
+  return np.any([Padded[1+di:1+di+Rows, 1+dj:1+dj+Columns] for di in (-1,0,1) for dj in (-1,0,1)], axis=0)
+
+
+def FitFromNeighbours(TT, S, Pixels, Shape, T1, Params, Ok, Iterations, DeltaT, T1Min, T1Max, Model = None):
+  """ Fit the pixels (I,J) of a slice of Shape (rows, columns) that aren't Ok from the mean parameters of their Ok
+  neighbours, propagating outward: every round fits the pixels next to the ones that converged in the round before,
+  until none converges. A pixel that fails is tried again when another neighbour converges. T1, Params, Ok and Iterations
+  of the pixels are updated in place. It returns the number of pixels fitted and of rounds """
+  I, J = Pixels
+  ParamsMap = np.full(Shape+(4,), np.nan)
+  ParamsMap[I,J] = Params
+  Front = Ok.copy()
+  Fitted = Rounds = 0
+  while True:
+    FrontMap = np.zeros(Shape, dtype=bool)
+    FrontMap[I[Front], J[Front]] = True
+    Pending = np.flatnonzero(~Ok & Dilate(FrontMap)[I,J])
+    if len(Pending) == 0:
+      return Fitted, Rounds
+    Seeds = NeighbourSeeds(ParamsMap, (I[Pending], J[Pending]))
+    T1p, Pp, Okp, It = FitSeeds(TT, S[Pending], Seeds, DeltaT, T1Min, T1Max, NeighbourIterations, Model)
+    Iterations[Pending] += It
+    Converged = Pending[Okp]
+    T1[Converged], Params[Converged], Ok[Converged] = T1p[Okp], Pp[Okp], True
+    ParamsMap[I[Converged], J[Converged]] = Pp[Okp]
+    Front = np.zeros(len(I), dtype=bool)
+    Front[Converged] = True
+    Fitted += len(Converged)
+    Rounds += 1
+
+
+def FitSlice(TT, Slice, Mask, DeltaT, T1Seeds, T1Min = 40, T1Max = 3000, Factor = Factor, Counters = None, Model = None):
+  """ Fit the masked pixels of a slice (rows, columns, frames) from coarse to fine. It returns the T1 of the masked
+  pixels, in the order of np.nonzero(Mask), their parameters (N,4), their iterations in all the fine fits, and a dict
+  with the number of pixels fitted in each stage and the total iterations of the fine fits. The counters of the
+  BatchFit.FitT1 calls are added to the dict Counters if it is given. Model is the signal model, Look Locker by default """
+  Model = Models.GetModel(Model)
+  TT = np.asarray(TT, dtype=float)
+  I, J = np.nonzero(Mask)
+  S = np.asarray(Slice[I,J,:], dtype=float)
+  Report = {'Coarse': 0, 'Seeded': 0, 'Neighbours': 0, 'Rounds': 0, 'Fallback': 0, 'Iterations': 0}
+  if len(I) == 0:
+    return np.zeros(0), np.zeros((0,4)), np.zeros(0, dtype=int), Report
+
+  Coarse, CoarseMask = Downsample(Slice, Mask, Factor)
+  CoarseParams = np.full(Coarse.shape[:2]+(4,), np.nan)
+  CoarseParams[CoarseMask] = BatchFit.FitT1(TT, Coarse[CoarseMask], DeltaT, T1Seeds, T1Min, T1Max, Counters = Counters, Model = Model)[1]
+  Report['Coarse'] = int(np.count_nonzero(CoarseMask))
+
+  # Seed of every pixel: the relaxation time of its block with its own amplitudes, or its InitialEstimate if the block failed
+  n = len(Model.Parameters)
+  Blocks = CoarseParams[I//Factor, J//Factor, :n]
+  Seeded = np.all(np.isfinite(Blocks), axis=1)
+  P0 = np.empty((len(I),4))
+  P0[Seeded] = Models.Pad(Model.SeedFrom(TT, S[Seeded], Blocks[Seeded]))
+  if not np.all(Seeded):
+    P0[~Seeded] = Models.Pad(Model.InitialEstimate(TT, S[~Seeded]))
+  T1, Params, Ok, Iterations = FitSeeds(TT, S, P0, DeltaT, T1Min, T1Max, SeededIterations, Model)
+  Report['Seeded'] = int(np.count_nonzero(Ok))
+
+  Report['Neighbours'], Report['Rounds'] = FitFromNeighbours(TT, S, (I,J), Slice.shape[:2], T1, Params, Ok, Iterations, DeltaT, T1Min, T1Max, Model)
+
+  Pending = np.flatnonzero(~Ok)
+  if len(Pending):
+    T1[Pending], Params[Pending], It = BatchFit.FitT1(TT, S[Pending], DeltaT, T1Seeds, T1Min, T1Max, ReturnIterations = True, Counters = Counters, Model = Model)
+    Iterations[Pending] += It
+    Report['Fallback'] = len(Pending)
+  Report['Iterations'] = int(np.sum(Iterations))
+  return T1, Params, Iterations, Report
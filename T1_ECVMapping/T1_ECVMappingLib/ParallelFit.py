@@ -0,0 +1,204 @@
+import os
+import sys
+import multiprocessing
+import numpy as np
+from . import BatchFit
+
+#
+# Multi-process T1 fitting
+#
+# The Look Locker array, the mask and the output maps live in shared memory blocks. The workers only receive the
+# names of those blocks and the (slice, first pixel, last pixel) range to fit, so the 4D array is never pickled.
+# The ranges follow the chunks of BatchFit.FitT1, therefore the result is exactly the same as the serial fit.
+#
+
+try:
+  from multiprocessing import shared_memory
+except ImportError: # Python < 3.8
+  shared_memory = None
+
+Pool = None
+PoolWorkers = 0
+
+
+def IsAvailable():
+  """ True if this Python supports shared memory blocks """
+  return shared_memory is not None
+
+
+def GetPool(Workers):
+  """ Return the pool of worker processes, it is created the first time and reused while Workers doesn't change """
+  global Pool, PoolWorkers
+  if Pool is not None and PoolWorkers == Workers:
+    return Pool
+  ShutdownPool()
+  Context = multiprocessing.get_context('spawn')
+  # Inside Slicer sys.executable is the application, the workers must be started with its Python interpreter
+  PythonSlicer = os.path.join(os.path.dirname(sys.executable), 'PythonSlicer'+('.exe' if os.name=='nt' else ''))
+  if os.path.exists(PythonSlicer):
+    Context.set_executable(PythonSlicer)
+  Pool = Context.Pool(Workers)
+  PoolWorkers = Workers
+  return Pool
+
+
+def ShutdownPool():
+  """ Terminate the worker processes """
+  global Pool, PoolWorkers
+  if Pool is not None:
+    Pool.terminate()
+    Pool.join()
+  Pool = None
+  PoolWorkers = 0
+
+
+def CreateSharedArray(Shape, dtype):
+  """ Create a shared memory block and the numpy array that uses it """
+  dtype = np.dtype(dtype)
+  Shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(Shape))*dtype.itemsize, 1))
+  return Shm, np.ndarray(Shape, dtype=dtype, buffer=Shm.buf)
+
+
+def AttachSharedArray(Name, Shape, dtype):
+  """ Attach to a shared memory block created by another process """
+  Shm = shared_memory.SharedMemory(name=Name)
+  return Shm, np.ndarray(Shape, dtype=np.dtype(dtype), buffer=Shm.buf)
+
+
+def SplitTasks(Mask):
+  """ Split the masked pixels of every slice in the same chunks used by BatchFit.FitT1 """
+  Tasks = []
+  for k in range(Mask.shape[0]):
+    N = int(np.count_nonzero(Mask[k]))
+    for Start in range(0, N, BatchFit.ChunkSize):
+      Tasks.append((k, Start, min(Start+BatchFit.ChunkSize, N)))
+  return Tasks
+
+
+def FitTask(Args):
+  """ Worker function: fit the pixels Start:Stop of the slice k and write them in the shared output maps.
+  It returns the number of pixels and the counters of the fit, 0 pixels if the job was cancelled before the task started """
+  Blocks, Task, TT, DeltaT, T1Seeds, T1Min, T1Max, Model = Args
+  k, Start, Stop = Task
+  Shms = []
+  Arrays = {}
+  Counters = {}
+  try:
+    try:
+      for Key, Block in Blocks.items():
+        Shm, Arrays[Key] = AttachSharedArray(*Block)
+        Shms.append(Shm)
+    except FileNotFoundError: # The blocks were released by FitJob.Cancel
+      return 0, Counters
+    Index = np.flatnonzero(Arrays['Mask'][k])[Start:Stop]
+    S = Arrays['MvImg'][k].reshape(-1, Arrays['MvImg'].shape[-1])[Index]
+    T1, Params, Iterations = BatchFit.FitT1(TT, S, DeltaT, T1Seeds, T1Min, T1Max, ReturnIterations = True, Counters = Counters, Model = Model)
+    Arrays['T1'][k].reshape(-1)[Index] = T1
+    Arrays['Params'][k].reshape(-1,4)[Index] = Params
+    Arrays['Iterations'][k].reshape(-1)[Index] = Iterations
+  finally:
+    Arrays.clear() # The arrays must be released before closing their blocks
+    for Shm in Shms:
+      Shm.close()
+  return Stop-Start, Counters
+
+
+def FitT1Parallel(MvImg, Mask, TT, DeltaT, T1Seeds, T1Min, T1Max, Workers, dtype = float, Counters = None, Model = None):
+  """ Fit the masked pixels of the Look Locker array MvImg (slices, rows, columns, frames) using Workers processes.
+  It returns the T1 map, zero outside the mask, and the parameters map (slices, rows, columns, 4), both of type dtype,
+  and the map of the iterations of every pixel. The counters of the fit are added to the dict Counters if it is given.
+  Model is the signal model of BatchFit.FitT1 """
+  Job = FitJob(MvImg, Mask, TT, DeltaT, T1Seeds, T1Min, T1Max, Workers, dtype = dtype, Model = Model)
+  Maps = Job.Wait()
+  if Counters is not None:
+    for Name, N in Job.Counters().items():
+      Counters[Name] = Counters.get(Name, 0)+N
+  return Maps
+
+
+def StartJobs(Jobs):
+  """ Submit the tasks of several jobs created with Start = False alternately, so all of them progress at the same time """
+  for Position in range(max([len(Job.Args) for Job in Jobs]+[0])):
+    for Job in Jobs:
+      Job.Submit(Job.Args[Position:Position+1])
+
+
+class FitJob():
+  """ Fit running in the worker processes. It is started by the constructor and it doesn't block, so the caller
+  can poll FittedPixels and IsDone (e.g. from a Qt timer) and get the maps with Result when it finishes.
+  With Start = False the tasks aren't submitted until StartJobs is called. The maps are of type dtype.
+  Model is the signal model of BatchFit.FitT1, it is pickled with the tasks """
+
+  def __init__(self, MvImg, Mask, TT, DeltaT, T1Seeds, T1Min, T1Max, Workers, Start = True, dtype = float, Model = None):
+    Shape = MvImg.shape[:-1]
+    self.Shms = []
+    self.Arrays = {}
+    Blocks = {}
+    Specs = [('MvImg', MvImg.shape, MvImg.dtype, MvImg),
+             ('Mask', Mask.shape, Mask.dtype, Mask),
+             ('T1', Shape, np.dtype(dtype), 0),
+             ('Params', Shape+(4,), np.dtype(dtype), np.nan),
+             ('Iterations', Shape, np.dtype(np.int32), 0)]
+    try:
+      for Key, BlockShape, dtype, Init in Specs:
+        Shm, self.Arrays[Key] = CreateSharedArray(BlockShape, dtype)
+        self.Shms.append(Shm)
+        self.Arrays[Key][...] = Init
+        Blocks[Key] = (Shm.name, BlockShape, dtype.str)
+      TT = np.asarray(TT, dtype=float)
+      self.Pool = GetPool(Workers)
+      self.TotalPixels = int(np.count_nonzero(Mask))
+      self.Args = [(Blocks, Task, TT, DeltaT, list(T1Seeds), T1Min, T1Max, Model) for Task in SplitTasks(Mask)]
+      self.Tasks = []
+      if Start:
+        self.Submit(self.Args)
+    except:
+      self.Release()
+      raise
+
+  def Submit(self, Args):
+    self.Tasks.extend(self.Pool.apply_async(FitTask, (a,)) for a in Args)
+
+  def FittedPixels(self):
+    """ Number of pixels already fitted """
+    return sum(Task.get()[0] for Task in self.Tasks if Task.ready() and Task.successful())
+
+  def Counters(self):
+    """ Counters of BatchFit.FitT1 of the tasks already finished """
+    Counters = dict.fromkeys(BatchFit.FitCounters, 0)
+    for Task in self.Tasks:
+      if Task.ready() and Task.successful():
+        for Name, N in Task.get()[1].items():
+          Counters[Name] += N
+    return Counters
+
+  def IsDone(self):
+    return all(Task.ready() for Task in self.Tasks)
+
+  def Wait(self):
+    """ Block until the fit finishes and return its result """
+    for Task in self.Tasks:
+      Task.wait()
+    return self.Result()
+
+  def Result(self):
+    """ T1 map, parameters map and iterations map of a finished fit. It raises the exception of the first task that failed """
+    try:
+      for Task in self.Tasks:
+        Task.get()
+      return self.Arrays['T1'].copy(), self.Arrays['Params'].copy(), self.Arrays['Iterations'].copy()
+    finally:
+      self.Release()
+
+  def Cancel(self):
+    """ Abort the fit. Its shared memory blocks are released, so the tasks that haven't started return at once and the
+    running ones finish their chunk in memory that is already unlinked. The pool and the other jobs keep running """
+    self.Release()
+
+  def Release(self):
+    """ Free the shared memory blocks """
+    self.Arrays.clear() # The arrays must be released before closing their blocks
+    for Shm in self.Shms:
+      Shm.close()
+      Shm.unlink()
+    self.Shms = []
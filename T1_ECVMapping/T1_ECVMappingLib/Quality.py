@@ -0,0 +1,47 @@
+import numpy as np
+from . import BatchFit
+from . import Models
+
+#
+# Quality of the fitted pixels
+#
+# It is computed in bulk from the fitted parameters, without fitting again: one evaluation of the signal and of the
+# Jacobian per pixel gives the residual, and the covariance of the parameters s^2*(J'J)^-1, as curve_fit estimates it,
+# gives the standard deviation of the T1 by propagating it through the T1 of the signal model.
+#
+
+QualityKeys = ['T1 SD', 'RMS', 'R2']
+
+
+def FitQuality(TT, S, Params, DeltaT, Model = None):
+  """ Standard deviation of the T1, RMS of the residual and R2 of every row of S fitted with the parameters Params (N,4)
+  of the Model, by default the Look Locker signal. It returns a dict with an array (N) for each key of QualityKeys,
+  NaN for the pixels that weren't fitted. The T1 SD is inf where the parameters are undetermined (J'J is singular) """
+  Model = Models.GetModel(Model)
+  n = len(Model.Parameters)
+  TT = np.asarray(TT, dtype=float)
+  N, Frames = S.shape
+  Quality = {Key: np.full(N, np.nan) for Key in QualityKeys}
+  for Start in range(0, N, BatchFit.ChunkSize):
+    Chunk = slice(Start, Start+BatchFit.ChunkSize)
+    Sc = np.asarray(S[Chunk], dtype=float)
+    P = np.asarray(Params[Chunk], dtype=float)
+    Fitted = np.all(np.isfinite(P), axis=1)
+    Sc, P = Sc[Fitted], P[Fitted, :n]
+    Index = np.arange(Start, Start+len(Fitted))[Fitted]
+    with np.errstate(all='ignore'):
+      Residual = Sc-Model.Signal(TT, P)
+      RSS = np.sum(Residual**2, axis=1)
+      TSS = np.sum((Sc-np.mean(Sc, axis=1, keepdims=True))**2, axis=1)
+      Quality['RMS'][Index] = np.sqrt(RSS/Frames)
+      Quality['R2'][Index] = 1-RSS/TSS
+      Jac = Model.Jacobian(TT, P)
+      JTJ = np.einsum('nfi,nfj->nij', Jac, Jac)
+      Singular = ~np.all(np.isfinite(JTJ), axis=(1,2)) | (np.linalg.matrix_rank(np.nan_to_num(JTJ)) < n)
+      JTJ[Singular] = np.eye(n)
+      Covariance = np.linalg.inv(JTJ)*(RSS/max(Frames-n, 1))[:,None,None]
+      g = Model.T1Gradient(P, DeltaT)
+      SD = np.sqrt(np.abs(np.einsum('ni,nij,nj->n', g, Covariance, g)))
+    SD[Singular] = np.inf
+    Quality['T1 SD'][Index] = SD
+  return Quality
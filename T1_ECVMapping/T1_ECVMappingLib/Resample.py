@@ -0,0 +1,85 @@
+import collections
+import numpy as np
+
+#
+# Resampling of a volume on the grid of another one
+#
+# The IJK to RAS matrices of both volumes give the continuous source voxel of every target voxel. From them the flat
+# source indices and the interpolation weights of every target voxel are computed once and cached, so resampling
+# again with the same pair of geometries is a single gather and weighted sum.
+#
+
+Methods = ('linear', 'nearest')
+CacheSize = 8
+SnapTolerance = 1e-3 # Coordinates closer than this to a voxel center are moved to it, e.g. for coplanar slices
+
+Cache = collections.OrderedDict()
+
+
+def SourceCoordinates(SourceIJKToRAS, TargetIJKToRAS, TargetShape):
+  """ Continuous (k,j,i) array coordinates of the source for every voxel of the target array of TargetShape (K,J,I) """
+  M = np.linalg.inv(SourceIJKToRAS).dot(TargetIJKToRAS)
+  K, J, I = np.meshgrid(*[np.arange(n, dtype=float) for n in TargetShape], indexing='ij')
+  IJK = np.stack([I.ravel(), J.ravel(), K.ravel(), np.ones(I.size)])
+  I, J, K = M.dot(IJK)[:3]
+  Coordinates = np.stack([K, J, I], axis=1)
+  Nearest = np.round(Coordinates)
+  Snap = np.abs(Coordinates-Nearest) < SnapTolerance
+  Coordinates[Snap] = Nearest[Snap]
+  return Coordinates
+
+
+def ComputeIndexMap(SourceShape, SourceIJKToRAS, TargetIJKToRAS, TargetShape, Method = 'linear'):
+  """ Flat source indices (N,n) and weights (N,n) of every target voxel, n is 8 for linear and 1 for nearest, and
+  the mask (N) of the target voxels inside the source volume. A voxel is inside when it is within half a voxel of the
+  source voxel centers, near the borders the values of the closest voxels are used. A source with a single slice is
+  resampled in plane on the closest target slice, wherever it is along the normal, e.g. a single slice rescanned at
+  another position of the breath hold """
+  if Method not in Methods:
+    raise ValueError('Unknown interpolation method: {}'.format(Method))
+  SourceShape = np.array(SourceShape[:3])
+  Coordinates = SourceCoordinates(SourceIJKToRAS, TargetIJKToRAS, TargetShape)
+  if SourceShape[0] == 1:
+    Slices = Coordinates.reshape(TargetShape[0], -1, 3) # View of the coordinates of every target slice
+    Slices[np.argmin(np.mean(np.abs(Slices[:,:,0]), axis=1)),:,0] = 0
+  Inside = np.all((Coordinates >= -0.5) & (Coordinates <= SourceShape-0.5), axis=1)
+  Coordinates = np.clip(Coordinates, 0, SourceShape-1)
+  if Method == 'nearest':
+    Index = np.ravel_multi_index(tuple(np.round(Coordinates).astype(int).T), tuple(SourceShape))
+    return Index[:,None], np.ones((len(Index),1)), Inside
+
+  Lower = np.minimum(np.floor(Coordinates).astype(int), SourceShape-2).clip(0)
+  Fraction = Coordinates-Lower
+  Upper = np.minimum(Lower+1, SourceShape-1)
+  Index = np.zeros((len(Coordinates),8), dtype=int)
+  Weights = np.ones((len(Coordinates),8))
+  for Corner in range(8):
+    Ijk = []
+    for Axis in range(3):
+      High = (Corner >> Axis) & 1
+      Ijk.append(Upper[:,Axis] if High else Lower[:,Axis])
+      Weights[:,Corner] *= Fraction[:,Axis] if High else 1-Fraction[:,Axis]
+    Index[:,Corner] = np.ravel_multi_index(tuple(Ijk), tuple(SourceShape))
+  return Index, Weights, Inside
+
+
+def GetIndexMap(SourceShape, SourceIJKToRAS, TargetIJKToRAS, TargetShape, Method = 'linear'):
+  """ Return the index map of these geometries, computing it only if it isn't in the cache """
+  Key = (tuple(SourceShape[:3]), np.asarray(SourceIJKToRAS, dtype=float).tobytes(), np.asarray(TargetIJKToRAS, dtype=float).tobytes(),
+         tuple(TargetShape[:3]), Method)
+  if Key in Cache:
+    Cache.move_to_end(Key)
+    return Cache[Key]
+  Cache[Key] = ComputeIndexMap(SourceShape, SourceIJKToRAS, TargetIJKToRAS, TargetShape, Method)
+  while len(Cache) > CacheSize:
+    Cache.popitem(last=False)
+  return Cache[Key]
+
+
+def ResampleVolume(Source, SourceIJKToRAS, TargetIJKToRAS, TargetShape, Method = 'linear', Fill = 0):
+  """ Resample the (K,J,I) array Source on the target grid. The voxels outside the source are set to Fill.
+  It returns the resampled array and the mask of the target voxels inside the source """
+  Index, Weights, Inside = GetIndexMap(Source.shape, SourceIJKToRAS, TargetIJKToRAS, TargetShape, Method)
+  Values = np.asarray(Source, dtype=float).ravel()[Index]
+  Resampled = np.where(Inside, np.sum(Values*Weights, axis=1), Fill)
+  return Resampled.reshape(TargetShape[:3]), Inside.reshape(TargetShape[:3])
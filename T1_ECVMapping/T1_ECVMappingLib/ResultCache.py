@@ -0,0 +1,127 @@
+import os
+import glob
+import hashlib
+import numpy as np
+
+#
+# Persistent cache of fitted T1 maps
+#
+# Every entry is a compressed .npz file named after a hash of everything the fit depends on: the Look Locker voxels,
+# the trigger times, DeltaT, the mode and the fitting settings. Reading an entry touches its modification time, so
+# the eviction removes the least recently used entries first when the cache exceeds its size.
+#
+
+DefaultMaxBytes = 1024**3
+
+
+def ComputeKey(MvImg, TT, DeltaT, Mode, Settings):
+  """ Hash of the fit inputs. Settings is a dict with the fitting parameters that change the result """
+  Hash = hashlib.blake2b(digest_size=20)
+  MvImg = np.ascontiguousarray(MvImg)
+  Hash.update(repr((MvImg.shape, MvImg.dtype.str)).encode())
+  Hash.update(memoryview(MvImg).cast('B'))
+  Hash.update(np.ascontiguousarray(TT, dtype=float).tobytes())
+  Hash.update(repr((float(DeltaT), Mode, sorted(Settings.items()))).encode())
+  return Hash.hexdigest()
+
+
+class ResultCache():
+  """ Size bounded LRU cache of fitted maps stored in Directory """
+
+  def __init__(self, Directory, MaxBytes = DefaultMaxBytes):
+    self.Directory = Directory
+    self.MaxBytes = MaxBytes
+    self.Hits = 0
+    self.Misses = 0
+    os.makedirs(Directory, exist_ok=True)
+
+  def Path(self, Key):
+    return os.path.join(self.Directory, Key+'.npz')
+
+  def Get(self, Key):
+    """ Return the dict of arrays stored with Key, or None if it isn't in the cache """
+    Path = self.Path(Key)
+    try:
+      with np.load(Path) as Entry:
+        Arrays = {Name: Entry[Name] for Name in Entry.files}
+      os.utime(Path)
+    except (OSError, ValueError): # Missing, evicted or corrupted entry
+      self.Misses += 1
+      return None
+    self.Hits += 1
+    return Arrays
+
+  def Put(self, Key, **Arrays):
+    """ Store the arrays with Key and evict the least recently used entries if the cache is too big """
+    Path = self.Path(Key)
+    Temporary = Path+'.tmp.npz'
+    np.savez_compressed(Temporary, **Arrays)
+    os.replace(Temporary, Path) # Other processes never read a half written entry
+    self.Evict()
+
+  def Entries(self):
+    """ (modification time, size, path) of every entry, the least recently used first """
+    Entries = []
+    for Path in glob.glob(os.path.join(self.Directory, '*.npz')):
+      if Path.endswith('.tmp.npz'):
+        continue
+      try:
+        Stat = os.stat(Path)
+      except OSError:
+        continue
+      Entries.append((Stat.st_mtime, Stat.st_size, Path))
+    return sorted(Entries)
+
+  def Evict(self):
+    Entries = self.Entries()
+    Size = sum(Entry[1] for Entry in Entries)
+    for _, EntrySize, Path in Entries[:-1]: # The newest entry is always kept
+      if Size <= self.MaxBytes:
+        break
+      try:
+        os.remove(Path)
+      except OSError:
+        pass
+      Size -= EntrySize
+
+  def Clear(self):
+    for _, _, Path in self.Entries():
+      os.remove(Path)
+    self.Hits = 0
+    self.Misses = 0
+
+  def Statistics(self):
+    """ Number of entries, size on disk, size limit, and hits and misses of this session """
+    Entries = self.Entries()
+    return {'Entries': len(Entries), 'Bytes': sum(Entry[1] for Entry in Entries), 'MaxBytes': self.MaxBytes,
+            'Hits': self.Hits, 'Misses': self.Misses}
+
+
+class CachedJob():
+  """ Finished job with the maps restored from the cache. It has the interface of ParallelFit.FitJob """
+
+  def __init__(self, T1Map, ParamsMap, IterationsMap):
+    self.Maps = (T1Map, ParamsMap, IterationsMap)
+    self.TotalPixels = int(np.count_nonzero(np.isfinite(T1Map) & (T1Map != 0)))
+    self.Args = []
+
+  def Submit(self, Args):
+    pass
+
+  def FittedPixels(self):
+    return self.TotalPixels
+
+  def Counters(self):
+    return {}
+
+  def IsDone(self):
+    return True
+
+  def Wait(self):
+    return self.Result()
+
+  def Result(self):
+    return self.Maps
+
+  def Cancel(self):
+    pass
@@ -0,0 +1,49 @@
+import numpy as np
+
+#
+# Statistics of segments
+#
+# Every segment is given by the flat indices of its voxels in the arrays. The voxels of all the segments are gathered
+# once, and the statistics of every segment are computed at the same time: sums with bincount, and minimum, maximum and
+# median from the values sorted by segment.
+#
+
+StatisticsKeys = ['Mean', 'Standard Deviation', 'Minimum', 'Maximum', 'Median', 'Number of voxels']
+
+
+def SegmentLabels(Indices):
+  """ Concatenated voxel indices of the segments and the segment number of each one """
+  Counts = [len(Index) for Index in Indices]
+  Labels = np.repeat(np.arange(len(Indices)), Counts)
+  Voxels = np.concatenate(Indices).astype(int) if Indices else np.zeros(0, dtype=int)
+  return Voxels, Labels
+
+
+def ComputeStatistics(Indices, Arrays):
+  """ Statistics of the values of every array inside every segment, ignoring the NaN values. Indices is a list with the
+  flat voxel indices of each segment and Arrays a list of arrays of the same grid. It returns a list with a dict for
+  every array, with an array of the value of every segment for each key of StatisticsKeys (NaN for empty segments).
+  The standard deviation is the sample one, NaN for the segments with a single value """
+  Voxels, Labels = SegmentLabels(Indices)
+  NumberOfSegments = len(Indices)
+  Results = []
+  for Array in Arrays:
+    Values = np.asarray(Array).ravel()[Voxels].astype(float)
+    Finite = np.isfinite(Values)
+    L, V = Labels[Finite], Values[Finite]
+    Count = np.bincount(L, minlength=NumberOfSegments)
+    Valid = Count > 0
+    with np.errstate(all='ignore'):
+      Mean = np.bincount(L, V, minlength=NumberOfSegments)/Count
+      SD = np.sqrt(np.bincount(L, (V-Mean[L])**2, minlength=NumberOfSegments)/(Count-1)) # Sample SD, as Segment Statistics
+    SD[Count < 2] = np.nan
+    Sorted = V[np.lexsort((V, L))] # By segment, and by value inside each segment
+    Start = np.cumsum(Count)-Count
+    Minimum, Maximum, Median = [np.full(NumberOfSegments, np.nan) for _ in range(3)]
+    Start, N = Start[Valid], Count[Valid]
+    Minimum[Valid] = Sorted[Start]
+    Maximum[Valid] = Sorted[Start+N-1]
+    Median[Valid] = (Sorted[Start+(N-1)//2]+Sorted[Start+N//2])/2
+    Results.append({'Mean': Mean, 'Standard Deviation': SD, 'Minimum': Minimum, 'Maximum': Maximum, 'Median': Median,
+                    'Number of voxels': Count})
+  return Results
@@ -0,0 +1,91 @@
+import unittest
+import numpy as np
+
+import TestFixtures
+from T1_ECVMappingLib import BatchFit, Models, Quality
+
+
+class BatchFitTest(unittest.TestCase):
+  """ Batched Levenberg-Marquardt fit of the signal models, on noiseless signals whose T1 is known in closed form """
+
+  def test_ClosedForm(self):
+    """ The fitted T1 is the Look Locker corrected T1 of the signal, Ts*(B/A-1) """
+    for DeltaT in (0, 50):
+      with self.subTest(DeltaT=DeltaT):
+        P, Expected = TestFixtures.LookLockerParams(300, DeltaT)
+        T1, Params = BatchFit.FitT1(TestFixtures.TriggerTimes, BatchFit.Signal(TestFixtures.TriggerTimes, P), DeltaT, TestFixtures.T1Seeds)
+        np.testing.assert_allclose(T1, Expected, rtol=1e-8)
+        np.testing.assert_allclose(Params[:,2], P[:,2], rtol=1e-8)
+
+  def test_Chunks(self):
+    """ The chunks are fitted independently, their size doesn't change the result """
+    S, _ = TestFixtures.LookLockerSignals(300, Noise = 8)
+    T1, Params = BatchFit.FitT1(TestFixtures.TriggerTimes, S, 0, TestFixtures.T1Seeds)
+    ChunkSize = BatchFit.ChunkSize
+    try:
+      BatchFit.ChunkSize = 64
+      T1Chunks, ParamsChunks = BatchFit.FitT1(TestFixtures.TriggerTimes, S, 0, TestFixtures.T1Seeds)
+    finally:
+      BatchFit.ChunkSize = ChunkSize
+    np.testing.assert_array_equal(T1Chunks, T1)
+    np.testing.assert_array_equal(ParamsChunks, Params)
+
+  def test_Jacobian(self):
+    P, _ = TestFixtures.LookLockerParams(300)
+    Jacobian = BatchFit.SignalJacobian(TestFixtures.TriggerTimes, P)
+    Numerical = BatchFit.NumericalJacobian(TestFixtures.TriggerTimes, P, BatchFit.Signal(TestFixtures.TriggerTimes, P))
+    np.testing.assert_allclose(Jacobian, Numerical, atol=1e-6*np.abs(Jacobian).max())
+
+  def test_InitialEstimate(self):
+    """ The closed form estimate of a noiseless signal is within a step of the Ts grid, with both polarities restored """
+    P, _ = TestFixtures.LookLockerParams(300)
+    Estimate = BatchFit.InitialEstimate(TestFixtures.TriggerTimes, BatchFit.Signal(TestFixtures.TriggerTimes, P))
+    Step = BatchFit.TsGrid[1]/BatchFit.TsGrid[0]
+    self.assertTrue(np.all(np.abs(np.log(Estimate[:,2]/P[:,2])) < np.log(Step)))
+
+  def test_LinearEstimate(self):
+    """ The amplitudes solved for a Ts of every row are the ones solved for the same Ts in the grid """
+    S, _ = TestFixtures.LookLockerSignals(12, Noise = 8)
+    Grid = BatchFit.TsGrid[:12]
+    A, B, Residual = BatchFit.LinearEstimate(TestFixtures.TriggerTimes, S, Grid)
+    Row = BatchFit.LinearEstimate(TestFixtures.TriggerTimes, S, Grid, PerRow = True)
+    for Expected, Actual in zip((A, B, Residual), Row):
+      np.testing.assert_allclose(Actual, np.diagonal(Expected), rtol=1e-10)
+
+  def test_Seeds(self):
+    """ The pixels whose T1 is out of the interval are fitted again with the next seeds, and are NaN if every seed fails """
+    S, _ = TestFixtures.LookLockerSignals(50)
+    T1, Params = BatchFit.FitT1(TestFixtures.TriggerTimes, S, 0, TestFixtures.T1Seeds, T1Min = 40, T1Max = 100)
+    self.assertTrue(np.all(np.isnan(T1)))
+    self.assertTrue(np.all(np.isnan(Params)))
+
+  def test_Models(self):
+    """ Every registered model recovers the T1 of its own noiseless signal """
+    P, T1 = TestFixtures.LookLockerParams(300)
+    A, Saturation = P[:,0], np.linspace(100, 3000, 12)
+    Params = {'Look Locker': (TestFixtures.TriggerTimes, P),
+              'MOLLI': (TestFixtures.TriggerTimes, P[:,:3]),
+              'Saturation recovery': (Saturation, np.stack([A, 0.95*A, T1], axis=1)),
+              'Two parameter': (Saturation, np.stack([A, T1], axis=1))}
+    for Name, Model in Models.Registry.items():
+      with self.subTest(Model=Name):
+        TT, ModelParams = Params[Name]
+        Fitted, _ = BatchFit.FitT1(TT, Model.Signal(TT, ModelParams), 0, TestFixtures.T1Seeds, Model=Name)
+        np.testing.assert_allclose(Fitted, Model.T1(ModelParams, 0), rtol=1e-8)
+
+  def test_Quality(self):
+    """ A perfect fit has no residual and R2 of 1, and the pixels that weren't fitted are NaN """
+    P, _ = TestFixtures.LookLockerParams(300)
+    S = BatchFit.Signal(TestFixtures.TriggerTimes, P)
+    P[:10] = np.nan
+    Maps = Quality.FitQuality(TestFixtures.TriggerTimes, S, P, 0)
+    self.assertEqual(set(Maps), set(Quality.QualityKeys))
+    for Key in Quality.QualityKeys:
+      self.assertTrue(np.all(np.isnan(Maps[Key][:10])), Key)
+    np.testing.assert_allclose(Maps['RMS'][10:], 0, atol=1e-6)
+    np.testing.assert_allclose(Maps['R2'][10:], 1, atol=1e-12)
+    self.assertTrue(np.all(np.isfinite(Maps['T1 SD'][10:])))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,67 @@
+import copy
+import os
+import tempfile
+import unittest
+import numpy as np
+
+import TestFixtures # Makes T1_ECVMappingLib importable
+from T1_ECVMappingLib import Benchmark
+
+
+class BenchmarkTest(unittest.TestCase):
+  """ Benchmark suite on small synthetic phantoms, and the regressions found against a saved baseline """
+
+  @classmethod
+  def setUpClass(cls):
+    cls.Report = Benchmark.RunSuite(Sizes = (32,), Noises = (4,), Schemes = ('4x3',))
+
+  def test_Report(self):
+    Case = self.Report['Cases'][0]
+    for Stage in Benchmark.PipelineStages:
+      if Stage != 'Filter': # Only timed with a Filter
+        self.assertGreater(Case[Stage]['Time'], 0, Stage)
+    self.assertGreater(Case['Fit Native']['Accuracy']['Within5%'], 0.9)
+    self.assertLess(Case['Fit Native']['Accuracy']['Failed'], 0.05)
+
+  def test_SaveLoad(self):
+    """ A saved baseline is loaded back without regressions against its own report """
+    with tempfile.TemporaryDirectory() as Folder:
+      Path = os.path.join(Folder, 'Baseline.json')
+      Benchmark.SaveBaseline(self.Report, Path)
+      Baseline = Benchmark.LoadBaseline(Path)
+    self.assertEqual(Baseline['Cases'][0]['Case'], self.Report['Cases'][0]['Case'])
+    self.assertEqual(Benchmark.CompareBaseline(self.Report, Baseline), [])
+
+  def test_TimeRegression(self):
+    """ A stage is a regression when it's slower than the baseline by more than the tolerance and MinTime """
+    Baseline = copy.deepcopy(self.Report)
+    Baseline['Cases'][0]['ECV']['Time'] /= 2
+    Regressions = Benchmark.CompareBaseline(self.Report, Baseline, MinTime = 0)
+    self.assertEqual(len(Regressions), 1)
+    self.assertTrue(Regressions[0].startswith('ECV ['))
+    self.assertEqual(Benchmark.CompareBaseline(self.Report, Baseline, MinTime = 10), [])
+
+  def test_AccuracyRegression(self):
+    Baseline = copy.deepcopy(self.Report)
+    Baseline['Cases'][0]['Fit Native']['Accuracy']['Within5%'] += 0.1
+    Regressions = Benchmark.CompareBaseline(self.Report, Baseline, TimeTolerance = np.inf)
+    self.assertEqual(len(Regressions), 1)
+    self.assertTrue(Regressions[0].startswith('Fit Native ['))
+
+  def test_OtherCases(self):
+    """ The cases that aren't in the baseline are not compared """
+    Baseline = copy.deepcopy(self.Report)
+    Baseline['Cases'][0]['Case']['Size'] = 64
+    Baseline['Cases'][0]['ECV']['Time'] = 0
+    self.assertEqual(Benchmark.CompareBaseline(self.Report, Baseline, MinTime = 0), [])
+
+  def test_CompareJacobians(self):
+    S, _ = TestFixtures.LookLockerSignals(500, Noise = 8)
+    Report = Benchmark.CompareJacobians(TestFixtures.TriggerTimes, S)
+    for Name in ('Numerical', 'Analytic'):
+      self.assertGreater(Report[Name]['Converged'], 0.9, Name)
+    self.assertGreater(Report['Speedup'], 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,53 @@
+import types
+import unittest
+from unittest import mock
+import numpy as np
+
+import TestFixtures # Makes T1_ECVMappingLib importable
+from T1_ECVMappingLib import DicomMetadata
+
+
+class DicomMetadataTest(unittest.TestCase):
+  """ Frame trigger times from the TriggerTime of the instances, read through a fake ReadTags """
+
+  def FrameTimes(self, Times, NumberOfFrames):
+    Tags = {str(i): types.SimpleNamespace(TriggerTime=Time) for i, Time in enumerate(Times)}
+    with mock.patch.object(DicomMetadata, 'ReadTags', lambda Path, InstanceUID = None: Tags[InstanceUID]):
+      return DicomMetadata.FrameTriggerTimes(list(Tags), NumberOfFrames, InstanceUIDs = list(Tags))
+
+  def test_Frames(self):
+    """ Two slices per frame, with the trigger times of the slices a few ms apart """
+    np.testing.assert_allclose(self.FrameTimes([100, 102, 1100, 1101, 2100, 2104], 3), [101, 1100.5, 2102])
+
+  def test_UnequalFrames(self):
+    """ 6 instances in 3 frames, but 3 of them in the first frame """
+    self.assertIsNone(self.FrameTimes([100, 102, 103, 1100, 2100, 2104], 3))
+    self.assertIsNone(self.FrameTimes([100, 1100, 2100, 3100], 3))
+
+  def test_MissingTag(self):
+    self.assertIsNone(self.FrameTimes([100, None], 2))
+
+  def test_Labels(self):
+    """ Rounded labels are refined, and labels that are not integers are kept """
+    Tags = {'1': types.SimpleNamespace(TriggerTime=100.4), '2': types.SimpleNamespace(TriggerTime=1099.8)}
+    with mock.patch.object(DicomMetadata, 'ReadTags', lambda Path, InstanceUID = None: Tags[InstanceUID]):
+      Labels = DicomMetadata.RefineFrameLabels(np.array([100., 1100.]), list(Tags), 2, InstanceUIDs = list(Tags))
+      np.testing.assert_allclose(Labels, [100.4, 1099.8])
+      Labels = np.array([100.5, 1100.])
+      self.assertIs(DicomMetadata.RefineFrameLabels(Labels, list(Tags), 2, InstanceUIDs = list(Tags)), Labels)
+
+  def test_CacheKey(self):
+    """ The tags of an instance of the DICOM database are cached by SOPInstanceUID, not by path """
+    Reads = []
+    def dcmread(Path, **Options):
+      Reads.append(Path)
+      return types.SimpleNamespace(TriggerTime=100)
+    with mock.patch.dict('sys.modules', pydicom=types.SimpleNamespace(dcmread=dcmread)), \
+        mock.patch.dict(DicomMetadata.Cache, clear=True):
+      DicomMetadata.ReadTags('/no/such/file.dcm', InstanceUID = '1.2.3')
+      DicomMetadata.ReadTags('/moved/file.dcm', InstanceUID = '1.2.3')
+    self.assertEqual(Reads, ['/no/such/file.dcm'])
+
+
+if __name__ == '__main__':
+  unittest.main()
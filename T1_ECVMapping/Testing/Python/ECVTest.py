@@ -0,0 +1,55 @@
+import unittest
+import numpy as np
+
+import TestFixtures # Makes T1_ECVMappingLib importable
+from T1_ECVMappingLib import ECV
+
+
+class ECVTest(unittest.TestCase):
+  """ ECV maps of the ECVEngine against the formula (100-Hct)*(1/T1E-1/T1N)/(1/T1E blood-1/T1N blood) """
+
+  def setUp(self):
+    self.Native = np.array([[1000., 1200.], [1600., 0.]])
+    self.Enhanced = np.array([[450., 500.], [300., 0.]])
+    self.Engine = ECV.ECVEngine()
+    self.Engine.SetInputs(self.Native, self.Enhanced)
+
+  def Expected(self, Haematocrit, NT1B, ET1B):
+    T1N, T1E = self.Native+ECV.Epsilon, self.Enhanced+ECV.Epsilon
+    ECVMap = (100-Haematocrit)*(1/T1E-1/T1N)/(1/ET1B-1/NT1B)
+    return np.where((ECVMap < 0) | (ECVMap > 100), 0, ECVMap)
+
+  def test_KnownValues(self):
+    ECVMap = self.Engine.Compute(42, 1600, 300)
+    np.testing.assert_allclose(ECVMap, self.Expected(42, 1600, 300))
+    self.assertAlmostEqual(ECVMap[1,1], 0) # No T1
+    self.assertAlmostEqual(ECVMap[1,0], 58, delta=0.05) # Same T1 as the blood, 100-Haematocrit but for Epsilon
+
+  def test_Outside(self):
+    """ The values out of [0,100] % are 0 """
+    Engine = ECV.ECVEngine()
+    Engine.SetInputs(np.array([400., 1000.]), np.array([900., 100.]))
+    np.testing.assert_array_equal(Engine.Compute(42, 1600, 300), 0)
+
+  def test_Key(self):
+    """ The difference map is kept while the Key doesn't change, and Out is filled in place """
+    self.assertTrue(self.Engine.SetInputs(self.Native, self.Enhanced, Key = 1))
+    self.assertFalse(self.Engine.SetInputs(2*self.Native, self.Enhanced, Key = 1))
+    Out = np.empty(self.Native.shape)
+    self.assertIs(self.Engine.Compute(45, 1700, 350, Out = Out), Out)
+    np.testing.assert_allclose(Out, self.Expected(45, 1700, 350))
+
+  def test_Float32(self):
+    """ A float32 engine fills a float32 Out, e.g. the image of the ECV node in the low memory mode """
+    Engine = ECV.ECVEngine(np.float32)
+    Engine.SetInputs(self.Native, self.Enhanced)
+    Out = np.empty(self.Native.shape, dtype=np.float32)
+    self.assertIs(Engine.Compute(45, 1700, 350, Out = Out), Out)
+    np.testing.assert_allclose(Out, self.Expected(45, 1700, 350), rtol=1e-5)
+
+  def test_Factor(self):
+    self.assertAlmostEqual(ECV.ECVFactor(40, 1600, 400), 60*1600*400/1200)
+
+
+if __name__ == '__main__':
+  unittest.main()
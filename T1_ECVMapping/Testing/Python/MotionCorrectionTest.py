@@ -0,0 +1,43 @@
+import unittest
+import numpy as np
+
+import TestFixtures # Makes T1_ECVMappingLib importable
+from T1_ECVMappingLib import MotionCorrection
+
+
+class MotionCorrectionTest(unittest.TestCase):
+  """ Recovery of known translations of the frames of a slice whose contrast changes from frame to frame """
+
+  def setUp(self):
+    y, x = np.mgrid[:64, :64]
+    Image = sum(a*np.exp(-((y-cy)**2+(x-cx)**2)/(2*s**2)) for a, cy, cx, s in [(300,30,28,6), (150,20,40,4), (200,44,36,5)])
+    self.Contrast = np.array([1.0, 0.6, 0.3, 0.8, 1.2, 0.9])
+    self.Slice = Image[:,:,None]*self.Contrast
+    self.Shifts = np.array([[0, 0], [1.5, -2.25], [-3, 1], [0.4, 0.7], [0, 0], [-1.3, 0]]) # Frame 4 is the reference
+
+  def test_IntegerShifts(self):
+    Shifts = np.round(self.Shifts)
+    Estimated, Peaks = MotionCorrection.EstimateShifts(MotionCorrection.ShiftFrames(self.Slice, Shifts))
+    np.testing.assert_allclose(Estimated, -Shifts, atol=0.01)
+    self.assertEqual(Peaks[MotionCorrection.ReferenceFrame(self.Slice)], Peaks.max())
+
+  def test_SubpixelShifts(self):
+    Estimated, _ = MotionCorrection.EstimateShifts(MotionCorrection.ShiftFrames(self.Slice, self.Shifts))
+    np.testing.assert_allclose(Estimated, -self.Shifts, atol=0.15)
+
+  def test_CorrectVolume(self):
+    Moved = MotionCorrection.ShiftFrames(self.Slice, self.Shifts)[None]
+    Corrected, Shifts, _ = MotionCorrection.CorrectVolume(Moved)
+    self.assertLess(np.abs(Corrected[0]-self.Slice).max(), 0.02*self.Slice.max())
+    np.testing.assert_allclose(MotionCorrection.ShiftVolume(Moved, Shifts), Corrected)
+
+  def test_Rejected(self):
+    """ A shift larger than MaxShift is not applied """
+    Shifts = self.Shifts.copy()
+    Shifts[1] = [30, 0]
+    Estimated, _ = MotionCorrection.EstimateShifts(MotionCorrection.ShiftFrames(self.Slice, Shifts))
+    np.testing.assert_array_equal(Estimated[1], 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
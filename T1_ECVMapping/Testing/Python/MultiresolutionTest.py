@@ -0,0 +1,57 @@
+import unittest
+from unittest import mock
+import numpy as np
+
+import TestFixtures
+from T1_ECVMappingLib import BatchFit, Multiresolution
+
+
+class MultiresolutionTest(unittest.TestCase):
+  """ Coarse to fine fit of a slice, and the propagation of the fit from the converged pixels to their neighbours """
+
+  def test_FitSlice(self):
+    S, Expected = TestFixtures.LookLockerSignals(24*20)
+    Slice = S.reshape(24, 20, -1)
+    Mask = np.ones(Slice.shape[:2], dtype=bool)
+    T1, Params, Iterations, Report = Multiresolution.FitSlice(TestFixtures.TriggerTimes, Slice, Mask, 0, TestFixtures.T1Seeds)
+    np.testing.assert_allclose(T1, Expected, rtol=1e-6)
+    self.assertEqual(Report['Seeded']+Report['Neighbours']+Report['Fallback'], Mask.sum())
+
+  def test_Propagation(self):
+    """ The fit spreads one ring of neighbours per round from the converged pixels, until every pixel is reached """
+    P, _ = TestFixtures.LookLockerParams(1)
+    Shape = (3, 10)
+    I, J = np.nonzero(np.ones(Shape, dtype=bool))
+    N = len(I)
+    S = np.repeat(BatchFit.Signal(TestFixtures.TriggerTimes, P), N, axis=0)
+    Ok = J == 0 # Only the first column converged
+    T1 = np.where(Ok, 1000., np.nan)
+    Params = np.where(Ok[:,None], P, np.nan)
+    Iterations = np.zeros(N, dtype=int)
+    Rounds = []
+    def FitSeeds(TT, S, P0, DeltaT, T1Min, T1Max, MaxIter, Model): # Every pixel converges to the mean of its neighbours
+      Rounds.append(len(S))
+      return np.full(len(S), 1000.), P0, np.ones(len(S), dtype=bool), np.ones(len(S), dtype=int)
+    with mock.patch.object(Multiresolution, 'FitSeeds', FitSeeds):
+      Fitted, RoundCount = Multiresolution.FitFromNeighbours(TestFixtures.TriggerTimes, S, (I,J), Shape, T1, Params, Ok, Iterations, 0, 40, 3000)
+    self.assertEqual((Fitted, RoundCount), (N-3, 9))
+    self.assertEqual(Rounds, [3]*9) # One column per round
+    self.assertTrue(np.all(Ok))
+    np.testing.assert_array_equal(Iterations, np.where(J == 0, 0, 1))
+
+  def test_Unreachable(self):
+    """ The propagation stops when no pixel converges, the remaining ones are left to the fallback seeds """
+    Shape = (1, 4)
+    I, J = np.nonzero(np.ones(Shape, dtype=bool))
+    P, _ = TestFixtures.LookLockerParams(1)
+    Ok = J == 0
+    T1, Params = np.where(Ok, 1000., np.nan), np.where(Ok[:,None], P, np.nan)
+    Failed = lambda TT, S, P0, *Args: (np.full(len(S), np.nan), np.full((len(S),4), np.nan), np.zeros(len(S), dtype=bool), np.ones(len(S), dtype=int))
+    with mock.patch.object(Multiresolution, 'FitSeeds', Failed):
+      Result = Multiresolution.FitFromNeighbours(TestFixtures.TriggerTimes, np.zeros((4, 12)), (I,J), Shape, T1, Params, Ok, np.zeros(4, dtype=int), 0, 40, 3000)
+    self.assertEqual(Result, (0, 1))
+    np.testing.assert_array_equal(Ok, [True, False, False, False])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+import numpy as np
+
+import TestFixtures
+from T1_ECVMappingLib import BatchFit, ParallelFit
+
+
+@unittest.skipUnless(ParallelFit.IsAvailable(), 'Shared memory needs Python 3.8')
+class ParallelFitTest(unittest.TestCase):
+  """ The fit in the worker processes gives exactly the serial fit of BatchFit.FitT1 """
+
+  @classmethod
+  def tearDownClass(cls):
+    ParallelFit.ShutdownPool()
+
+  def setUp(self):
+    S, _ = TestFixtures.LookLockerSignals(2*48*64, Noise = 12)
+    self.MvImg = S.reshape(2, 48, 64, -1) # More pixels than BatchFit.ChunkSize, so there are several tasks
+    self.Mask = np.zeros(self.MvImg.shape[:-1], dtype=bool)
+    self.Mask[:, 4:44, 2:] = True
+
+  def Serial(self, Counters = None, Model = None):
+    T1 = np.zeros(self.Mask.shape)
+    Params = np.full(self.Mask.shape+(4,), np.nan)
+    Iterations = np.zeros(self.Mask.shape, dtype=int)
+    for k in range(self.Mask.shape[0]):
+      T1[k][self.Mask[k]], Params[k][self.Mask[k]], Iterations[k][self.Mask[k]] = BatchFit.FitT1(
+        TestFixtures.TriggerTimes, self.MvImg[k][self.Mask[k]], 0, TestFixtures.T1Seeds, ReturnIterations = True, Counters = Counters, Model = Model)
+    return np.nan_to_num(T1), Params, Iterations
+
+  def Parallel(self, Counters = None):
+    return ParallelFit.FitT1Parallel(self.MvImg, self.Mask, TestFixtures.TriggerTimes, 0, TestFixtures.T1Seeds, 40, 3000, 2, Counters = Counters)
+
+  def test_SerialEquality(self):
+    Maps, Expected = self.Parallel(), self.Serial()
+    self.assertEqual(len(Maps), len(Expected))
+    for Map, ExpectedMap in zip(Maps, Expected):
+      np.testing.assert_array_equal(Map, ExpectedMap)
+
+  def test_Counters(self):
+    """ The counters returned by the workers add up to the ones of the serial fit """
+    Counters, Expected = {}, {}
+    self.Parallel(Counters)
+    self.Serial(Expected)
+    self.assertEqual(Counters, Expected)
+    self.assertEqual(Counters['Fits'], np.count_nonzero(self.Mask))
+
+  def test_Model(self):
+    """ The model is sent to the workers with the tasks """
+    T1, _, _ = ParallelFit.FitT1Parallel(self.MvImg, self.Mask, TestFixtures.TriggerTimes, 0, TestFixtures.T1Seeds, 40, 3000, 2, Model = 'MOLLI')
+    np.testing.assert_array_equal(T1, self.Serial(Model = 'MOLLI')[0])
+
+  def test_Cancel(self):
+    """ Cancelling a job doesn't affect the pool nor the jobs running with it """
+    Pool = ParallelFit.GetPool(2)
+    Cancelled = ParallelFit.FitJob(self.MvImg, self.Mask, TestFixtures.TriggerTimes, 0, TestFixtures.T1Seeds, 40, 3000, 2)
+    Running = ParallelFit.FitJob(self.MvImg, self.Mask, TestFixtures.TriggerTimes, 0, TestFixtures.T1Seeds, 40, 3000, 2)
+    Cancelled.Cancel()
+    np.testing.assert_array_equal(Running.Wait()[0], self.Serial()[0])
+    self.assertIs(ParallelFit.GetPool(2), Pool)
+    for Task in Cancelled.Tasks:
+      Task.wait()
+    self.assertTrue(all(Task.successful() for Task in Cancelled.Tasks))
+
+  def test_StartJobs(self):
+    """ Jobs started together give the same maps as one at a time """
+    Jobs = [ParallelFit.FitJob(self.MvImg, self.Mask, TestFixtures.TriggerTimes, 0, TestFixtures.T1Seeds, 40, 3000, 2, Start = False) for _ in range(2)]
+    ParallelFit.StartJobs(Jobs)
+    Expected = self.Serial()[0]
+    for Job in Jobs:
+      np.testing.assert_array_equal(Job.Wait()[0], Expected)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+import numpy as np
+
+import TestFixtures # Makes T1_ECVMappingLib importable
+from T1_ECVMappingLib import Resample
+
+
+class ResampleTest(unittest.TestCase):
+  """ Resampling of the T1 maps on the grid of another one, with their IJK to RAS matrices """
+
+  def setUp(self):
+    Resample.Cache.clear()
+    self.Native = np.diag([2.0, 2.0, 8.0, 1.0]) # 2 mm pixels, 8 mm slices
+    self.Enhanced = np.diag([1.0, 1.0, 8.0, 1.0])
+    self.Enhanced[:2,3] = -0.5 # Same field of view with 1 mm pixels
+    self.Source = np.add.outer(np.arange(32.0), 100*np.arange(32.0))[None] # Linear ramp along i and j
+
+  def test_SameGeometry(self):
+    """ The same grid gives back the source """
+    Resampled, Inside = Resample.ResampleVolume(self.Source, self.Native, self.Native, self.Source.shape)
+    np.testing.assert_array_equal(Resampled, self.Source)
+    self.assertTrue(Inside.all())
+
+  def test_LinearRamp(self):
+    """ The linear interpolation reproduces a linear ramp, and the borders take the value of the closest pixels """
+    Resampled, Inside = Resample.ResampleVolume(self.Source, self.Native, self.Enhanced, (1,64,64))
+    k, j, i = Resample.SourceCoordinates(self.Native, self.Enhanced, (1,64,64)).T
+    Expected = np.clip(j, 0, 31)+100*np.clip(i, 0, 31)
+    np.testing.assert_allclose(Resampled.ravel(), Expected, atol=1e-9)
+    self.assertTrue(Inside.all())
+
+  def test_Nearest(self):
+    Resampled, _ = Resample.ResampleVolume(self.Source, self.Native, self.Enhanced, (1,64,64), 'nearest')
+    self.assertTrue(np.all(np.isin(Resampled, self.Source)))
+
+  def test_OffsetSingleSlice(self):
+    """ A single slice 5 mm away from the target slice, with 8 mm slices, is resampled in plane """
+    Offset = self.Enhanced.copy()
+    Offset[2,3] = 5
+    Resampled, Inside = Resample.ResampleVolume(self.Source, self.Native, Offset, (1,64,64))
+    Coplanar, _ = Resample.ResampleVolume(self.Source, self.Native, self.Enhanced, (1,64,64))
+    self.assertTrue(Inside.all())
+    np.testing.assert_allclose(Resampled, Coplanar)
+
+  def test_OffsetSingleSliceInStack(self):
+    """ A single slice is only resampled on the closest slice of a target stack """
+    Offset = self.Enhanced.copy()
+    Offset[2,3] = -13 # The target slices are 13, 5 and 3 mm away from the source slice
+    Resampled, Inside = Resample.ResampleVolume(self.Source, self.Native, Offset, (3,64,64))
+    np.testing.assert_array_equal(Inside.any(axis=(1,2)), [False, False, True])
+    np.testing.assert_array_equal(Resampled[:2], 0)
+
+  def test_OutsideStack(self):
+    """ The target slices more than half a slice away from a source stack are outside """
+    Source = np.repeat(self.Source, 3, axis=0)
+    Offset = self.Native.copy()
+    Offset[2,3] = 12
+    _, Inside = Resample.ResampleVolume(Source, self.Native, Offset, Source.shape)
+    np.testing.assert_array_equal(Inside.any(axis=(1,2)), [True, True, False])
+
+  def test_Cache(self):
+    Resample.ResampleVolume(self.Source, self.Native, self.Enhanced, (1,64,64))
+    Resample.ResampleVolume(2*self.Source, self.Native, self.Enhanced, (1,64,64))
+    self.assertEqual(len(Resample.Cache), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
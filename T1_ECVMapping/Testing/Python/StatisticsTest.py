@@ -0,0 +1,51 @@
+import unittest
+import numpy as np
+
+import TestFixtures # Makes T1_ECVMappingLib importable
+from T1_ECVMappingLib import Statistics
+
+
+class StatisticsTest(unittest.TestCase):
+  """ Statistics of several segments at once against the ones of numpy for every segment """
+
+  def setUp(self):
+    Rng = np.random.RandomState(0)
+    self.Array = Rng.uniform(300, 1800, (2, 32, 32))
+    self.Array[0, :4] = np.nan
+    self.Indices = [np.flatnonzero(Rng.rand(*self.Array.shape) < Fraction) for Fraction in (0.1, 0.3, 0.5)]
+
+  def test_KnownValues(self):
+    Result = Statistics.ComputeStatistics([np.array([0, 1, 2, 3]), np.array([4])], [np.array([1., 2., 4., np.nan, 7.])])[0]
+    np.testing.assert_allclose(Result['Mean'], [7/3, 7])
+    np.testing.assert_allclose(Result['Standard Deviation'], [np.sqrt(7/3), np.nan]) # Sample SD, undefined for one value
+    np.testing.assert_array_equal(Result['Minimum'], [1, 7])
+    np.testing.assert_array_equal(Result['Maximum'], [4, 7])
+    np.testing.assert_array_equal(Result['Median'], [2, 7])
+    np.testing.assert_array_equal(Result['Number of voxels'], [3, 1])
+
+  def test_Numpy(self):
+    Results = Statistics.ComputeStatistics(self.Indices, [self.Array, 2*self.Array])
+    self.assertEqual(len(Results), 2)
+    for Result, Array in zip(Results, [self.Array, 2*self.Array]):
+      self.assertEqual(set(Result), set(Statistics.StatisticsKeys))
+      for s, Index in enumerate(self.Indices):
+        Values = Array.ravel()[Index]
+        Values = Values[np.isfinite(Values)]
+        self.assertAlmostEqual(Result['Mean'][s], np.mean(Values))
+        self.assertAlmostEqual(Result['Standard Deviation'][s], np.std(Values, ddof=1))
+        self.assertEqual(Result['Minimum'][s], np.min(Values))
+        self.assertEqual(Result['Maximum'][s], np.max(Values))
+        self.assertEqual(Result['Median'][s], np.median(Values))
+        self.assertEqual(Result['Number of voxels'][s], len(Values))
+
+  def test_Empty(self):
+    """ A segment without voxels, or only with NaN, has NaN statistics and no voxels """
+    NaNIndex = np.flatnonzero(np.isnan(self.Array))[:5]
+    Results = Statistics.ComputeStatistics([np.zeros(0, dtype=int), NaNIndex], [self.Array])[0]
+    for Key in Statistics.StatisticsKeys[:-1]:
+      self.assertTrue(np.all(np.isnan(Results[Key])), Key)
+    np.testing.assert_array_equal(Results['Number of voxels'], 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,32 @@
+import os
+import sys
+import numpy as np
+
+#
+# Fixtures shared by the unit tests of T1_ECVMappingLib
+#
+# Importing this file adds the module folder to sys.path, so the tests import T1_ECVMappingLib without Slicer.
+#
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+TriggerTimes = np.array([110,190,270,1000,1080,1160,1900,1980,2060,2800,2880,2960.]) # Native 4x3 MOLLI-like scheme
+T1Seeds = (1000, 1500, 650, 1250, 500)
+
+
+def LookLockerParams(N, DeltaT = 0, Seed = 0):
+  """ Random Look Locker parameters (N,4) of N pixels, with the columns A,B,Ts,c, and their T1 """
+  Rng = np.random.RandomState(Seed)
+  A = Rng.uniform(200, 600, N)
+  Ratio = Rng.uniform(1.6, 2.0, N) # B/A, the inversion efficiency
+  T1 = Rng.uniform(300, 1800, N)
+  Ts = T1/(Ratio-1)
+  return np.stack([A, A*Ratio*np.exp(-DeltaT/Ts), Ts, np.zeros(N)], axis=1), T1
+
+
+def LookLockerSignals(N, Noise = 0, DeltaT = 0, Seed = 0, TT = TriggerTimes):
+  """ Magnitude Look Locker signals (N,F) at the times TT with gaussian noise, and their T1 """
+  from T1_ECVMappingLib import BatchFit
+  P, T1 = LookLockerParams(N, DeltaT, Seed)
+  Rng = np.random.RandomState(Seed+1)
+  return np.abs(BatchFit.Signal(TT, P)+Rng.normal(0, Noise, (N,len(TT)))), T1